@@ -0,0 +1,29 @@
+# Gunicorn config used by the Docker container
+#
+# Views block while waiting on Kijiji API responses, which can take up to 30 seconds,
+# so each worker process handles many requests at the same time on threads rather than one at a time.
+# Threads spend nearly all of that time waiting on the network, and share one Kijiji API connection pool per process.
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:80')
+
+# Background tasks only run in one of the worker processes
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 32))
+
+# Worker processes stay alive while their threads are waiting, so this only catches stuck workers
+timeout = 120
+graceful_timeout = 60
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info')
+
+
+def post_worker_init(worker):
+    """Start background tasks as soon as each worker process has loaded the app, rather than on its first request"""
+    from kijiji_manager.app import start_background_tasks
+    start_background_tasks(worker.wsgi)
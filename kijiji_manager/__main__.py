@@ -1,7 +1,9 @@
 import argparse
 import os
+import sys
 
-from .app import create_app
+from .app import create_app, start_background_tasks
+from .cli import add_commands, run
 
 # Flask app variable used when starting WSGI server
 # Get config file argument via environment variable
@@ -17,9 +19,18 @@ def main():
     parser.add_argument('-b', '--bind', help='interface to bind to (default: localhost)')
     parser.add_argument('-p', '--port', type=int, help='port to bind to (default: 5000)')
     parser.add_argument('-d', '--debug', action='store_true', help='enable debugging')
+    add_commands(parser)
     args = parser.parse_args()
 
     app = create_app(args.config)
+
+    # Run batch command without starting the web server or background tasks
+    if args.command:
+        sys.exit(run(app, args))
+
+    # The debug reloader only serves requests from its child process, which starts them on its first request
+    if not args.debug:
+        start_background_tasks(app)
     app.run(host=args.bind, port=args.port, debug=args.debug)
 
 
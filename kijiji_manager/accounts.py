@@ -0,0 +1,212 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .export import iter_ads
+from .history import HistoryStore
+from .jobs import StatusJob
+from .kijijiapi import KijijiApiException, error_message
+from .models import registry
+from .payloads import PayloadStore
+from .records import Ad, parse_conversations
+from .repost import REPOST_DELAY_MINUTES, RepostJob, prepare_repost_payload
+
+logger = logging.getLogger(__name__)
+
+# Actions that can be run on many accounts at once
+ACTIONS = {
+    'repost': 'Repost all ads',
+    'sync': 'Sync ads and record history',
+}
+
+
+class RateLimiter:
+    """Space out calls evenly to at most a given number per minute"""
+
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute if per_minute else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call is allowed"""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
+def summarize_account(api, user):
+    """Get ad and conversation totals of an account
+
+    :param api: KijijiApi instance
+    :param user: user dict with 'id', 'token', 'email' and 'name' keys
+    :return: summary dict, with an 'error' message if the account data could not be fetched
+    """
+    summary = {'id': user['id'], 'email': user['email'], 'name': user['name'],
+               'ads': None, 'views': None, 'conversations': None, 'unread': None, 'error': None}
+    try:
+        ads = [Ad.from_dict(ad) for ad in iter_ads(api, user['id'], user['token'])]
+        conversations = parse_conversations(api.get_conversation_page(user['id'], user['token'], 0))
+    except Exception as e:
+        # One account failing, e.g. on an unexpected response, must not fail the whole summary page
+        if not isinstance(e, KijijiApiException):
+            logger.exception('Summary of account %s failed', user['id'])
+        summary['error'] = error_message(e)
+        return summary
+
+    # Only the first page of conversations is checked for unread messages
+    summary.update(
+        ads=len(ads),
+        views=sum(ad.views or 0 for ad in ads),
+        conversations=len(conversations),
+        unread=sum(1 for c in conversations if c.last_message and c.last_message.read is False),
+    )
+    return summary
+
+
+def summarize_accounts(api, users):
+    """Get summaries of many accounts, fetching each account at the same time"""
+    if not users:
+        return []
+    with ThreadPoolExecutor(max_workers=len(users)) as pool:
+        return list(pool.map(lambda user: summarize_account(api, user), users))
+
+
+class AccountBatchJob(StatusJob):
+    """Run an action on many accounts at once
+
+    Each account is handled in its own thread, and the Kijiji API calls made for an account are spaced out
+    to stay within a per-account rate limit.
+    Job progress is written to a JSON status file within the instance folder of the user who started it.
+    """
+
+    FOLDER = 'accounts'
+
+    def __init__(self, api, instance_path, owner_id, users, action, per_minute=10,
+                 delay_minutes=REPOST_DELAY_MINUTES, job_id=None, on_change=None):
+        """
+        :param api: KijijiApi instance
+        :param instance_path: Flask instance folder path
+        :param owner_id: ID of user starting the job, whose instance folder holds the job status
+        :param users: list of user dicts with 'id', 'token', 'email' and 'name' keys
+        :param action: one of ACTIONS
+        :param per_minute: maximum number of ads acted on per minute per account
+        :param delay_minutes: minutes between deleting and posting each reposted ad
+        :param on_change: optional callable given the user ID of each account once its ads have changed
+        """
+        if action not in ACTIONS:
+            raise ValueError(f'Unknown account action {action}')
+
+        self.api = api
+        self.instance_path = instance_path
+        self.owner_id = owner_id
+        self.users = users
+        self.action = action
+        self.per_minute = per_minute
+        self.delay_minutes = delay_minutes
+        self.on_change = on_change
+        self.id = job_id or uuid.uuid4().hex
+
+        self._lock = threading.Lock()
+        self.status = {
+            'id': self.id,
+            'action': action,
+            'state': 'pending',
+            'created': datetime.utcnow().isoformat(timespec='milliseconds'),
+            'finished': None,
+            'accounts': [{'id': user['id'], 'name': user['name'], 'state': 'pending',
+                          'total': None, 'done': 0, 'failed': 0, 'messages': []} for user in users],
+        }
+
+        # Save initial status so that the job can be reported on before it starts running
+        self._write()
+
+    def run(self):
+        """Run job to completion, returning final job status dict"""
+        self._update(state='running')
+        if self.users:
+            with ThreadPoolExecutor(max_workers=len(self.users)) as pool:
+                list(pool.map(self._run_account, range(len(self.users))))
+        return self._update(state='finished', finished=datetime.utcnow().isoformat(timespec='milliseconds'))
+
+    def _run_account(self, i):
+        user = self.users[i]
+
+        # Session token may have been refreshed in the background
+        user = dict(user, token=(registry.get(user['id']) or user)['token'])
+
+        self._update_account(i, state='running')
+        try:
+            ads = list(iter_ads(self.api, user['id'], user['token']))
+            self._update_account(i, total=len(ads))
+
+            if self.action == 'repost':
+                self._repost(i, user, [ad['@id'] for ad in ads])
+            else:
+                self._sync(i, user, ads)
+        except Exception as e:
+            logger.exception('Account batch %s: %s failed for user %s', self.id, self.action, user['id'])
+            self._update_account(i, state='failed', message=error_message(e))
+            return
+
+        if self.on_change:
+            self.on_change(user['id'])
+        self._update_account(i, state='finished')
+        logger.info('Account batch %s: %s finished for user %s', self.id, self.action, user['id'])
+
+    def _repost(self, i, user, ad_ids):
+        """Delete every ad at the rate limit, and then post each one again once its own delay has passed"""
+        limiter = RateLimiter(self.per_minute)
+        payloads = PayloadStore(self.instance_path, user['id'])
+
+        jobs = []
+        for ad_id in ad_ids:
+            limiter.wait()
+            try:
+                xml_payload = prepare_repost_payload(self.api, user['id'], user['token'], user['email'], payloads, ad_id)
+                job = RepostJob(self.api, self.instance_path, user['id'], user['token'], ad_id, xml_payload,
+                                self.delay_minutes)
+                job.delete()
+            except Exception as e:
+                # Job is left to be resumed if it is unknown whether the ad was deleted, e.g. after a timeout
+                self._update_account(i, failed=1, message=f'Ad {ad_id}: {error_message(e)}')
+                continue
+            jobs.append(job)
+
+        # Jobs were created in order, so each one waits until its own post time
+        for job in jobs:
+            try:
+                job.run()
+            except Exception as e:
+                self._update_account(i, failed=1, message=f'Ad {job.status["ad_id"]}: {error_message(e)}')
+                continue
+            self._update_account(i, done=1)
+
+    def _sync(self, i, user, ads):
+        """Record freshly fetched ads to the ad history"""
+        HistoryStore(self.instance_path, user['id']).record_ads(ads)
+        self._update_account(i, done=len(ads))
+
+    def _update_account(self, i, done=0, failed=0, message=None, **kwargs):
+        with self._lock:
+            account = self.status['accounts'][i]
+            account.update(kwargs)
+            account['done'] += done
+            account['failed'] += failed
+            if message:
+                account['messages'].append(message)
+            self._write()
+
+    def _update(self, **kwargs):
+        with self._lock:
+            self.status.update(kwargs)
+            self._write()
+            return dict(self.status)
+
+    def _owner(self):
+        return self.owner_id
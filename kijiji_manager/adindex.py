@@ -0,0 +1,70 @@
+from .records import _int
+
+
+class AdIndex:
+    """Sortable and searchable list of ad records, used to serve the ad table one page at a time
+
+    Search text and sort order of each column are computed once when the index is built,
+    so each request only filters and slices the precomputed lists.
+    """
+
+    # Sort key of each sortable column; missing values always sort last
+    SORT_KEYS = {
+        'id': lambda ad: _int(ad.id),
+        'title': lambda ad: ad.title.lower() if ad.title else None,
+        'category': lambda ad: ad.category.lower() if ad.category else None,
+        'price': lambda ad: _float(ad.price) if ad.price_type == 'SPECIFIED_AMOUNT' else None,
+        'views': lambda ad: ad.views,
+        'page': lambda ad: ad.rank,
+        'start': lambda ad: ad.start_at,
+        'end': lambda ad: ad.end_at,
+    }
+
+    def __init__(self, ads):
+        self.ads = list(ads)
+        self._text = [' '.join(str(v) for v in (ad.id, ad.title, ad.category, ad.price_label) if v).lower()
+                      for ad in self.ads]
+        self._orders = {}
+
+    def __len__(self):
+        return len(self.ads)
+
+    def order(self, column, descending=False):
+        """Get ad positions sorted by given column, or None if column is not sortable"""
+        if column not in self.SORT_KEYS:
+            return None
+        if column not in self._orders:
+            key = self.SORT_KEYS[column]
+            values = [key(ad) for ad in self.ads]
+            ascending = sorted(range(len(self.ads)), key=lambda i: (values[i] is None, values[i]))
+            present = sum(1 for v in values if v is not None)
+            # Missing values stay last in both directions
+            self._orders[column] = (ascending, ascending[present - 1::-1] + ascending[present:] if present else ascending)
+        return self._orders[column][1 if descending else 0]
+
+    def query(self, search=None, column=None, descending=False, start=0, length=None):
+        """Get one page of ads
+
+        :param search: only include ads containing this text in their ID, title, category or price
+        :param column: column to sort by, one of SORT_KEYS
+        :param descending: sort descending rather than ascending
+        :param start: position of first ad to return
+        :param length: maximum number of ads to return, or None for all
+        :return: tuple of number of ads matching search, and list of ad records on the page
+        """
+        positions = self.order(column, descending) or range(len(self.ads))
+
+        if search:
+            terms = search.lower().split()
+            positions = [i for i in positions if all(term in self._text[i] for term in terms)]
+
+        positions = list(positions)
+        end = None if length is None else start + length
+        return len(positions), [self.ads[i] for i in positions[start:end]]
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
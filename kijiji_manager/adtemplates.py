@@ -0,0 +1,201 @@
+import csv
+import io
+import os
+import re
+import uuid
+from datetime import datetime
+from xml.parsers.expat import ExpatError
+
+import xmltodict
+
+from .bulk import BulkImportException
+from .storage import read_json, write_json
+
+# Placeholders look like {{ name }}, name being a CSV column
+_placeholder_pattern = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+
+class AdTemplateStore:
+    """Store of ad templates
+
+    A template is a complete ad payload, including category, attributes, location and links to already uploaded
+    images, whose text values may contain placeholders. Each template is saved as a JSON file within the user's
+    instance folder and is keyed by a random template ID. Templates never expire.
+    """
+
+    # Template IDs are always a 32 character hex string
+    # Anything else is rejected to avoid reading files outside of the templates folder
+    _id_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, instance_path, user_id):
+        self.path = os.path.join(instance_path, 'user', user_id, 'templates')
+
+    def create(self, name, xml_payload):
+        """Save new template
+
+        :param name: template name
+        :param xml_payload: XML payload string
+        :return: new template ID
+        """
+        template_id = uuid.uuid4().hex
+        now = datetime.utcnow().isoformat(timespec='milliseconds')
+        self._write(template_id, dict(_template_data(xml_payload), id=template_id, name=name, created=now, updated=now))
+        return template_id
+
+    def get(self, template_id):
+        """Get template data
+
+        :param template_id: template ID
+        :return: template data dict, or None if template does not exist
+        """
+        template_file = self._file(template_id)
+        if not template_file:
+            return None
+        return read_json(template_file)
+
+    def update(self, template_id, name, xml_payload):
+        """Replace name and payload of existing template
+
+        :return: updated template data dict, or None if template does not exist
+        """
+        template = self.get(template_id)
+        if template is None:
+            return None
+        template.update(_template_data(xml_payload), name=name,
+                        updated=datetime.utcnow().isoformat(timespec='milliseconds'))
+        self._write(template_id, template)
+        return template
+
+    def delete(self, template_id):
+        """Delete template if it exists"""
+        template_file = self._file(template_id)
+        if template_file and os.path.isfile(template_file):
+            os.remove(template_file)
+
+    def list(self):
+        """Get all templates, sorted by name"""
+        if not os.path.isdir(self.path):
+            return []
+
+        templates = []
+        for name in os.listdir(self.path):
+            template_id, ext = os.path.splitext(name)
+            if ext == '.json':
+                template = self.get(template_id)
+                if template is not None:
+                    templates.append(template)
+        return sorted(templates, key=lambda t: t['name'].lower())
+
+    def _file(self, template_id):
+        if not template_id or not self._id_pattern.match(template_id):
+            return None
+        return os.path.join(self.path, f'{template_id}.json')
+
+    def _write(self, template_id, template):
+        write_json(self._file(template_id), template)
+
+
+def _template_data(xml_payload):
+    """Get template payload with its ad ID cleared, so that it is always posted as a new ad, along with its category ID
+
+    :raises BulkImportException: if payload is not a valid ad payload
+    """
+    payload = _parse(xml_payload)
+    payload['ad:ad']['@id'] = ''
+    category = payload['ad:ad'].get('cat:category')
+    return {
+        'payload': xmltodict.unparse(payload, short_empty_elements=True),
+        'category': category.get('@id') if isinstance(category, dict) else None,
+    }
+
+
+def template_fields(xml_payload):
+    """Get names of all placeholders within a template payload, in order of first appearance"""
+    return list(dict.fromkeys(_placeholder_pattern.findall(xml_payload)))
+
+
+def fill_template(xml_payload, values):
+    """Replace placeholders within a template payload
+
+    Placeholders are replaced within parsed text values, so values never need to be XML escaped.
+
+    :param xml_payload: template XML payload string
+    :param values: dict of placeholder name to value
+    :return: XML payload string
+    :raises KeyError: with the placeholder name if there is no value for it
+    """
+    return xmltodict.unparse(_fill(_parse(xml_payload), values), short_empty_elements=True)
+
+
+def generate_payloads(xml_payload, csv_text):
+    """Generate one ad payload for each row of a CSV file
+
+    The first row holds column names, which are matched to template placeholders. Extra columns are ignored.
+
+    :param xml_payload: template XML payload string
+    :param csv_text: CSV file text
+    :return: list of tuples of row name and XML payload string
+    :raises BulkImportException: if any row is missing a value, so that no ads are posted with placeholders left in
+    """
+    fields = template_fields(xml_payload)
+    reader = csv.DictReader(io.StringIO(csv_text))
+
+    missing = [field for field in fields if field not in (reader.fieldnames or [])]
+    if missing:
+        raise BulkImportException(f'CSV file is missing columns: {", ".join(missing)}')
+
+    # Template is only parsed once, and then filled in for each row
+    template = _parse(xml_payload)
+
+    payloads = []
+    errors = []
+    for row_number, row in enumerate(reader, start=2):
+        try:
+            payload = _fill(template, row)
+        except KeyError as e:
+            errors.append(f'Row {row_number} is missing a value for {e.args[0]}')
+            continue
+        name = f'Row {row_number}: {payload["ad:ad"].get("ad:title") or ""}'
+        payloads.append((name, xmltodict.unparse(payload, short_empty_elements=True)))
+
+    if errors:
+        raise BulkImportException('; '.join(errors))
+    return payloads
+
+
+def fill_text(text, values):
+    """Replace placeholders within a text
+
+    :param text: text with placeholders
+    :param values: dict of placeholder name to value
+    :return: text with every placeholder replaced
+    :raises KeyError: with the placeholder name if there is no value for it
+    """
+    def replace(match):
+        value = values.get(match.group(1))
+        if value is None:
+            raise KeyError(match.group(1))
+        return value
+
+    return _placeholder_pattern.sub(replace, text)
+
+
+def _fill(node, values):
+    """Copy of parsed payload with placeholders in every text value replaced"""
+    if isinstance(node, dict):
+        return {key: _fill(value, values) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_fill(value, values) for value in node]
+    if isinstance(node, str):
+        return fill_text(node, values)
+    return node
+
+
+def _parse(xml_payload):
+    try:
+        payload = xmltodict.parse(xml_payload)
+    except ExpatError as e:
+        raise BulkImportException(f'Unable to parse ad payload: {e}')
+    if not isinstance(payload.get('ad:ad'), dict):
+        raise BulkImportException('Ad payload is missing ad:ad root element')
+    return payload
@@ -1,12 +1,22 @@
 import os
+import threading
 
 from flask import Flask, flash, redirect, url_for, request, render_template
 from flask_login import LoginManager
 from werkzeug.serving import WSGIRequestHandler
 
 from . import __version__ as app_version
-from .kijijiapi import KijijiApiException
-from .models import User
+from .autorepost import RepostScheduler
+from .cache import page_cache
+from .credentials import CredentialStore, refresh_tokens
+from .history import sample_history
+from .images import image_processor
+from .kijijiapi import KijijiApi, KijijiApiException
+from .metadata import metadata_cache
+from .models import User, registry
+from .repost import REPOST_RECONCILE_MINUTES, reconcile_reposts
+from .scheduler import LeaderLease, PeriodicTask
+from .warmup import warm_up
 
 
 def create_app(config=None):
@@ -46,6 +56,15 @@ def create_app(config=None):
     # Suppress "None" output as string
     app.jinja_env.finalize = lambda x: x if x is not None else ''
 
+    # Rendered page fragment and API data cache
+    page_cache.init_app(app)
+
+    # Category attribute metadata cache, shared by all users
+    metadata_cache.init_app(app)
+
+    # Uploaded image preprocessing
+    image_processor.init_app(app)
+
     # Flask-Executor
     from .views.ad import executor as ad_executor
     ad_executor.init_app(app)
@@ -55,10 +74,12 @@ def create_app(config=None):
     from .views.user import user
     from .views.ad import ad
     from .views.json import json
+    from .views.export import export
     app.register_blueprint(main)
     app.register_blueprint(user)
     app.register_blueprint(ad)
     app.register_blueprint(json)
+    app.register_blueprint(export)
 
     # Handle KijijiApi exceptions
     # Print error message rather than showing a generic 500 Internal Server Error
@@ -86,4 +107,72 @@ def create_app(config=None):
 
     login_manager.init_app(app)
 
+    # Users known to background tasks, shared by every worker process
+    registry.init_app(app)
+
+    # Background tasks only start once the app is serving requests, not for batch commands
+    # WSGI servers may also start them right after loading the app, see start_background_tasks()
+    @app.before_request
+    def start_tasks():
+        start_background_tasks(app)
+
     return app
+
+
+# Guards starting background tasks on the first requests, which may be handled at the same time
+_start_lock = threading.Lock()
+
+
+def start_background_tasks(app):
+    """Start background tasks of app, unless already started
+
+    Called when the app starts serving requests, by its first request or by the WSGI server once the app is loaded,
+    e.g. from the gunicorn `post_worker_init` hook. Processes only running batch commands never start them.
+    """
+    with _start_lock:
+        if app.extensions.get('background_tasks'):
+            return
+        app.extensions['background_tasks'] = True
+
+    # Open connections and load shared metadata in the background, so that the first requests after starting do not wait for it
+    # Runs in every worker process, since each one has its own connection pool and caches
+    if app.config.get('WARMUP'):
+        threading.Thread(target=warm_up, args=(KijijiApi(), registry.all(), app.config.get('WARMUP_CONNECTIONS', 4)),
+                         name='warm-up', daemon=True).start()
+
+    # Only one process runs background tasks when served by many worker processes
+    lease = LeaderLease.get(app.instance_path)
+    app.extensions['leader_lease'] = lease
+
+    # Background ad performance history sampler
+    history_minutes = app.config.get('HISTORY_SAMPLE_MINUTES')
+    if history_minutes:
+        retention_days = app.config.get('HISTORY_RETENTION_DAYS', 90)
+        app.extensions['history_sampler'] = PeriodicTask(
+            'history-sampler', history_minutes * 60,
+            lambda: sample_history(KijijiApi(), app.instance_path, registry.all(), retention_days), lease=lease).start()
+
+    # Background session token refresh using saved credentials
+    if app.config.get('SAVE_CREDENTIALS'):
+        max_age = app.config.get('TOKEN_REFRESH_HOURS', 12) * 60 * 60
+        credentials = CredentialStore(app.instance_path)
+        app.extensions['token_refresher'] = PeriodicTask(
+            'token-refresh', min(max_age / 4, 15 * 60),
+            lambda: refresh_tokens(KijijiApi(), registry, credentials, max_age), lease=lease).start()
+
+    # Resume reposts interrupted by the app or their worker process stopping, or report them until their user logs in again
+    credentials = CredentialStore(app.instance_path) if app.config.get('SAVE_CREDENTIALS') else None
+    app.extensions['repost_reconciler'] = PeriodicTask(
+        'repost-reconcile', REPOST_RECONCILE_MINUTES * 60,
+        reconcile_reposts, KijijiApi(), app.instance_path, credentials, on_change=page_cache.invalidate, lease=lease).start()
+
+    # Background automatic repost of ads which have dropped past a given search results page
+    repost_page = app.config.get('AUTO_REPOST_PAGE')
+    if repost_page:
+        scheduler = RepostScheduler(KijijiApi(), app.instance_path, repost_page,
+                                    app.config.get('AUTO_REPOST_MAX_PER_WINDOW', 5),
+                                    app.config.get('AUTO_REPOST_WINDOW_MINUTES', 60), on_change=page_cache.invalidate)
+        app.extensions['repost_scheduler'] = scheduler
+        app.extensions['repost_checker'] = PeriodicTask(
+            'auto-repost-check', app.config.get('AUTO_REPOST_CHECK_MINUTES', 60) * 60,
+            lambda: scheduler.check(registry.all()), lease=lease).start()
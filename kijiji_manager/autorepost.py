@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+
+from .export import iter_ads
+from .kijijiapi import KijijiApiException
+from .models import registry
+from .payloads import PayloadStore
+from .records import Ad
+from .repost import REPOST_DELAY_MINUTES, repost_ad
+
+logger = logging.getLogger(__name__)
+
+
+class RepostScheduler:
+    """Automatically repost ads that have dropped too far down the search results
+
+    Each check looks at the rank of every ad and picks the ones past the page threshold, lowest ranked first.
+    At most `max_per_window` reposts are started per user within each time window, and the reposts picked
+    in one check are spaced evenly across the window rather than all being started at once.
+    Each repost waits for its start time on its own timer thread, so reposts of one user never hold up
+    those of another user, and start on time however long earlier ones take.
+    Ads that are already being reposted are skipped.
+    """
+
+    def __init__(self, api, instance_path, page_threshold, max_per_window=5, window_minutes=60,
+                 delay_minutes=REPOST_DELAY_MINUTES, on_change=None):
+        """
+        :param on_change: optional callable given the user ID whenever a repost changes the user's ads
+        """
+        self.api = api
+        self.instance_path = instance_path
+        self.page_threshold = page_threshold
+        self.max_per_window = max(1, int(max_per_window))
+        self.window = window_minutes * 60
+        self.delay_minutes = delay_minutes
+        self.on_change = on_change
+
+        # Pairs of user ID and ad ID currently being reposted
+        self.in_flight = set()
+
+        # Scheduled start times of recent reposts, by user ID
+        self._starts = {}
+
+        self._lock = threading.Lock()
+
+    def check(self, users):
+        """Check ad ranks of each given user and schedule reposts
+
+        :param users: list of user dicts with 'id', 'token' and 'email' keys
+        :return: list of pairs of user ID and ad ID scheduled for repost
+        """
+        scheduled = []
+        for user in users:
+            try:
+                ads = [Ad.from_dict(ad) for ad in iter_ads(self.api, user['id'], user['token'])]
+            except KijijiApiException as e:
+                logger.warning('Unable to check ad ranks for user %s: %s', user['id'], e)
+                continue
+
+            now = time.time()
+            with self._lock:
+                candidates = []
+                for ad in ads:
+                    if ad.page is not None and ad.page > self.page_threshold and (user['id'], ad.id) not in self.in_flight:
+                        candidates.append((ad.rank, ad.id))
+
+                # Lowest ranked ads first
+                candidates.sort(reverse=True)
+
+                starts = [t for t in self._starts.get(user['id'], []) if t > now - self.window]
+                allowance = self.max_per_window - len(starts)
+                spacing = self.window / self.max_per_window
+
+                for i, (_, ad_id) in enumerate(candidates[:max(0, allowance)]):
+                    # Space out reposts after the latest one already scheduled
+                    start = max([now] + [t + spacing for t in starts])
+                    starts.append(start)
+                    self.in_flight.add((user['id'], ad_id))
+                    timer = threading.Timer(start - now, self._repost, (user, ad_id))
+                    timer.name = f'auto-repost-{ad_id}'
+                    timer.daemon = True
+                    timer.start()
+                    scheduled.append((user['id'], ad_id))
+
+                self._starts[user['id']] = starts
+
+            if candidates:
+                logger.info('Scheduled %d of %d ads past page %d for repost for user %s',
+                            min(len(candidates), max(0, allowance)), len(candidates), self.page_threshold, user['id'])
+        return scheduled
+
+    def _repost(self, user, ad_id):
+        try:
+            # Session token may have been refreshed while waiting
+            user = registry.get(user['id']) or user
+            payloads = PayloadStore(self.instance_path, user['id'])
+            ad_id_new = repost_ad(self.api, user['id'], user['token'], user['email'], payloads, ad_id,
+                                  self.delay_minutes, warn=logger.warning, on_change=self.on_change)
+            logger.info('Automatically reposted ad %s, new ID %s', ad_id, ad_id_new)
+        except Exception:
+            logger.exception('Failed to automatically repost ad %s', ad_id)
+        finally:
+            with self._lock:
+                self.in_flight.discard((user['id'], ad_id))
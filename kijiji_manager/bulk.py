@@ -0,0 +1,230 @@
+import io
+import logging
+import os
+import tarfile
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from xml.parsers.expat import ExpatError, errors
+
+import xmltodict
+
+from .jobs import StatusJob
+from .kijijiapi import KijijiApiException, error_message
+from .locations import resolve_location
+from .payloads import PayloadStore
+from .validation import validate_payloads
+
+logger = logging.getLogger(__name__)
+
+class BulkImportException(Exception):
+    """Bulk import exception"""
+
+
+def read_archive(fileobj, filename):
+    """Read ad payloads from a zip or tar archive
+
+    Only files with an .xml extension are read, everything else in the archive is ignored.
+
+    :param fileobj: binary file-like object of archive contents
+    :param filename: archive file name, used to determine archive type
+    :return: list of tuples of payload file name and payload text
+    """
+    data = fileobj.read()
+    payloads = []
+    try:
+        if filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and info.filename.lower().endswith('.xml'):
+                        payloads.append((info.filename, archive.read(info).decode('utf-8')))
+        else:
+            # Compression (if any) is detected automatically
+            with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+                for member in archive.getmembers():
+                    if member.isfile() and member.name.lower().endswith('.xml'):
+                        payloads.append((member.name, archive.extractfile(member).read().decode('utf-8')))
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        raise BulkImportException(f'Unable to read archive {filename}: {e}')
+    except UnicodeDecodeError as e:
+        raise BulkImportException(f'Ad payload in archive {filename} is not valid UTF-8 text: {e}')
+    return sorted(payloads)
+
+
+def read_directory(path):
+    """Read ad payloads from all XML files within a directory
+
+    :param path: directory path
+    :return: list of tuples of payload file name and payload text
+    """
+    if not os.path.isdir(path):
+        raise BulkImportException(f'Directory {path} does not exist')
+
+    payloads = []
+    for name in sorted(os.listdir(path)):
+        file = os.path.join(path, name)
+        if os.path.isfile(file) and name.lower().endswith('.xml'):
+            with open(file, 'r', encoding='utf-8') as f:
+                payloads.append((name, f.read()))
+    return payloads
+
+
+def validate_payload(xml_payload):
+    """Check that an ad payload is well formed before attempting to post it
+
+    This only catches malformed payloads; invalid ad values are still reported back by Kijiji after posting.
+
+    :param xml_payload: XML payload string
+    :return: list of error messages, empty if payload is valid
+    """
+    try:
+        doc = xmltodict.parse(xml_payload)
+    except ExpatError as e:
+        return [f'Unable to parse XML: {errors.messages[e.code]}']
+
+    ad = doc.get('ad:ad') if isinstance(doc, dict) else None
+    if not isinstance(ad, dict):
+        return ['Missing ad:ad root element']
+
+    messages = []
+    for key in ['cat:category', 'loc:locations', 'ad:ad-type', 'ad:title', 'ad:description']:
+        if not ad.get(key):
+            messages.append(f'Missing {key} element')
+    return messages
+
+
+class BulkPostJob(StatusJob):
+    """Validate and post many ad payloads in the background
+
+    Payloads with a postal code but no location first get the location closest to their postal code.
+    Payloads are validated in parallel, first for being well formed and then against their category's
+    attribute metadata, and then the valid ones are posted through a bounded pool of workers.
+    Posted payloads are saved to the user's payload store.
+    Job progress is written to a JSON status file within the user's instance folder after every payload,
+    so that it can be reported while the job is still running.
+    A job always ends up finished, with an error message if it was stopped early by an unexpected error.
+    """
+
+    FOLDER = 'bulk'
+
+    def __init__(self, api, instance_path, user_id, token, payloads, workers=4, job_id=None, progress=None,
+                 on_change=None):
+        self.api = api
+        self.instance_path = instance_path
+        self.user_id = user_id
+        self.token = token
+        self.payloads = payloads
+        self.workers = max(1, int(workers))
+        self.id = job_id or uuid.uuid4().hex
+
+        # Optional callable given each payload result dict as soon as it changes
+        self.progress = progress
+
+        # Optional callable given the user ID once the job has posted any ads
+        self.on_change = on_change
+
+        self._lock = threading.Lock()
+        self.status = {
+            'id': self.id,
+            'state': 'pending',
+            'created': datetime.utcnow().isoformat(timespec='milliseconds'),
+            'finished': None,
+            'total': len(payloads),
+            'validated': 0,
+            'posted': 0,
+            'failed': 0,
+            'error': None,
+            'results': [{'name': name, 'state': 'pending', 'ad_id': None, 'messages': []} for name, _ in payloads],
+        }
+
+        # Save initial status so that the job can be reported on before it starts running
+        self._write()
+
+    def run(self):
+        """Run job to completion, returning final job status dict"""
+        try:
+            self._run()
+        except Exception as e:
+            logger.exception('Bulk post %s stopped early', self.id)
+            self._update(error=error_message(e))
+        finally:
+            status = self._update(state='finished', finished=datetime.utcnow().isoformat(timespec='milliseconds'))
+            if self.on_change and status['posted']:
+                self.on_change(self.user_id)
+        return status
+
+    def _run(self):
+        self._update(state='validating')
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            resolved = list(pool.map(self._resolve, [xml_payload for _, xml_payload in self.payloads]))
+            self.payloads = [(name, xml_payload) for (name, _), (xml_payload, _) in zip(self.payloads, resolved)]
+            messages = list(pool.map(validate_payload, [xml_payload for _, xml_payload in self.payloads]))
+
+        # Payloads whose location could not be filled in are reported as is, since they would fail validation anyway
+        messages = [resolve_messages or result_messages for (_, resolve_messages), result_messages in zip(resolved, messages)]
+
+        # Well formed payloads are then checked against the attribute metadata of their category
+        # Metadata is fetched once per category for the whole batch, so invalid payloads fail before any are posted
+        well_formed = [i for i, result_messages in enumerate(messages) if not result_messages]
+        checked = validate_payloads(self.api, self.user_id, self.token,
+                                    [self.payloads[i][1] for i in well_formed], self.workers)
+        for i, result_messages in zip(well_formed, checked):
+            messages[i] = result_messages
+
+        valid = []
+        for i, result_messages in enumerate(messages):
+            if result_messages:
+                self._update_result(i, state='invalid', messages=result_messages)
+            else:
+                valid.append(i)
+                self._update_result(i, state='valid')
+
+        self._update(state='posting')
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(self._post, valid))
+
+    def _resolve(self, xml_payload):
+        """Get payload with the location closest to its postal code filled in, and a list of any error messages"""
+        try:
+            return resolve_location(self.api, self.user_id, self.token, xml_payload), []
+        except Exception as e:
+            logger.warning('Bulk post %s: unable to find location of postal code: %s', self.id, e)
+            return xml_payload, [f'Unable to find location of postal code: {error_message(e)}']
+
+    def _post(self, i):
+        name, xml_payload = self.payloads[i]
+        try:
+            ad_id = self.api.post_ad(self.user_id, self.token, xml_payload)
+        except Exception as e:
+            # Other errors, e.g. timeouts, only fail this payload rather than the whole job
+            if not isinstance(e, KijijiApiException):
+                logger.exception('Bulk post %s: unable to post %s', self.id, name)
+            self._update_result(i, state='failed', messages=[error_message(e)])
+            return
+
+        PayloadStore(self.instance_path, self.user_id).save(ad_id, xml_payload)
+        self._update_result(i, state='posted', ad_id=ad_id)
+
+    def _update_result(self, i, **kwargs):
+        with self._lock:
+            result = self.status['results'][i]
+            result.update(kwargs)
+            if result['state'] in ('valid', 'invalid'):
+                self.status['validated'] += 1
+            if result['state'] == 'posted':
+                self.status['posted'] += 1
+            elif result['state'] in ('invalid', 'failed'):
+                self.status['failed'] += 1
+            self._write()
+        if self.progress:
+            self.progress(dict(result))
+
+    def _update(self, **kwargs):
+        with self._lock:
+            self.status.update(kwargs)
+            self._write()
+            return dict(self.status)
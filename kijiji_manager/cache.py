@@ -0,0 +1,165 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import make_response, render_template, request, session
+from markupsafe import Markup
+
+from .storage import atomic_write, file_identity
+from .version import __version__
+
+
+class Memo:
+    """Thread-safe memo of computed values, discarding the least recently used values when full"""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, func):
+        """Get memoized value for key, calling func to compute it if not memoized yet"""
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key]
+
+        value = func()
+        self.put(key, value)
+        return value
+
+    def peek(self, key, default=None):
+        """Get memoized value for key, or default if not memoized"""
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key]
+        return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class PageCache:
+    """Cache of rendered page fragments and fetched API data per user
+
+    Fragments are keyed by a content hash of the data they are rendered from, so they never go stale
+    and need no invalidation. API data is only cached for `CACHE_SECONDS` seconds if configured,
+    and is invalidated whenever the user changes their ads or conversations.
+
+    Each worker process has its own cache, so API data is also keyed by a per-user version stamp file
+    within the instance folder. Invalidating replaces the stamp, which invalidates the data cached by every process.
+    """
+
+    # Version stamp file within each user folder
+    VERSION_FILE = 'cache.version'
+
+    def __init__(self, app=None):
+        self.ttl = 0
+        self.path = None
+        self.fragments = Memo(256)
+        # Expired and invalidated data is never looked up again and is discarded once least recently used
+        self._data = Memo(512)
+        # Number of times data of each user was invalidated by this process
+        self._versions = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('CACHE_SECONDS', 0)
+        self.path = os.path.join(app.instance_path, 'user')
+        app.extensions['page_cache'] = self
+
+    def data(self, user_id, key, func, ttl=None):
+        """Get API data, calling func to fetch it if not cached or expired
+
+        :param ttl: seconds to cache data for, defaults to `CACHE_SECONDS`
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if not ttl:
+            return func()
+
+        now = time.monotonic()
+        cache_key = (user_id, self._version(user_id), key)
+        cached = self._data.peek(cache_key)
+        if cached and now - cached[0] < ttl:
+            return cached[1]
+
+        value = func()
+        self._data.put(cache_key, (now, value))
+        return value
+
+    def invalidate(self, user_id):
+        """Discard all cached API data of a user, in every worker process"""
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+        if self.path is not None:
+            with atomic_write(self._version_file(user_id)) as f:
+                f.write(uuid.uuid4().hex)
+
+    def _version(self, user_id):
+        with self._lock:
+            local = self._versions.get(user_id, 0)
+        if self.path is None:
+            return local
+        return local, file_identity(self._version_file(user_id))
+
+    def _version_file(self, user_id):
+        return os.path.join(self.path, user_id, self.VERSION_FILE)
+
+    def render(self, user_id, template, source, **context):
+        """Render a template fragment, reusing the previous rendering while its source data is unchanged
+
+        :param user_id: user ID, fragments are never shared between users
+        :param template: fragment template name
+        :param source: data the fragment is rendered from, must have a stable repr()
+        :param context: template context
+        :return: tuple of rendered Markup, content hash and time first rendered
+        """
+        digest = content_hash(user_id, template, source)
+        fragment, rendered = self.fragments.get(
+            (user_id, digest),
+            lambda: (Markup(render_template(template, **context)), datetime.now(timezone.utc).replace(microsecond=0)))
+        return fragment, digest, rendered
+
+    def render_page(self, user_id, template, fragment_template, source, **context):
+        """Render page with a cached fragment, and answer conditional requests with 304 Not Modified
+
+        The fragment is given to the page template as `fragment`.
+        Pages with pending flashed messages are always sent in full, since those are only shown once.
+        """
+        fragment, digest, rendered = self.render(user_id, fragment_template, source, **context)
+        conditional = not session.get('_flashes')
+
+        if conditional and digest in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            response = make_response(render_template(template, fragment=fragment, **context))
+
+        if conditional:
+            response.set_etag(digest)
+            response.last_modified = rendered
+        # Browser may keep the page, but has to check that it is still current every time
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+
+def content_hash(*values):
+    """Hash of repr() of given values and the app version, since templates change along with it"""
+    return hashlib.sha1(repr((__version__,) + values).encode('utf-8')).hexdigest()
+
+
+page_cache = PageCache()
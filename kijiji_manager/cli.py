@@ -0,0 +1,218 @@
+import getpass
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .bulk import BulkPostJob
+from .export import FORMATS, AD_FIELDS, CONVERSATION_FIELDS, iter_ads, iter_conversations, flatten_ad, flatten_conversation, export
+from .kijijiapi import KijijiApi, KijijiApiException, error_message
+from .payloads import PayloadStore
+from .repost import REPOST_DELAY_MINUTES, repost_ad
+from .storage import write_json
+
+# Name of file within the instance folder used to keep the command line login session between runs
+SESSION_FILE = 'cli-session.json'
+
+
+class CliException(Exception):
+    """Command line interface exception"""
+
+
+def add_commands(parser):
+    """Add batch subcommands to given argument parser
+
+    Every subcommand prints its result to stdout as JSON. Progress messages are printed to stderr.
+    """
+    subparsers = parser.add_subparsers(dest='command', metavar='command',
+                                       help='batch command to run instead of starting the web server')
+
+    login = subparsers.add_parser('login', help='login and save session for other commands')
+    login.add_argument('-u', '--username', required=True, help='login email')
+    login.add_argument('--password', help='login password (default: KIJIJI_PASSWORD environment variable, or prompt)')
+
+    subparsers.add_parser('logout', help='clear saved session')
+
+    subparsers.add_parser('ads', help='list all ads')
+
+    repost = subparsers.add_parser('repost', help='repost ads')
+    repost_ids = repost.add_mutually_exclusive_group(required=True)
+    repost_ids.add_argument('ad_ids', nargs='*', default=[], metavar='ad_id', help='ad ID to repost')
+    repost_ids.add_argument('--all', action='store_true', help='repost all ads')
+    repost.add_argument('--delay', type=float, default=REPOST_DELAY_MINUTES,
+                        help=f'minutes to wait between deleting and posting each ad (default: {REPOST_DELAY_MINUTES})')
+    repost.add_argument('-w', '--workers', type=int, default=4, help='number of ads reposted at the same time (default: 4)')
+
+    post = subparsers.add_parser('post', help='post ads from XML payload files')
+    post.add_argument('files', nargs='+', metavar='file', help='XML ad payload file')
+    post.add_argument('-w', '--workers', type=int, default=4, help='number of ads posted at the same time (default: 4)')
+
+    conversations = subparsers.add_parser('conversations', help='export all conversations')
+    conversations.add_argument('--pages', type=int, help='maximum number of conversation pages to export')
+
+    export_data = subparsers.add_parser('export', help='stream all ads or conversations as JSONL or CSV')
+    export_data.add_argument('data', choices=['ads', 'conversations'], help='data to export')
+    export_data.add_argument('-f', '--format', choices=list(FORMATS), default='jsonl', help='export format (default: jsonl)')
+    export_data.add_argument('-o', '--output', help='output file (default: stdout)')
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('-q', '--quiet', action='store_true', help='do not print progress messages')
+
+
+def run(app, args):
+    """Run batch subcommand given by parsed arguments
+
+    :param app: Flask app, used for its config and instance folder
+    :param args: parsed arguments
+    :return: process exit code
+    """
+    cli = Cli(app.instance_path, quiet=args.quiet)
+    commands = {
+        'login': lambda: cli.login(args.username, args.password),
+        'logout': cli.logout,
+        'ads': cli.ads,
+        'repost': lambda: cli.repost(args.ad_ids, args.all, args.delay, args.workers),
+        'post': lambda: cli.post(args.files, args.workers),
+        'conversations': lambda: cli.conversations(args.pages),
+        'export': lambda: cli.export(args.data, args.format, args.output),
+    }
+    try:
+        result, ok = commands[args.command]()
+    except (CliException, KijijiApiException) as e:
+        result, ok = {'error': error_message(e)}, False
+
+    # Exported data has already been written to stdout
+    if result is not None:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return 0 if ok else 1
+
+
+class Cli:
+    """Batch operations using KijijiApi directly, without the web interface"""
+
+    def __init__(self, instance_path, quiet=False, api=None):
+        self.instance_path = instance_path
+        self.quiet = quiet
+        self.api = api or KijijiApi()
+
+    def progress(self, message):
+        if not self.quiet:
+            print(message, file=sys.stderr, flush=True)
+
+    def login(self, username, password=None):
+        if not password:
+            password = os.environ.get('KIJIJI_PASSWORD') or getpass.getpass()
+
+        user_id, token = self.api.login(username, password)
+        name = self.api.get_profile(user_id, token)['user:user-profile']['user:user-display-name']
+        user = {'id': user_id, 'token': token, 'email': username, 'name': name}
+
+        # Session token is as good as a password; only the current user may read it
+        write_json(self._session_file(), user, private=True)
+
+        self.progress(f'Logged in as {name}')
+        return {'id': user_id, 'email': username, 'name': name}, True
+
+    def logout(self):
+        if os.path.isfile(self._session_file()):
+            os.remove(self._session_file())
+        return {}, True
+
+    def ads(self):
+        user = self._user()
+        return [flatten_ad(ad) for ad in iter_ads(self.api, user['id'], user['token'])], True
+
+    def repost(self, ad_ids, repost_all=False, delay_minutes=REPOST_DELAY_MINUTES, workers=4):
+        user = self._user()
+        if repost_all:
+            ad_ids = [ad['@id'] for ad in iter_ads(self.api, user['id'], user['token'])]
+
+        payloads = PayloadStore(self.instance_path, user['id'])
+
+        def repost_one(ad_id):
+            self.progress(f'Reposting ad {ad_id} after {delay_minutes} minute delay')
+            ad_id_new = repost_ad(self.api, user['id'], user['token'], user['email'], payloads, ad_id,
+                                  delay_minutes, warn=self.progress)
+            self.progress(f'Reposted ad {ad_id}, new ID {ad_id_new}')
+            return ad_id_new
+
+        results = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(repost_one, ad_id): ad_id for ad_id in ad_ids}
+            for future in as_completed(futures):
+                result = {'ad_id': futures[future], 'new_ad_id': None, 'error': None}
+                try:
+                    result['new_ad_id'] = future.result()
+                except KijijiApiException as e:
+                    result['error'] = error_message(e)
+                    self.progress(f'Failed to repost ad {result["ad_id"]}: {result["error"]}')
+                results.append(result)
+
+        return results, all(result['error'] is None for result in results)
+
+    def post(self, files, workers=4):
+        user = self._user()
+
+        payloads = []
+        for file in files:
+            with open(file, 'r', encoding='utf-8') as f:
+                payloads.append((file, f.read()))
+
+        def progress(result):
+            if result['state'] == 'posted':
+                self.progress(f'Posted {result["name"]}, new ID {result["ad_id"]}')
+            elif result['state'] in ('invalid', 'failed'):
+                self.progress(f'Failed to post {result["name"]}: {"; ".join(result["messages"])}')
+
+        job = BulkPostJob(self.api, self.instance_path, user['id'], user['token'], payloads, workers, progress=progress)
+        status = job.run()
+        if status['error']:
+            self.progress(f'Bulk post stopped early: {status["error"]}')
+        return status['results'], status['failed'] == 0 and not status['error']
+
+    def conversations(self, max_pages=None):
+        user = self._user()
+        return list(iter_conversations(self.api, user['id'], user['token'], max_pages)), True
+
+    def export(self, data, fmt='jsonl', output=None):
+        """Write exported rows one at a time, so memory use does not grow with the number of ads or conversations"""
+        user = self._user()
+        if data == 'ads':
+            rows = (flatten_ad(ad) for ad in iter_ads(self.api, user['id'], user['token']))
+            fieldnames = AD_FIELDS
+        else:
+            rows = (flatten_conversation(c) for c in iter_conversations(self.api, user['id'], user['token']))
+            fieldnames = CONVERSATION_FIELDS
+
+        count = 0
+
+        def counted(rows):
+            nonlocal count
+            for row in rows:
+                count += 1
+                if count % 100 == 0:
+                    self.progress(f'Exported {count} {data}')
+                yield row
+
+        if output:
+            with open(output, 'w', encoding='utf-8', newline='') as f:
+                for chunk in export(counted(rows), fieldnames, fmt):
+                    f.write(chunk)
+            self.progress(f'Exported {count} {data} to {output}')
+            return {'file': output, 'count': count}, True
+
+        for chunk in export(counted(rows), fieldnames, fmt):
+            sys.stdout.write(chunk)
+        return None, True
+
+    def _session_file(self):
+        return os.path.join(self.instance_path, SESSION_FILE)
+
+    def _user(self):
+        try:
+            with open(self._session_file(), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise CliException("Not logged in; run the 'login' command first")
+
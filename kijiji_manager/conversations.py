@@ -0,0 +1,82 @@
+import logging
+import os
+import re
+
+from .records import as_list
+from .storage import read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+# Number of most recent messages fetched to update a conversation that was fetched before
+INCREMENTAL_TAIL = 10
+
+# Number of most recent messages fetched for a conversation that was never fetched, or fell too far behind
+FULL_TAIL = 100
+
+
+class ConversationStore:
+    """Store of conversations fetched before, as returned by KijijiApi.get_conversation()
+
+    Each conversation is saved as a JSON file within the user's instance folder, keyed by conversation ID.
+    """
+
+    # Conversation IDs are letters, digits and dashes
+    # Anything else is rejected to avoid reading files outside of the conversations folder
+    _id_pattern = re.compile(r'^[\w-]+$')
+
+    def __init__(self, instance_path, user_id):
+        self.path = os.path.join(instance_path, 'user', user_id, 'conversations')
+
+    def load(self, conversation_id):
+        """Get saved conversation response data dict, or None if not saved"""
+        conversation_file = self._file(conversation_id)
+        if not conversation_file:
+            return None
+        return read_json(conversation_file)
+
+    def save(self, conversation_id, data):
+        conversation_file = self._file(conversation_id)
+        if conversation_file:
+            write_json(conversation_file, data)
+
+    def _file(self, conversation_id):
+        if not conversation_id or not self._id_pattern.match(conversation_id):
+            return None
+        return os.path.join(self.path, f'{conversation_id}.json')
+
+
+def fetch_conversation(api, user_id, token, conversation_id, store, tail=INCREMENTAL_TAIL):
+    """Get single conversation, only fetching the messages posted since it was last fetched
+
+    The most recent messages are fetched and merged into the saved copy of the conversation, as long as they
+    include the last message seen before. Otherwise there may be messages missing in between, and the
+    conversation is fetched again in full.
+
+    :param api: KijijiApi instance
+    :param user_id: user ID number
+    :param token: session token
+    :param conversation_id: conversation ID number
+    :param store: ConversationStore instance for user
+    :param tail: number of most recent messages to fetch of a conversation fetched before
+    :return: response data dict, as returned by KijijiApi.get_conversation()
+    """
+    saved = store.load(conversation_id)
+    known = as_list(saved['user:user-conversation'].get('user:user-message')) if saved else []
+    last_seen = known[-1].get('user:msg-id') if known else None
+
+    if last_seen:
+        data = api.get_conversation(user_id, token, conversation_id, tail=tail)
+        latest = as_list(data['user:user-conversation'].get('user:user-message'))
+        latest_ids = [m.get('user:msg-id') for m in latest]
+
+        if last_seen in latest_ids:
+            # Newer copies of known messages replace the saved ones, since their read state may have changed
+            messages = [m for m in known if m.get('user:msg-id') not in latest_ids] + latest
+            data['user:user-conversation']['user:user-message'] = messages
+            store.save(conversation_id, data)
+            return data
+        logger.debug('More than %d new messages in conversation %s, fetching it again', tail, conversation_id)
+
+    data = api.get_conversation(user_id, token, conversation_id, tail=FULL_TAIL)
+    store.save(conversation_id, data)
+    return data
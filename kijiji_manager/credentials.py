@@ -0,0 +1,87 @@
+import logging
+import os
+import time
+
+from .kijijiapi import KijijiApiException
+from .locks import FileLock
+from .storage import read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+
+class CredentialStore:
+    """Server-side store of login credentials, used to log in again in the background once a session token gets old
+
+    Credentials are only saved when enabled with `SAVE_CREDENTIALS`, and are removed when the user logs out.
+    The file is only readable by the user running the app, since it holds passwords as is.
+    The file is locked while being modified, since other worker processes may be modifying it at the same time.
+    """
+
+    FILE = 'credentials.json'
+
+    def __init__(self, instance_path):
+        self.file = os.path.join(instance_path, self.FILE)
+        self._lock = FileLock(f'{self.file}.lock')
+
+    def get(self, user_id):
+        """Get credentials of user
+
+        :param user_id: user ID number
+        :return: dict with 'email' and 'password' keys, or None if no credentials are saved for this user
+        """
+        return self._read().get(user_id)
+
+    def save(self, user_id, email, password):
+        with self._lock:
+            credentials = self._read()
+            credentials[user_id] = {'email': email, 'password': password}
+            self._write(credentials)
+
+    def delete(self, user_id):
+        with self._lock:
+            credentials = self._read()
+            if credentials.pop(user_id, None) is not None:
+                self._write(credentials)
+
+    def _read(self):
+        return read_json(self.file, {})
+
+    def _write(self, credentials):
+        write_json(self.file, credentials, private=True)
+
+
+def refresh_tokens(api, registry, store, max_age):
+    """Log in again for each known user whose session token is older than the given age
+
+    Users without saved credentials are skipped, and keep using their current token.
+
+    :param api: KijijiApi instance
+    :param registry: UserRegistry of users to check
+    :param store: CredentialStore instance
+    :param max_age: maximum token age in seconds
+    :return: list of user IDs with a new token
+    """
+    refreshed = []
+    now = time.time()
+    for user in registry.all():
+        if user['token_time'] and now - user['token_time'] < max_age:
+            continue
+
+        credentials = store.get(user['id'])
+        if not credentials:
+            continue
+
+        try:
+            user_id, token = api.login(credentials['email'], credentials['password'])
+        except KijijiApiException as e:
+            logger.warning('Unable to refresh session token for user %s: %s', user['id'], e)
+            continue
+        except Exception:
+            # Other users are still refreshed
+            logger.exception('Unable to refresh session token for user %s', user['id'])
+            continue
+
+        registry.update_token(user_id, token, now)
+        refreshed.append(user_id)
+        logger.info('Refreshed session token for user %s', user_id)
+    return refreshed
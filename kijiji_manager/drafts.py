@@ -0,0 +1,105 @@
+import os
+import re
+import uuid
+from datetime import datetime, timedelta
+
+from .storage import read_json, write_json
+
+
+class DraftStore:
+    """Server-side store for in-progress ad post drafts
+
+    Each draft is saved as a JSON file within the user's instance folder and is keyed by a random draft ID.
+    Drafts are removed once they have not been updated within the expiry time.
+    Only the draft ID needs to be passed between requests, keeping the session cookie small.
+    """
+
+    # Draft IDs are always a 32 character hex string
+    # Anything else is rejected to avoid reading files outside of the drafts folder
+    _id_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, instance_path, user_id, expiry=None):
+        self.path = os.path.join(instance_path, 'user', user_id, 'drafts')
+        self.expiry = expiry if expiry is not None else timedelta(hours=72)
+
+    def create(self, data):
+        """Save new draft
+
+        :param data: JSON serializable draft data dict
+        :return: new draft ID
+        """
+        draft_id = uuid.uuid4().hex
+        now = datetime.utcnow().isoformat(timespec='milliseconds')
+        self._write(draft_id, dict(data, id=draft_id, created=now, updated=now))
+        return draft_id
+
+    def get(self, draft_id):
+        """Get draft data
+
+        :param draft_id: draft ID
+        :return: draft data dict, or None if draft does not exist or has expired
+        """
+        draft_file = self._file(draft_id)
+        if not draft_file:
+            return None
+        draft = read_json(draft_file)
+        if draft is None:
+            return None
+
+        if self._expired(draft):
+            self.delete(draft_id)
+            return None
+        return draft
+
+    def update(self, draft_id, data):
+        """Merge given data into existing draft, refreshing its expiry time
+
+        :param draft_id: draft ID
+        :param data: JSON serializable dict of values to update
+        :return: updated draft data dict, or None if draft does not exist or has expired
+        """
+        draft = self.get(draft_id)
+        if draft is None:
+            return None
+        draft.update(data)
+        draft['updated'] = datetime.utcnow().isoformat(timespec='milliseconds')
+        self._write(draft_id, draft)
+        return draft
+
+    def delete(self, draft_id):
+        """Delete draft if it exists"""
+        draft_file = self._file(draft_id)
+        if draft_file and os.path.isfile(draft_file):
+            os.remove(draft_file)
+
+    def list(self):
+        """Get all unexpired drafts, most recently updated first
+
+        Expired drafts found along the way are deleted.
+        """
+        if not os.path.isdir(self.path):
+            return []
+
+        drafts = []
+        for name in os.listdir(self.path):
+            draft_id, ext = os.path.splitext(name)
+            if ext == '.json':
+                draft = self.get(draft_id)
+                if draft is not None:
+                    drafts.append(draft)
+        return sorted(drafts, key=lambda d: d['updated'], reverse=True)
+
+    def _file(self, draft_id):
+        if not draft_id or not self._id_pattern.match(draft_id):
+            return None
+        return os.path.join(self.path, f'{draft_id}.json')
+
+    def _write(self, draft_id, draft):
+        write_json(self._file(draft_id), draft)
+
+    def _expired(self, draft):
+        try:
+            updated = datetime.fromisoformat(draft['updated'])
+        except (KeyError, TypeError, ValueError):
+            return True
+        return datetime.utcnow() - updated > self.expiry
@@ -0,0 +1,130 @@
+import csv
+import io
+import json
+
+from .records import Ad, Conversation, as_list
+
+# Export formats and their MIME types
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+AD_FIELDS = [
+    'id', 'title', 'category_id', 'category', 'ad_type', 'status', 'price_type', 'price', 'location_id',
+    'views', 'phone_clicks', 'map_views', 'rank', 'page', 'start', 'end', 'url',
+]
+
+CONVERSATION_FIELDS = [
+    'uid', 'ad_id', 'subject', 'owner_id', 'owner_name', 'replier_id', 'replier_name',
+    'read', 'flagged_buyer', 'flagged_seller', 'last_message_time', 'last_message',
+]
+
+
+def iter_ads(api, user_id, token, page_size=50):
+    """Iterate through all ads of every page, fetching one page at a time"""
+    page = 0
+    while True:
+        data = api.get_ad_page(user_id, token, page, page_size)
+        ads = as_list(data['ad:ads'].get('ad:ad') if data['ad:ads'] else None)
+        yield from ads
+        if len(ads) < page_size:
+            break
+        page += 1
+
+
+def iter_conversations(api, user_id, token, max_pages=None):
+    """Iterate through all conversations of every page, fetching one page at a time"""
+    # Kijiji always returns conversations in pages of 25
+    page_size = 25
+    page = 0
+    while max_pages is None or page < max_pages:
+        data = api.get_conversation_page(user_id, token, page)
+        conversations = as_list(data['user:user-conversations'].get('user:user-conversation') if data['user:user-conversations'] else None)
+        yield from conversations
+        if len(conversations) < page_size:
+            break
+        page += 1
+
+
+def flatten_ad(ad):
+    """Flatten ad data dict to a single level dict of AD_FIELDS"""
+    record = Ad.from_dict(ad)
+    return {
+        'id': record.id,
+        'title': record.title,
+        'category_id': record.category_id,
+        'category': record.category,
+        'ad_type': record.ad_type,
+        'status': record.status,
+        'price_type': record.price_type,
+        'price': record.price,
+        'location_id': record.location_id,
+        'views': record.views,
+        'phone_clicks': record.phone_clicks,
+        'map_views': record.map_views,
+        'rank': record.rank,
+        'page': record.page,
+        'start': record.start,
+        'end': record.end,
+        'url': record.url,
+    }
+
+
+def flatten_conversation(conversation):
+    """Flatten conversation data dict to a single level dict of CONVERSATION_FIELDS"""
+    record = Conversation.from_dict(conversation)
+    message = record.last_message
+    return {
+        'uid': record.uid,
+        'ad_id': record.ad_id,
+        'subject': record.subject,
+        'owner_id': record.owner_id,
+        'owner_name': record.owner_name,
+        'replier_id': record.replier_id,
+        'replier_name': record.replier_name,
+        'read': message.read if message else None,
+        'flagged_buyer': record.flagged_buyer,
+        'flagged_seller': record.flagged_seller,
+        'last_message_time': message.time if message else None,
+        'last_message': message.content if message else None,
+    }
+
+
+def to_jsonl(rows):
+    """Generate one JSON line per row"""
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def to_csv(rows, fieldnames):
+    """Generate CSV text one row at a time, starting with the header row"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+
+    def flush():
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    writer.writeheader()
+    yield flush()
+    for row in rows:
+        writer.writerow(row)
+        yield flush()
+
+
+def export(rows, fieldnames, fmt):
+    """Generate exported text of rows in given format
+
+    :param rows: iterable of flattened row dicts
+    :param fieldnames: list of CSV column names
+    :param fmt: export format, one of FORMATS
+    :return: generator of text chunks
+    """
+    if fmt == 'jsonl':
+        return to_jsonl(rows)
+    elif fmt == 'csv':
+        return to_csv(rows, fieldnames)
+    raise ValueError(f'Unsupported export format {fmt}')
@@ -0,0 +1,13 @@
+from flask_wtf import FlaskForm
+from wtforms import SelectField, SelectMultipleField, SubmitField, widgets
+from wtforms.validators import InputRequired
+
+from kijiji_manager.accounts import ACTIONS
+
+
+class AccountBatchForm(FlaskForm):
+    """Multiple account batch action form."""
+    action = SelectField('Action', [InputRequired()], choices=list(ACTIONS.items()))
+    accounts = SelectMultipleField('Accounts', [InputRequired()],
+                                   widget=widgets.ListWidget(prefix_label=False), option_widget=widgets.CheckboxInput())
+    submit = SubmitField('Run')
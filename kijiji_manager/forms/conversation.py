@@ -1,9 +1,25 @@
 from flask_wtf import FlaskForm
-from wtforms import TextAreaField, SubmitField
-from wtforms.validators import InputRequired
+from wtforms import StringField, TextAreaField, SelectField, SelectMultipleField, SubmitField, widgets
+from wtforms.validators import InputRequired, Optional
 
 
 class ConversationForm(FlaskForm):
     """User conversation form."""
     message = TextAreaField('Reply', [InputRequired()])
     submit = SubmitField('Reply')
+
+
+class ReplyBatchForm(FlaskForm):
+    """Reply to many conversations at once form."""
+    conversations = SelectMultipleField('Conversations', [InputRequired()],
+                                        widget=widgets.ListWidget(prefix_label=False), option_widget=widgets.CheckboxInput())
+    response = SelectField('Canned response', [Optional()])
+    message = TextAreaField('Reply')
+    submit = SubmitField('Send')
+
+
+class CannedResponseForm(FlaskForm):
+    """Canned reply message form."""
+    name = StringField('Name', [InputRequired()])
+    message = TextAreaField('Message', [InputRequired()])
+    submit = SubmitField('Save')
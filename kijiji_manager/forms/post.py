@@ -3,7 +3,7 @@ import re
 import phonenumbers
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed, FileRequired
-from wtforms import SelectField, StringField, TextAreaField, DecimalField, SubmitField
+from wtforms import BooleanField, SelectField, StringField, TextAreaField, DecimalField, SubmitField
 from wtforms.validators import InputRequired, Optional, Length, NumberRange, Regexp, ValidationError
 
 
@@ -103,6 +103,8 @@ class PostForm(FlaskForm):
     file9 = FileField('Pictures', [FileAllowed(images, 'Must be an image file')])
     file10 = FileField('Pictures', [FileAllowed(images, 'Must be an image file')])
 
+    template = BooleanField('Save as template instead of posting')
+
     submit = SubmitField('Post Ad')
 
 
@@ -111,3 +113,27 @@ class PostManualForm(FlaskForm):
 
     file = FileField('Ad payload file', [FileRequired(), FileAllowed(['xml'], 'Must be an XML file')])
     submit = SubmitField('Post Ad')
+
+
+class PostBulkForm(FlaskForm):
+    """Ad bulk post form."""
+
+    archives = ['zip', 'tar', 'gz', 'tgz', 'bz2', 'xz']
+    file = FileField('Ad payload archive', [FileAllowed(archives, 'Must be a zip or tar archive')])
+    directory = StringField('Server directory')
+    submit = SubmitField('Post Ads')
+
+
+class AdTemplateForm(FlaskForm):
+    """Ad template form."""
+
+    name = StringField('Template name', [InputRequired(), Length(max=100)])
+    payload = TextAreaField('Ad payload', [InputRequired()])
+    submit = SubmitField('Save Template')
+
+
+class AdTemplateGenerateForm(FlaskForm):
+    """Ad template bulk generation form."""
+
+    file = FileField('Values CSV file', [FileRequired(), FileAllowed(['csv'], 'Must be a CSV file')])
+    submit = SubmitField('Post Ads')
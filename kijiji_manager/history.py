@@ -0,0 +1,194 @@
+import logging
+import os
+import re
+import struct
+import time
+
+from .export import iter_ads
+from .kijijiapi import KijijiApiException
+from .locks import FileLock
+from .storage import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryStore:
+    """Append-only time-series store of ad performance counters
+
+    Each ad has its own binary file within the user's instance folder holding fixed size records of
+    timestamp, view count, phone click count, map view count and rank.
+    Appending a sample never rewrites existing data; old samples are only removed when pruned.
+    Appending and pruning hold a lock on the user's history, since they may run at the same time in other
+    worker processes, and a sample appended while a file is being pruned would otherwise be lost.
+    """
+
+    # Record layout: epoch seconds, views, phone clicks, map views, rank
+    _record = struct.Struct('<IIIII')
+
+    # Stored in place of a missing counter value
+    _missing = 0xFFFFFFFF
+
+    FIELDS = ['time', 'views', 'phone_clicks', 'map_views', 'rank']
+
+    # Ad IDs are always numeric
+    _id_pattern = re.compile(r'^\d+$')
+
+    def __init__(self, instance_path, user_id):
+        self.path = os.path.join(instance_path, 'user', user_id, 'history')
+        self._lock = FileLock(os.path.join(self.path, 'history.lock'))
+
+    def file(self, ad_id):
+        if not self._id_pattern.match(str(ad_id)):
+            raise ValueError(f'Invalid ad ID {ad_id}')
+        return os.path.join(self.path, f'{ad_id}.bin')
+
+    def append(self, ad_id, timestamp, views, phone_clicks, map_views, rank):
+        """Append one sample for an ad. Missing counter values may be given as None."""
+        with self._lock:
+            self._append(ad_id, timestamp, views, phone_clicks, map_views, rank)
+
+    def _append(self, ad_id, timestamp, views, phone_clicks, map_views, rank):
+        values = [self._missing if v is None else int(v) for v in (views, phone_clicks, map_views, rank)]
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.file(ad_id), 'ab') as f:
+            f.write(self._record.pack(int(timestamp), *values))
+
+    def record_ads(self, ads, timestamp=None, min_interval=0):
+        """Append one sample for each ad from ad data dicts as returned by KijijiApi
+
+        :param ads: iterable of ad data dicts
+        :param timestamp: epoch seconds of sample, defaults to now
+        :param min_interval: skip ads which already have a sample less than this many seconds old
+        :return: number of samples appended
+        """
+        timestamp = int(timestamp if timestamp is not None else time.time())
+        ads = [ad for ad in ads if ad.get('@id')]
+        count = 0
+        # Locked for every ad at once, so that the same sample is not also appended by another request
+        with self._lock:
+            for ad in ads:
+                ad_id = ad['@id']
+                if min_interval:
+                    last = self.last(ad_id)
+                    if last and timestamp - last['time'] < min_interval:
+                        continue
+                self._append(ad_id, timestamp, _int(ad.get('ad:view-ad-count')), _int(ad.get('ad:phone-click-count')),
+                             _int(ad.get('ad:map-view-count')), _int(ad.get('ad:rank')))
+                count += 1
+        return count
+
+    def last(self, ad_id):
+        """Get most recent sample for an ad, or None if there are none"""
+        try:
+            with open(self.file(ad_id), 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell() - f.tell() % self._record.size
+                if size == 0:
+                    return None
+                f.seek(size - self._record.size)
+                return self._unpack(f.read(self._record.size))
+        except FileNotFoundError:
+            return None
+
+    def read(self, ad_id, since=None):
+        """Get all samples for an ad, oldest first
+
+        :param ad_id: ad ID number
+        :param since: only include samples at or after this epoch time
+        :return: list of sample dicts with FIELDS keys
+        """
+        try:
+            with open(self.file(ad_id), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+
+        # Ignore a trailing partial record, e.g. from an interrupted write
+        data = data[:len(data) - len(data) % self._record.size]
+        samples = [self._unpack(record) for record in self._record.iter_unpack(data)]
+        if since is not None:
+            samples = [s for s in samples if s['time'] >= since]
+        return samples
+
+    def ads(self):
+        """Get IDs of all ads with samples"""
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name[:-4] for name in os.listdir(self.path) if name.endswith('.bin'))
+
+    def prune(self, retention_days):
+        """Remove samples older than the retention period
+
+        Files of ads which have no samples left are deleted.
+        """
+        cutoff = time.time() - retention_days * 24 * 60 * 60
+        for ad_id in self.ads():
+            # Locked for each ad on its own, so that samples are not held back for long
+            with self._lock:
+                self._prune(ad_id, cutoff)
+
+    def _prune(self, ad_id, cutoff):
+        samples = self.read(ad_id)
+        if samples and samples[0]['time'] >= cutoff:
+            # Nothing to prune; samples are in time order
+            return
+
+        file = self.file(ad_id)
+        kept = [s for s in samples if s['time'] >= cutoff]
+        if not kept:
+            os.remove(file)
+            return
+
+        with atomic_write(file, binary=True) as f:
+            for s in kept:
+                f.write(self._record.pack(s['time'], *[self._missing if s[k] is None else s[k] for k in self.FIELDS[1:]]))
+
+    def _unpack(self, record):
+        values = record if isinstance(record, tuple) else self._record.unpack(record)
+        return {k: None if v == self._missing and k != 'time' else v for k, v in zip(self.FIELDS, values)}
+
+
+def downsample(samples, resolution):
+    """Reduce samples to at most one per time bucket
+
+    Counters only ever increase and rank is a point-in-time value, so the last sample within each bucket is kept.
+
+    :param samples: list of sample dicts, oldest first
+    :param resolution: bucket size in seconds
+    :return: list of sample dicts, oldest first
+    """
+    if not resolution or resolution <= 1:
+        return samples
+
+    buckets = {}
+    for sample in samples:
+        buckets[sample['time'] // resolution] = sample
+    return [buckets[key] for key in sorted(buckets)]
+
+
+def sample_history(api, instance_path, users, retention_days=None):
+    """Record a sample of every ad for each given user
+
+    :param api: KijijiApi instance
+    :param instance_path: Flask instance folder path
+    :param users: list of user dicts with 'id' and 'token' keys
+    :param retention_days: prune samples older than this many days if given
+    """
+    for user in users:
+        store = HistoryStore(instance_path, user['id'])
+        try:
+            count = store.record_ads(iter_ads(api, user['id'], user['token']))
+        except KijijiApiException as e:
+            logger.warning('Unable to sample ad history for user %s: %s', user['id'], e)
+            continue
+        logger.info('Sampled history of %d ads for user %s', count, user['id'])
+
+        if retention_days:
+            store.prune(retention_days)
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,165 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.datastructures import FileStorage
+
+from .locks import FileLock
+from .storage import read_json, write_json
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Largest size in px that Kijiji serves an image at, see create_picture_payload()
+MAX_IMAGE_SIZE = 800
+
+# Uploaded images are only reused while they stay hosted for at least this long, so they outlive a new ad
+IMAGE_REUSE_MIN_SECONDS = 60 * 24 * 60 * 60
+
+
+def shrink_image(data, max_size=MAX_IMAGE_SIZE, quality=85):
+    """Downscale image to fit within max_size px and recompress it as JPEG, leaving out EXIF data
+
+    Runs in a worker process, so it only takes and returns bytes.
+
+    :param data: image file bytes
+    :param max_size: maximum width and height in px
+    :param quality: JPEG quality, 1 to 95
+    :return: JPEG image bytes
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        # Rotate according to EXIF orientation first, since the EXIF data itself is not kept
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+        return out.getvalue()
+
+
+class ImageProcessor:
+    """Shrink uploaded images before sending them to Kijiji
+
+    Images are processed in a pool of worker processes, so that decoding and encoding large photos
+    does not hold up request threads. Requires Pillow; images are uploaded as is if it is not installed,
+    if disabled with `IMAGE_PREPROCESS = False`, or if an image cannot be processed.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.max_size = MAX_IMAGE_SIZE
+        self.quality = 85
+        self.workers = None
+        self._pool = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('IMAGE_PREPROCESS', True)
+        self.max_size = app.config.get('IMAGE_MAX_SIZE', MAX_IMAGE_SIZE)
+        self.quality = app.config.get('IMAGE_QUALITY', 85)
+        self.workers = app.config.get('IMAGE_WORKERS')
+        if self.enabled and Image is None:
+            logger.info('Pillow is not installed, images will be uploaded without preprocessing')
+            self.enabled = False
+        app.extensions['image_processor'] = self
+
+    def process(self, files):
+        """Shrink many images at the same time
+
+        :param files: list of werkzeug.FileStorage image objects
+        :return: list of werkzeug.FileStorage image objects in the same order, either shrunk or the original
+        """
+        if not self.enabled or not files:
+            return files
+
+        data = [f.read() for f in files]
+        futures = [self._get_pool().submit(shrink_image, d, self.max_size, self.quality) for d in data]
+
+        processed = []
+        for f, original, future in zip(files, data, futures):
+            try:
+                shrunk = future.result()
+            except Exception as e:
+                logger.warning('Unable to preprocess image %s, uploading as is: %s', f.filename, e)
+                shrunk = None
+
+            # Already small and well compressed images may not get any smaller
+            if shrunk is None or len(shrunk) >= len(original):
+                processed.append(FileStorage(io.BytesIO(original), f.filename, content_type=f.content_type))
+            else:
+                filename = f'{os.path.splitext(f.filename or "image")[0]}.jpg'
+                processed.append(FileStorage(io.BytesIO(shrunk), filename, content_type='image/jpeg'))
+        return processed
+
+    def _get_pool(self):
+        # Worker processes are only started once the first image is uploaded
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+
+image_processor = ImageProcessor()
+
+
+class UploadedImageStore:
+    """Store of images already uploaded to Kijiji, by content hash of the original image file
+
+    Uploading the same image again, e.g. when posting similar ads, reuses the hosted image
+    as long as it does not expire soon. Saved as one JSON file within the user's instance folder.
+    The file is locked while being modified, since other worker processes may be modifying it at the same time.
+    """
+
+    FILE = 'images.json'
+
+    def __init__(self, instance_path, user_id):
+        self.file = os.path.join(instance_path, 'user', user_id, self.FILE)
+        self._lock = FileLock(f'{self.file}.lock')
+
+    @staticmethod
+    def digest(data):
+        """Content hash of image file bytes"""
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, digest, min_seconds=IMAGE_REUSE_MIN_SECONDS):
+        """Get URL of uploaded image
+
+        :param digest: content hash of image file
+        :param min_seconds: only return images which stay hosted for at least this many seconds from now
+        :return: image URL, or None if no image with this hash is uploaded or it expires too soon
+        """
+        image = self._read().get(digest)
+        if image and image['expires'] - time.time() >= min_seconds:
+            return image['url']
+        return None
+
+    def save(self, digest, url, expires):
+        """Save uploaded image, discarding images which have expired
+
+        :param digest: content hash of image file
+        :param url: image URL
+        :param expires: epoch seconds the image stops being hosted at
+        """
+        now = time.time()
+        with self._lock:
+            images = {k: v for k, v in self._read().items() if v['expires'] > now}
+            images[digest] = {'url': url, 'expires': int(expires)}
+            self._write(images)
+
+    def _read(self):
+        return read_json(self.file, {})
+
+    def _write(self, images):
+        write_json(self.file, images)
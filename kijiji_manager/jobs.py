@@ -0,0 +1,47 @@
+import os
+import re
+
+from .storage import read_json, write_json
+
+
+class StatusJob:
+    """Base of background jobs whose progress is saved to a JSON status file within a user's instance folder
+
+    Subclasses set FOLDER to the folder of their status files within the user folder, and keep their
+    job ID in `id` and status dict in `status`. The status file is written by _write(), so that the job
+    can be reported on from any request or worker process while it is still running.
+    """
+
+    # Folder of status files within the user's instance folder
+    FOLDER = None
+
+    # Job IDs are always a 32 character hex string
+    # Anything else is rejected to avoid reading files outside of the jobs folder
+    _id_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+    @classmethod
+    def file(cls, instance_path, user_id, job_id, ext='json'):
+        """Get job status file path, or other job file path by extension, or None if job ID is not valid"""
+        if not job_id or not cls._id_pattern.match(job_id):
+            return None
+        return os.path.join(instance_path, 'user', user_id, cls.FOLDER, f'{job_id}.{ext}')
+
+    @classmethod
+    def status_file(cls, instance_path, user_id, job_id):
+        """Get status file path for given job ID, or None if job ID is not valid"""
+        return cls.file(instance_path, user_id, job_id)
+
+    @classmethod
+    def load_status(cls, instance_path, user_id, job_id):
+        """Get job status dict, or None if the job does not exist"""
+        status_file = cls.status_file(instance_path, user_id, job_id)
+        if not status_file:
+            return None
+        return read_json(status_file)
+
+    def _owner(self):
+        """ID of user whose instance folder holds the job status"""
+        return self.user_id
+
+    def _write(self):
+        write_json(self.status_file(self.instance_path, self._owner(), self.id), self.status)
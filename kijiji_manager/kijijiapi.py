@@ -1,6 +1,8 @@
 import os
 import tempfile
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from urllib.parse import urlparse, urlunparse
 from xml.parsers.expat import ExpatError, errors
@@ -37,6 +39,15 @@ class KijijiApiXmlException(KijijiApiException):
         super().__init__(messages, *args)
 
 
+def error_message(e):
+    """Flatten exception message(s), such as those of KijijiApiException, into a single string"""
+    message = e.args[0] if e.args else str(e)
+    if isinstance(message, list):
+        return '; '.join(str(m) for m in message)
+    # Some exceptions, e.g. timeouts, may not have any message
+    return str(message) or type(e).__name__
+
+
 class KijijiApi:
     """API for interfacing with Kijiji site
 
@@ -45,6 +56,15 @@ class KijijiApi:
 
     Methods raise KijijiApiException on errors
     """
+
+    # HTTP client shared by every instance not given its own session, so that they share one connection pool
+    _shared_session = None
+
+    # Postal code data, loaded from disk once and then shared by every instance
+    _nominatim = None
+
+    _lock = threading.Lock()
+
     def __init__(self, session=None):
 
         # Base API URL
@@ -53,6 +73,10 @@ class KijijiApi:
         # Kijiji app version number
         self.app_ver = '17.7.0'
 
+        # Time uploaded images are hosted for
+        # Kijiji sets this to 199 days, 23 hours from now
+        self.image_lifetime = timedelta(days=199, hours=23)
+
         # Common HTTP header fields
         self.headers = {
             'Accept': 'application/xml',
@@ -70,10 +94,27 @@ class KijijiApi:
             # Append common headers
             self.session.headers = self.headers
         else:
-            # Kijiji sometimes takes a bit longer to respond to API requests
-            # e.g. for loading conversations
-            timeout = httpx.Timeout(30.0, connect=30.0)
-            self.session = httpx.Client(timeout=timeout, headers=self.headers)
+            with self._lock:
+                if KijijiApi._shared_session is None:
+                    # Kijiji sometimes takes a bit longer to respond to API requests
+                    # e.g. for loading conversations
+                    timeout = httpx.Timeout(30.0, connect=30.0)
+                    KijijiApi._shared_session = httpx.Client(timeout=timeout, headers=self.headers)
+            self.session = KijijiApi._shared_session
+
+    def connect(self, count=1):
+        """Open connections to Kijiji ahead of the first request, keeping them in the connection pool
+
+        :param count: number of connections to open at the same time
+        """
+        # Any response will do, only the connection is of use
+        with ThreadPoolExecutor(max_workers=max(1, count)) as pool:
+            futures = [pool.submit(self.session.head, self.base_url) for _ in range(max(1, count))]
+        try:
+            for future in futures:
+                future.result()
+        except httpx.HTTPError as e:
+            raise KijijiApiException(f'Unable to connect to Kijiji: {e}')
 
     def login(self, username, password):
         """Login to Kijiji
@@ -114,15 +155,36 @@ class KijijiApi:
         :param ad_id: ad ID number
         :return: response data dict
         """
+        if not ad_id:
+            # Query all ads
+            return self.get_ad_page(user_id, token, 0)
+
         headers = self._headers_with_auth(user_id, token)
-        url = f'{self.base_url}/users/{user_id}/ads'
-        if ad_id:
-            url += f'/{ad_id}'
+        url = f'{self.base_url}/users/{user_id}/ads/{ad_id}'
+
+        r = self.session.get(url, headers=headers)
+
+        doc = self._parse_response(r.text)
+
+        if r.status_code == 200:
+            return doc
         else:
-            # Query all ads
-            url += '?size=50' \
-                   '&page=0' \
-                   '&_in=id,title,price,ad-type,locations,ad-status,category,pictures,start-date-time,features-active,view-ad-count,user-id,phone,email,rank,ad-address,phone-click-count,map-view-count,ad-source-id,ad-channel-id,contact-methods,attributes,link,description,feature-group-active,end-date-time,extended-info,highest-price'
+            raise KijijiApiException(self._error_reason(doc))
+
+    def get_ad_page(self, user_id, token, page, size=50):
+        """Get existing ads by page number
+
+        :param user_id: user ID number
+        :param token: session token
+        :param page: ad page number, starting at 0
+        :param size: number of ads per page
+        :return: response data dict
+        """
+        headers = self._headers_with_auth(user_id, token)
+        url = f'{self.base_url}/users/{user_id}/ads' \
+              f'?size={size}' \
+              f'&page={page}' \
+              '&_in=id,title,price,ad-type,locations,ad-status,category,pictures,start-date-time,features-active,view-ad-count,user-id,phone,email,rank,ad-address,phone-click-count,map-view-count,ad-source-id,ad-channel-id,contact-methods,attributes,link,description,feature-group-active,end-date-time,extended-info,highest-price'
 
         r = self.session.get(url, headers=headers)
 
@@ -271,8 +333,7 @@ class KijijiApi:
         })
 
         # Image expiration epoch timestamp
-        # Kijiji sets this to 199 days, 23 hours from now
-        expiration_timestamp = int((datetime.today() + timedelta(days=199, hours=23)).timestamp())
+        expiration_timestamp = int((datetime.today() + self.image_lifetime).timestamp())
 
         # Multipart form data
         files = {
@@ -300,18 +361,19 @@ class KijijiApi:
         else:
             raise KijijiApiException(self._error_reason_mobile(doc))
 
-    def get_conversation(self, user_id, token, conversation_id=None):
+    def get_conversation(self, user_id, token, conversation_id=None, tail=100):
         """Get all conversations or single conversation by conversation ID number if given
 
         :param user_id: user ID number
         :param token: session token
         :param conversation_id: conversation ID number
+        :param tail: number of most recent messages to get of a single conversation
         :return: response data dict
         """
         headers = self._headers_with_auth(user_id, token)
         url = f'{self.base_url}/users/{user_id}/conversations'
         if conversation_id:
-            url += f'/{conversation_id}?tail=100'
+            url += f'/{conversation_id}?tail={tail}'
         else:
             # Query all ads
             url += '?size=25'
@@ -400,18 +462,25 @@ class KijijiApi:
         else:
             raise KijijiApiException(self._error_reason(doc))
 
-    @staticmethod
-    def geo_location(postal_code):
+    @classmethod
+    def geo_location(cls, postal_code):
         # pgeocode.Nominatim.query_postal_code only uses the first three characters to do the lookup for Canadian postal codes
         postalcode = postal_code[:3]
         try:
-            nomi = pgeocode.Nominatim('ca')
-            location = nomi.query_postal_code(postalcode)
+            location = cls.nominatim().query_postal_code(postalcode)
         except Exception as e:
             raise KijijiApiException(f'Error acquiring geo location data: {e}')
         else:
             return location
 
+    @classmethod
+    def nominatim(cls):
+        """Get Canadian postal code data, which is downloaded on first use and then only loaded from disk once"""
+        with cls._lock:
+            if KijijiApi._nominatim is None:
+                KijijiApi._nominatim = pgeocode.Nominatim('ca')
+            return KijijiApi._nominatim
+
     @staticmethod
     def _headers_with_auth(user_id, token):
         return {'X-ECG-Authorization-User': f'id="{user_id}", token="{token}"'}
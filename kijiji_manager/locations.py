@@ -0,0 +1,159 @@
+import logging
+import math
+import threading
+
+import xmltodict
+
+from .kijijiapi import KijijiApi, KijijiApiException
+from .metadata import metadata_cache
+from .records import as_list
+
+logger = logging.getLogger(__name__)
+
+
+class LocationIndex:
+    """Nearest location lookup over the Kijiji location tree, as returned by KijijiApi.get_locations()
+
+    Only the most specific locations, the ones without sublocations, are indexed. Each location is placed on the
+    unit sphere, where straight line distance orders locations the same as distance over the Earth's surface,
+    and is kept in a k-d tree so that a lookup only visits a few locations.
+    """
+
+    def __init__(self, data):
+        # Dicts of location ID, name, latitude, longitude, and path of location IDs from the top level down
+        self.locations = []
+        root = data['loc:locations']['loc:location']
+        for location in as_list(root.get('loc:location')):
+            self._add(location, [])
+
+        self._tree = _build([(_point(loc['latitude'], loc['longitude']), i) for i, loc in enumerate(self.locations)], 0)
+
+    def nearest(self, latitude, longitude):
+        """Get location closest to a point
+
+        :return: location dict with 'id', 'name', 'latitude', 'longitude' and 'path' keys, or None if nothing is indexed
+        """
+        best = [None, math.inf]
+        _search(self._tree, _point(latitude, longitude), best)
+        return dict(self.locations[best[0]]) if best[0] is not None else None
+
+    def _add(self, location, path):
+        path = path + [location['@id']]
+        children = as_list(location.get('loc:location'))
+        if children:
+            for child in children:
+                self._add(child, path)
+            return
+
+        try:
+            latitude, longitude = float(location['loc:latitude']), float(location['loc:longitude'])
+        except (KeyError, TypeError, ValueError):
+            return
+        self.locations.append({'id': location['@id'], 'name': location.get('loc:localized-name'),
+                               'latitude': latitude, 'longitude': longitude, 'path': path})
+
+
+# Index of the last location data seen, which only changes when location metadata is fetched again
+_index = (None, None)
+_index_lock = threading.Lock()
+
+
+def location_index(data):
+    """Get LocationIndex of location data, only built again if the data has changed"""
+    global _index
+    with _index_lock:
+        if _index[0] is not data:
+            _index = (data, LocationIndex(data))
+        return _index[1]
+
+
+def nearest_location(api, user_id, token, postal_code):
+    """Get the most specific Kijiji location closest to a postal code
+
+    :param api: KijijiApi instance
+    :param user_id: user ID number, only used if location metadata has to be fetched
+    :param token: session token, only used if location metadata has to be fetched
+    :param postal_code: Canadian postal code
+    :return: location dict as returned by LocationIndex.nearest(), along with the 'postal_latitude' and
+             'postal_longitude' of the postal code itself, or None if the postal code is unknown
+    """
+    geo = KijijiApi.geo_location(postal_code)
+    latitude, longitude = float(geo.latitude), float(geo.longitude)
+    if math.isnan(latitude) or math.isnan(longitude):
+        return None
+    location = location_index(metadata_cache.locations(api, user_id, token)).nearest(latitude, longitude)
+    if location is not None:
+        location.update(postal_latitude=latitude, postal_longitude=longitude)
+    return location
+
+
+def resolve_location(api, user_id, token, xml_payload):
+    """Fill in the location of an ad payload that only has a postal code, using the closest location
+
+    Payloads that already have a location, or have no postal code, are returned as is, as are payloads whose
+    location cannot be found because of a Kijiji API error. Other errors, e.g. timeouts, are raised.
+    Latitude and longitude of the ad address are filled in from the postal code if missing as well.
+
+    :return: XML payload string
+    """
+    try:
+        payload = xmltodict.parse(xml_payload)
+        ad = payload['ad:ad']
+        address = ad.get('ad:ad-address') or {}
+        postal_code = address.get('types:zip-code')
+        location = (ad.get('loc:locations') or {}).get('loc:location') or {}
+    except Exception:
+        # Malformed payloads are reported by validation
+        return xml_payload
+
+    if not postal_code or not isinstance(location, dict) or location.get('@id'):
+        return xml_payload
+
+    try:
+        nearest = nearest_location(api, user_id, token, postal_code)
+    except KijijiApiException as e:
+        logger.warning('Unable to find location of postal code %s: %s', postal_code, e)
+        return xml_payload
+    if nearest is None:
+        return xml_payload
+
+    ad['loc:locations'] = {'loc:location': {'@id': nearest['id']}}
+    if not address.get('types:latitude') or not address.get('types:longitude'):
+        address.update({'types:latitude': nearest['postal_latitude'], 'types:longitude': nearest['postal_longitude']})
+        ad['ad:ad-address'] = address
+    return xmltodict.unparse(payload, short_empty_elements=True)
+
+
+def _point(latitude, longitude):
+    """Position on the unit sphere"""
+    lat, lon = math.radians(latitude), math.radians(longitude)
+    return math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)
+
+
+def _build(points, axis):
+    """Build k-d tree node of (point, index, axis, left, right) out of (point, index) pairs"""
+    if not points:
+        return None
+    points.sort(key=lambda p: p[0][axis])
+    median = len(points) // 2
+    next_axis = (axis + 1) % 3
+    return (points[median][0], points[median][1], axis,
+            _build(points[:median], next_axis), _build(points[median + 1:], next_axis))
+
+
+def _search(node, point, best):
+    """Find index of the point closest to given point, keeping [index, squared distance] of the best one so far"""
+    if node is None:
+        return
+    node_point, index, axis, left, right = node
+
+    distance = sum((a - b) ** 2 for a, b in zip(node_point, point))
+    if distance < best[1]:
+        best[0], best[1] = index, distance
+
+    diff = point[axis] - node_point[axis]
+    near, far = (left, right) if diff < 0 else (right, left)
+    _search(near, point, best)
+    # Other side can only hold a closer point if the splitting plane is closer than the best one so far
+    if diff ** 2 < best[1]:
+        _search(far, point, best)
@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+
+class FileLock:
+    """Exclusive lock on a file, shared between every process using the same instance folder
+
+    The lock is held until released, or until the process holding it exits, so a lock is never left behind
+    by a worker process that was killed. A lock also excludes other FileLock objects on the same file
+    within the same process.
+    Where file locks are not available, the lock only excludes other FileLock objects within the same process.
+    """
+
+    # Paths locked by this process, only used where file locks are not available
+    _local = set()
+    _local_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    @property
+    def locked(self):
+        """Whether this object holds the lock"""
+        # A forked child process does not share the lock held by its parent
+        return self._fd is not None and self._pid == os.getpid()
+
+    def acquire(self, blocking=False):
+        """Acquire lock
+
+        :param blocking: wait until the lock is released by its holder, rather than giving up right away
+        :return: True if the lock is now held by this object
+        """
+        if self.locked:
+            return True
+        self._fd = None
+
+        if fcntl is None:
+            while True:
+                with self._local_lock:
+                    if self.path not in self._local:
+                        self._local.add(self.path)
+                        break
+                if not blocking:
+                    return False
+                time.sleep(0.05)
+            self._fd, self._pid = -1, os.getpid()
+            return True
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd, self._pid = fd, os.getpid()
+        return True
+
+    def release(self):
+        if not self.locked:
+            self._fd = None
+            return
+
+        if fcntl is None:
+            with self._local_lock:
+                self._local.discard(self.path)
+        else:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire(blocking=True)
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,138 @@
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+
+from .locks import FileLock
+from .storage import atomic_write, file_identity
+
+logger = logging.getLogger(__name__)
+
+# Version of the snapshot file format, snapshots of any other version are fetched again
+SNAPSHOT_VERSION = 1
+
+
+class MetadataCache:
+    """Cache of Kijiji category, location and category attribute metadata
+
+    Metadata rarely changes and is the same for every user, so it is shared between users
+    and only fetched again once it is older than `METADATA_CACHE_HOURS` hours.
+
+    Once init_app() is called, fetched metadata is also saved as a snapshot within the `metadata` folder of the
+    instance folder, one pickle file per category list, location list or category attributes, so that it is shared
+    by every worker process and survives restarts. A process loads a snapshot again whenever another process replaces it.
+    Only one process fetches an expired snapshot again, while the others keep using the expired one until it is replaced.
+    """
+
+    # Snapshot file names are made of the cache key, e.g. 'attributes-10'
+    _name_pattern = re.compile(r'^[\w-]+$')
+
+    def __init__(self, app=None):
+        self.ttl = 24 * 60 * 60
+        self.path = None
+
+        # Tuples of time fetched, snapshot file identity and data, by cache key
+        self._data = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('METADATA_CACHE_HOURS', 24) * 60 * 60
+        self.path = os.path.join(app.instance_path, 'metadata')
+        app.extensions['metadata_cache'] = self
+
+    def categories(self, api, user_id, token):
+        """Get all categories metadata, as returned by KijijiApi.get_categories()"""
+        return self._get('categories', lambda: api.get_categories(user_id, token))
+
+    def locations(self, api, user_id, token):
+        """Get all locations metadata, as returned by KijijiApi.get_locations()"""
+        return self._get('locations', lambda: api.get_locations(user_id, token))
+
+    def attributes(self, api, user_id, token, category_id):
+        """Get attribute metadata of a category, as returned by KijijiApi.get_attributes()
+
+        :param api: KijijiApi instance
+        :param user_id: user ID number, only used if metadata has to be fetched
+        :param token: session token, only used if metadata has to be fetched
+        :param category_id: category ID number
+        :return: response data dict
+        """
+        return self._get(f'attributes-{category_id}', lambda: api.get_attributes(user_id, token, category_id))
+
+    def clear(self):
+        """Discard metadata held in memory, snapshots are kept"""
+        with self._lock:
+            self._data.clear()
+
+    def _get(self, key, fetch):
+        snapshot_file = self._file(key)
+        cached = self._reload(key, snapshot_file)
+        if cached and time.time() - cached[0] < self.ttl:
+            return cached[2]
+
+        if snapshot_file is None:
+            data = fetch()
+            with self._lock:
+                self._data[key] = (time.time(), None, data)
+            return data
+
+        lock = FileLock(f'{snapshot_file}.lock')
+        if not lock.acquire():
+            if cached:
+                # Another process or thread is fetching it again
+                return cached[2]
+            lock.acquire(blocking=True)
+
+        try:
+            # May have just been fetched while waiting
+            cached = self._reload(key, snapshot_file)
+            if cached and time.time() - cached[0] < self.ttl:
+                return cached[2]
+
+            fetched = time.time()
+            data = fetch()
+            self._save(snapshot_file, fetched, data)
+            with self._lock:
+                self._data[key] = (fetched, file_identity(snapshot_file), data)
+            return data
+        finally:
+            lock.release()
+
+    def _reload(self, key, snapshot_file):
+        """Get cached tuple of key, loading the snapshot again if it was replaced since last loaded"""
+        with self._lock:
+            cached = self._data.get(key)
+
+        identity = file_identity(snapshot_file) if snapshot_file else None
+        if identity is None or (cached and cached[1] == identity):
+            return cached
+
+        try:
+            with open(snapshot_file, 'rb') as f:
+                snapshot = pickle.load(f)
+            if snapshot.get('version') != SNAPSHOT_VERSION:
+                return cached
+        except Exception as e:
+            logger.warning('Unable to load metadata snapshot %s: %s', snapshot_file, e)
+            return cached
+
+        cached = (snapshot['fetched'], identity, snapshot['data'])
+        with self._lock:
+            self._data[key] = cached
+        return cached
+
+    def _save(self, snapshot_file, fetched, data):
+        with atomic_write(snapshot_file, binary=True) as f:
+            pickle.dump({'version': SNAPSHOT_VERSION, 'fetched': fetched, 'data': data}, f, pickle.HIGHEST_PROTOCOL)
+
+    def _file(self, key):
+        if self.path is None or not self._name_pattern.match(key):
+            return None
+        return os.path.join(self.path, f'{key}.pickle')
+
+
+metadata_cache = MetadataCache()
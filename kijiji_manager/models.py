@@ -1,6 +1,105 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+
 from flask import session
 from flask_login import UserMixin
 
+from .locks import FileLock
+from .storage import file_identity, read_json, write_json
+
+
+class UserRegistry:
+    """Registry of users with a known session token
+
+    Flask session data is only available while handling a request of that user,
+    so background tasks use this registry to find the users to act on behalf of.
+    Users are added when they log in or their session has a newer token, and removed when they log out.
+    Each token is kept along with the time it was issued, and a newer token is never replaced by an older one.
+
+    Once init_app() is called, the registry is saved to `sessions.json` within the instance folder rather than kept
+    in memory, so that it is shared by every worker process and the one running scheduled tasks knows about users
+    whose requests were handled by the others. The file is only readable by the user running the app.
+    It is only parsed again once replaced, so looking up users costs a single stat() while nothing changes.
+    """
+
+    FILE = 'sessions.json'
+
+    def __init__(self):
+        self.file = None
+        self._file_lock = None
+        self._users = {}
+        # Identity of the registry file last read, and the users read from it
+        self._cached = (None, {})
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.file = os.path.join(app.instance_path, self.FILE)
+        self._file_lock = FileLock(f'{self.file}.lock')
+        app.extensions['user_registry'] = self
+
+    def add(self, user_id, token, email=None, name=None, token_time=None):
+        with self._modify() as users:
+            user = users.get(user_id)
+            if user and user['token_time'] and (token_time is None or user['token_time'] > token_time):
+                # Keep token refreshed in the background over the older one still in the session
+                token, token_time = user['token'], user['token_time']
+            users[user_id] = {'id': user_id, 'token': token, 'email': email, 'name': name, 'token_time': token_time}
+
+    def update_token(self, user_id, token, token_time):
+        """Replace token of a known user"""
+        with self._modify() as users:
+            if user_id in users:
+                users[user_id].update(token=token, token_time=token_time)
+
+    def remove(self, user_id):
+        with self._modify() as users:
+            users.pop(user_id, None)
+
+    def get(self, user_id):
+        with self._lock:
+            user = self._read().get(user_id)
+            return dict(user) if user else None
+
+    def all(self):
+        with self._lock:
+            return [dict(user) for user in self._read().values()]
+
+    @contextmanager
+    def _modify(self):
+        """Read users to modify them, and save them once modified"""
+        with self._lock:
+            if self.file is None:
+                yield self._users
+                return
+
+            # Other processes may be saving at the same time
+            with self._file_lock:
+                before = json.dumps(self._read(), sort_keys=True)
+                # Modify a copy, since the users read are kept for later reads
+                users = json.loads(before)
+                yield users
+                # Only save when something changed
+                if json.dumps(users, sort_keys=True) != before:
+                    self._write(users)
+
+    def _read(self):
+        if self.file is None:
+            return self._users
+        identity = file_identity(self.file)
+        if identity is None:
+            return {}
+        if self._cached[0] != identity:
+            self._cached = (identity, read_json(self.file, {}))
+        return self._cached[1]
+
+    def _write(self, users):
+        write_json(self.file, users, private=True)
+
+
+registry = UserRegistry()
+
 
 class User(UserMixin):
     """User model
@@ -8,17 +107,21 @@ class User(UserMixin):
     Saves user data in Flask session
     """
 
-    def __init__(self, user_id, token, email=None, name=None):
+    def __init__(self, user_id, token, email=None, name=None, token_time=None):
         self.id = user_id
         self.token = token
         self.email = email
         self.name = name
 
+        # Epoch time the token was issued at
+        self.token_time = token_time
+
         user_entry = {
             'id': self.id,
             'token': self.token,
             'email': self.email,
             'name': self.name,
+            'token_time': self.token_time,
         }
 
         # Create session user db if not already exists
@@ -30,6 +133,17 @@ class User(UserMixin):
         if self.id not in session['user_db']:
             session['user_db'].update({self.id: user_entry})
 
+        # Make user known to background tasks, only once logged in or when the session has a newer token
+        # Users are loaded on every request, so this mostly only looks the user up
+        known = registry.get(self.id)
+        if known is None or (known['token'] != self.token and (self.token_time or 0) > (known['token_time'] or 0)):
+            registry.add(self.id, self.token, self.email, self.name, self.token_time)
+        elif known['token'] != self.token:
+            # Use token refreshed in the background from now on
+            self.token, self.token_time = known['token'], known['token_time']
+            session['user_db'][self.id].update(token=self.token, token_time=self.token_time)
+            session.modified = True
+
     def is_authenticated(self):
         if 'user_db' not in session:
             return False
@@ -42,7 +156,12 @@ class User(UserMixin):
         if 'user_db' in session:
             if user_id in session['user_db']:
                 user = session['user_db'].get(user_id)
-                return User(user['id'], user['token'], user['email'], user['name'])
+                return User(user['id'], user['token'], user['email'], user['name'], user.get('token_time'))
+
+    # Get user objects of all accounts logged in within this session
+    @classmethod
+    def accounts(cls):
+        return [cls.get(user_id) for user_id in list(session.get('user_db', {}))]
 
     # Clear current user entry from user db
     @classmethod
@@ -50,3 +169,5 @@ class User(UserMixin):
         if 'user_db' in session:
             if user_id in session['user_db']:
                 session['user_db'].pop(user_id)
+                session.modified = True
+        registry.remove(user_id)
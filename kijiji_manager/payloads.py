@@ -0,0 +1,60 @@
+import os
+
+
+class PayloadStore:
+    """Store of posted ad XML payloads
+
+    Payloads are saved within the user's instance folder as one XML file per ad, named after the ad ID.
+    Saved payloads are used when reposting ads, and can be posted again manually.
+    """
+
+    def __init__(self, instance_path, user_id):
+        self.instance_path = instance_path
+        self.user_id = user_id
+        self.path = os.path.join(instance_path, 'user', user_id)
+
+    def file(self, ad_id):
+        """Get payload file path for given ad ID"""
+        return os.path.join(self.path, f'{ad_id}.xml')
+
+    def exists(self, ad_id):
+        return os.path.isfile(self.file(ad_id))
+
+    def load(self, ad_id):
+        """Get ad payload
+
+        :param ad_id: ad ID number
+        :return: XML payload string, or None if no payload is saved for this ad
+        """
+        try:
+            with open(self.file(ad_id), 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def save(self, ad_id, xml_payload):
+        """Save ad payload
+
+        :param ad_id: ad ID number
+        :param xml_payload: XML payload string or bytes
+        :return: saved payload file path
+        """
+        os.makedirs(self.path, exist_ok=True)
+        if isinstance(xml_payload, bytes):
+            xml_payload = xml_payload.decode('utf-8')
+        ad_file = self.file(ad_id)
+        with open(ad_file, 'w', encoding='utf-8') as f:
+            f.write(xml_payload)
+        return ad_file
+
+    def delete(self, ad_id):
+        """Delete ad payload
+
+        :param ad_id: ad ID number
+        :return: boolean indicating if a payload file was deleted
+        """
+        ad_file = self.file(ad_id)
+        if os.path.isfile(ad_file):
+            os.remove(ad_file)
+            return True
+        return False
@@ -0,0 +1,266 @@
+import math
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional
+
+from .cache import Memo
+
+# Picture link sizes, largest first
+PICTURE_SIZES = ['extraLarge', 'large', 'normal']
+
+
+# Parsed ad dates, by the date strings they are parsed from
+ad_dates = Memo()
+
+
+@dataclass
+class Picture:
+    """Ad picture"""
+    __slots__ = ('thumbnail', 'url')
+
+    thumbnail: Optional[str]
+    url: Optional[str]
+
+    @classmethod
+    def from_dict(cls, data):
+        links = {link.get('@rel'): link.get('@href') for link in as_list(data.get('pic:link'))}
+        url = next((links[size] for size in PICTURE_SIZES if links.get(size)), None)
+        return cls(links.get('thumbnail'), url or links.get('thumbnail'))
+
+
+@dataclass
+class Ad:
+    """Ad, as returned by KijijiApi.get_ad() with or without an ad ID"""
+    __slots__ = (
+        'id', 'title', 'description', 'category_id', 'category', 'ad_type', 'status', 'price_type', 'price',
+        'currency', 'location_id', 'latitude', 'longitude', 'address', 'views', 'phone_clicks', 'map_views', 'rank',
+        'created', 'start', 'end', 'created_at', 'start_at', 'end_at', 'url', 'pictures',
+    )
+
+    id: str
+    title: Optional[str]
+    description: Optional[str]
+    category_id: Optional[str]
+    category: Optional[str]
+    ad_type: Optional[str]
+    status: Optional[str]
+    price_type: Optional[str]
+    price: Optional[str]
+    currency: Optional[str]
+    location_id: Optional[str]
+    latitude: Optional[str]
+    longitude: Optional[str]
+    address: Optional[str]
+    views: Optional[int]
+    phone_clicks: Optional[int]
+    map_views: Optional[int]
+    rank: Optional[int]
+    created: Optional[str]
+    start: Optional[str]
+    end: Optional[str]
+    created_at: Optional[datetime]
+    start_at: Optional[datetime]
+    end_at: Optional[datetime]
+    url: Optional[str]
+    pictures: List[Picture]
+
+    @classmethod
+    def from_dict(cls, data):
+        price = data.get('ad:price') or {}
+        location = _get(data, 'loc:locations', 'loc:location') or {}
+
+        # Dates are only parsed once per distinct date strings, since most ads keep the same dates between refreshes
+        # Nothing else is keyed by ad, since the ad list has no modification time to tell when an ad was edited
+        dates = (data.get('ad:creation-date-time'), data.get('ad:start-date-time'), data.get('ad:end-date-time'))
+        created_at, start_at, end_at = ad_dates.get(dates, lambda: tuple(parse_datetime(date) for date in dates))
+        links = as_list(data.get('ad:link'))
+
+        return cls(
+            id=data.get('@id'),
+            title=data.get('ad:title'),
+            description=data.get('ad:description'),
+            category_id=_get(data, 'cat:category', '@id'),
+            category=_get(data, 'cat:category', 'cat:id-name'),
+            ad_type=_get(data, 'ad:ad-type', 'ad:value'),
+            status=_get(data, 'ad:ad-status', 'ad:value'),
+            price_type=_get(price, 'types:price-type', 'types:value'),
+            price=price.get('types:amount'),
+            currency=_get(price, 'types:currency-iso-code', 'types:value', '@localized-label'),
+            location_id=location.get('@id'),
+            latitude=location.get('loc:latitude'),
+            longitude=location.get('loc:longitude'),
+            address=_get(data, 'ad:ad-address', 'types:full-address'),
+            views=_int(data.get('ad:view-ad-count')),
+            phone_clicks=_int(data.get('ad:phone-click-count')),
+            map_views=_int(data.get('ad:map-view-count')),
+            rank=_int(data.get('ad:rank')),
+            created=data.get('ad:creation-date-time'),
+            start=data.get('ad:start-date-time'),
+            end=data.get('ad:end-date-time'),
+            created_at=created_at,
+            start_at=start_at,
+            end_at=end_at,
+            url=next((link.get('@href') for link in links if link.get('@rel') == 'self-public-website'), None),
+            pictures=[Picture.from_dict(pic) for pic in as_list(_get(data, 'pic:pictures', 'pic:picture'))],
+        )
+
+    @property
+    def page(self):
+        """Search results page number the ad is on"""
+        return rank_page(self.rank)
+
+    @property
+    def price_label(self):
+        """Price as shown to users, e.g. '$12.00', or price type such as 'PLEASE_CONTACT' if no amount is specified"""
+        if self.price_type == 'SPECIFIED_AMOUNT':
+            return f'{self.currency or "$"}{self.price if self.price is not None else ""}'
+        return self.price_type
+
+    @property
+    def thumbnail(self):
+        """First thumbnail image url, or None if ad has no images"""
+        return self.pictures[0].thumbnail if self.pictures else None
+
+
+@dataclass
+class Message:
+    """Conversation message"""
+    __slots__ = ('id', 'sender_id', 'sender_name', 'content', 'time', 'read')
+
+    id: Optional[str]
+    sender_id: Optional[str]
+    sender_name: Optional[str]
+    content: Optional[str]
+    time: Optional[str]
+    read: Optional[bool]
+
+    @classmethod
+    def from_dict(cls, data):
+        read = data.get('user:read')
+        return cls(
+            id=data.get('user:msg-id'),
+            sender_id=data.get('user:sender-id'),
+            sender_name=data.get('user:sender-name'),
+            content=data.get('user:msg-content'),
+            time=data.get('user:post-time-stamp'),
+            read=read == 'true' if read is not None else None,
+        )
+
+
+@dataclass
+class Conversation:
+    """Conversation, as returned by KijijiApi.get_conversation() or within KijijiApi.get_conversation_page()
+
+    Conversations within a page only include their latest message.
+    """
+    __slots__ = (
+        'uid', 'ad_id', 'subject', 'image', 'owner_id', 'owner_email', 'owner_name',
+        'replier_id', 'replier_email', 'replier_name', 'flagged_buyer', 'flagged_seller', 'messages',
+    )
+
+    uid: str
+    ad_id: Optional[str]
+    subject: Optional[str]
+    image: Optional[str]
+    owner_id: Optional[str]
+    owner_email: Optional[str]
+    owner_name: Optional[str]
+    replier_id: Optional[str]
+    replier_email: Optional[str]
+    replier_name: Optional[str]
+    flagged_buyer: bool
+    flagged_seller: bool
+    messages: List[Message]
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            uid=data.get('@uid'),
+            ad_id=data.get('user:ad-id'),
+            subject=data.get('user:ad-subject'),
+            image=data.get('user:ad-first-img-url'),
+            owner_id=data.get('user:ad-owner-id'),
+            owner_email=data.get('user:ad-owner-email'),
+            owner_name=data.get('user:ad-owner-name'),
+            replier_id=data.get('user:ad-replier-id'),
+            replier_email=data.get('user:ad-replier-email'),
+            replier_name=data.get('user:ad-replier-name'),
+            flagged_buyer=data.get('user:flagged-buyer') == 'true',
+            flagged_seller=data.get('user:flagged-seller') == 'true',
+            messages=[Message.from_dict(m) for m in as_list(data.get('user:user-message'))],
+        )
+
+    @property
+    def flagged(self):
+        return self.flagged_buyer or self.flagged_seller
+
+    @property
+    def last_message(self):
+        """Most recent message, or None if there are no messages"""
+        # ISO 8601 timestamps sort chronologically as strings
+        return max(self.messages, key=lambda m: m.time or '') if self.messages else None
+
+
+def parse_ads(data):
+    """Get list of Ad records from KijijiApi.get_ad() or get_ad_page() response"""
+    return [Ad.from_dict(ad) for ad in as_list(_get(data, 'ad:ads', 'ad:ad'))]
+
+
+def parse_ad(data):
+    """Get Ad record from KijijiApi.get_ad() response for a single ad"""
+    return Ad.from_dict(data['ad:ad'])
+
+
+def parse_conversations(data):
+    """Get list of Conversation records from KijijiApi.get_conversation_page() response"""
+    return [Conversation.from_dict(c) for c in as_list(_get(data, 'user:user-conversations', 'user:user-conversation'))]
+
+
+def parse_conversation(data):
+    """Get Conversation record from KijijiApi.get_conversation() response"""
+    return Conversation.from_dict(data['user:user-conversation'])
+
+
+def parse_datetime(date, fmt=None):
+    """Convert datetime string to datetime object, or None if it cannot be parsed
+    Kijiji API returns datetime strings in full ISO 8601 format; e.g. '2020-06-20T20:57:42.000Z'.
+    """
+    if fmt is None:
+        fmt = '%Y-%m-%dT%H:%M:%S.%f'
+
+    try:
+        date = date.replace('Z', '')  # Strip out trailing zone designator if present
+        return datetime.strptime(date, fmt)
+    except (ValueError, AttributeError):
+        return None
+
+
+def rank_page(rank):
+    """Convert ad rank to search results page number, or None if rank is not a number"""
+    try:
+        return int(math.ceil(int(rank) / 20))
+    except (TypeError, ValueError):
+        return None
+
+
+def as_list(data):
+    """Force xmltodict value to a list, since a single element is not parsed as a list"""
+    if data is None:
+        return []
+    return data if isinstance(data, list) else [data]
+
+
+def _get(data, *keys):
+    """Get nested dict value, or None if any key along the way is missing"""
+    for key in keys:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,253 @@
+import logging
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .accounts import RateLimiter
+from .adtemplates import fill_text, template_fields
+from .jobs import StatusJob
+from .kijijiapi import KijijiApiException, error_message
+from .locks import FileLock
+from .models import registry
+from .records import parse_conversation
+from .storage import read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+# Placeholders that can be used within a reply, filled in for each conversation
+REPLY_FIELDS = {
+    'name': 'Name of the other person in the conversation',
+    'subject': 'Ad title',
+    'ad_id': 'Ad ID',
+    'my_name': 'Your display name',
+}
+
+
+def reply_target(conversation, user_id, user_name=None, user_email=None):
+    """Get who a reply within a conversation is from, and which way it goes
+
+    :param conversation: Conversation record
+    :param user_id: ID of user replying
+    :param user_name: display name of user replying, used if not part of the conversation record
+    :param user_email: email of user replying, used if not part of the conversation record
+    :return: tuple of reply username, email and direction, or None if the ad has been deleted
+    """
+    # Ad has been deleted if owner ID is 'null'
+    # Subject will also say 'Deleted Ad'
+    if conversation.owner_id == 'null':
+        return None
+
+    if conversation.owner_id == user_id:
+        # Replying to our own ad
+        return conversation.owner_name or user_name, conversation.owner_email or user_email, 'buyer'
+    if conversation.replier_id == user_id:
+        # Replying to someone else's ad
+        return conversation.replier_name or user_name, conversation.replier_email or user_email, 'owner'
+    return None, None, None
+
+
+def reply_values(conversation, user_id, user_name):
+    """Get placeholder values of a reply within a conversation"""
+    if conversation.owner_id == user_id:
+        name = conversation.replier_name
+    else:
+        name = conversation.owner_name
+    return {
+        'name': name or '',
+        'subject': conversation.subject or '',
+        'ad_id': conversation.ad_id or '',
+        'my_name': user_name or '',
+    }
+
+
+def check_reply(message):
+    """Get error message if reply uses unknown placeholders, or None"""
+    unknown = [field for field in template_fields(message) if field not in REPLY_FIELDS]
+    if unknown:
+        return f'Unknown placeholders: {", ".join(unknown)}'
+    return None
+
+
+class CannedResponseStore:
+    """Store of canned reply messages
+
+    Saved as one JSON file within the user's instance folder, keyed by a random response ID.
+    The file is locked while being modified, since other worker processes may be modifying it at the same time.
+    """
+
+    FILE = 'responses.json'
+
+    # Response IDs are always a 32 character hex string
+    _id_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, instance_path, user_id):
+        self.file = os.path.join(instance_path, 'user', user_id, self.FILE)
+        self._lock = FileLock(f'{self.file}.lock')
+
+    def list(self):
+        """Get all responses, sorted by name"""
+        return sorted(self._read().values(), key=lambda r: r['name'].lower())
+
+    def get(self, response_id):
+        """Get response dict, or None if response does not exist"""
+        if not response_id or not self._id_pattern.match(response_id):
+            return None
+        return self._read().get(response_id)
+
+    def create(self, name, message):
+        """Save new response
+
+        :return: new response ID
+        """
+        response_id = uuid.uuid4().hex
+        with self._lock:
+            responses = self._read()
+            responses[response_id] = {'id': response_id, 'name': name, 'message': message}
+            self._write(responses)
+        return response_id
+
+    def delete(self, response_id):
+        """Delete response if it exists"""
+        with self._lock:
+            responses = self._read()
+            if responses.pop(response_id, None) is not None:
+                self._write(responses)
+
+    def _read(self):
+        return read_json(self.file, {})
+
+    def _write(self, responses):
+        write_json(self.file, responses)
+
+
+class ReplyBatchJob(StatusJob):
+    """Send the same reply to many conversations at once, filling in placeholders for each conversation
+
+    Replies are sent on a few threads at the same time, and spaced out to stay within a rate limit.
+    Conversations are given as already fetched records, e.g. from a cached conversations page, and are only
+    fetched again if not given.
+    Job progress is written to a JSON status file within the user's instance folder.
+    A job always ends up finished, with an error message if it was stopped early by an unexpected error.
+    """
+
+    FOLDER = 'replies'
+
+    def __init__(self, api, instance_path, user_id, token, user_name, user_email, message, conversations,
+                 per_minute=20, workers=4, job_id=None, on_change=None):
+        """
+        :param api: KijijiApi instance
+        :param instance_path: Flask instance folder path
+        :param user_id: user ID number
+        :param token: session token
+        :param user_name: user display name, for the 'my_name' placeholder
+        :param user_email: user email
+        :param message: reply message, with placeholders from REPLY_FIELDS
+        :param conversations: list of conversation IDs or Conversation records
+        :param per_minute: maximum number of replies sent per minute
+        :param workers: number of replies sent at the same time
+        :param on_change: optional callable given the user ID once any reply is sent
+        """
+        self.api = api
+        self.instance_path = instance_path
+        self.user_id = user_id
+        self.token = token
+        self.user_name = user_name
+        self.user_email = user_email
+        self.message = message
+        self.conversations = conversations
+        self.per_minute = per_minute
+        self.workers = workers
+        self.on_change = on_change
+        self.id = job_id or uuid.uuid4().hex
+
+        self._lock = threading.Lock()
+        self.status = {
+            'id': self.id,
+            'state': 'pending',
+            'created': datetime.utcnow().isoformat(timespec='milliseconds'),
+            'finished': None,
+            'total': len(conversations),
+            'sent': 0,
+            'failed': 0,
+            'error': None,
+            'conversations': [{'uid': _uid(c), 'name': None, 'subject': getattr(c, 'subject', None),
+                               'state': 'pending', 'error': None} for c in conversations],
+        }
+
+        # Save initial status so that the job can be reported on before it starts running
+        self._write()
+
+    def run(self):
+        """Run job to completion, returning final job status dict"""
+        try:
+            self._update(state='running')
+            limiter = RateLimiter(self.per_minute)
+            if self.conversations:
+                with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(self.conversations)))) as pool:
+                    list(pool.map(lambda i: self._send(i, limiter), range(len(self.conversations))))
+
+            if self.on_change and self.status['sent']:
+                self.on_change(self.user_id)
+        except Exception as e:
+            logger.exception('Reply batch %s stopped early', self.id)
+            self._update(error=error_message(e))
+        finally:
+            status = self._update(state='finished', finished=datetime.utcnow().isoformat(timespec='milliseconds'))
+        logger.info('Reply batch %s: sent %d replies, %d failed', self.id, status['sent'], status['failed'])
+        return status
+
+    def _send(self, i, limiter):
+        conversation = self.conversations[i]
+
+        # Session token may have been refreshed in the background
+        token = (registry.get(self.user_id) or {'token': self.token})['token']
+
+        try:
+            if isinstance(conversation, str):
+                limiter.wait()
+                # Only the conversation details are needed, not its messages
+                conversation = parse_conversation(self.api.get_conversation(self.user_id, token, conversation, tail=1))
+            self._update_conversation(i, subject=conversation.subject)
+
+            target = reply_target(conversation, self.user_id, self.user_name, self.user_email)
+            if target is None:
+                self._update_conversation(i, state='skipped', error='Ad has been deleted')
+                return
+            username, email, direction = target
+            if direction is None:
+                self._update_conversation(i, state='skipped', error='Not part of this conversation')
+                return
+            values = reply_values(conversation, self.user_id, self.user_name)
+            self._update_conversation(i, name=values['name'])
+
+            message = fill_text(self.message, values)
+            limiter.wait()
+            self.api.post_conversation_reply(self.user_id, token, conversation.uid, conversation.ad_id,
+                                             username, email, message, direction)
+        except Exception as e:
+            # Other errors, e.g. timeouts, only fail this conversation rather than the whole job
+            if not isinstance(e, KijijiApiException):
+                logger.exception('Reply batch %s: unable to reply to conversation %s', self.id, _uid(conversation))
+            self._update_conversation(i, failed=1, state='failed', error=error_message(e))
+            return
+        self._update_conversation(i, sent=1, state='sent')
+
+    def _update_conversation(self, i, sent=0, failed=0, **kwargs):
+        with self._lock:
+            self.status['conversations'][i].update(kwargs)
+            self.status['sent'] += sent
+            self.status['failed'] += failed
+            self._write()
+
+    def _update(self, **kwargs):
+        with self._lock:
+            self.status.update(kwargs)
+            self._write()
+            return dict(self.status)
+
+
+def _uid(conversation):
+    return conversation if isinstance(conversation, str) else conversation.uid
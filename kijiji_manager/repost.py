@@ -0,0 +1,525 @@
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import xmltodict
+
+from .export import iter_ads
+from .jobs import StatusJob
+from .kijijiapi import KijijiApiException, error_message
+from .locks import FileLock
+from .models import registry
+from .payloads import PayloadStore
+from .validation import check_payload
+
+logger = logging.getLogger(__name__)
+
+# Waiting for 3 minutes appears to be enough time for Kijiji to not consider it a duplicate ad
+REPOST_DELAY_MINUTES = 3
+
+# Number of times posting a deleted ad again is retried, and minutes between attempts
+REPOST_RETRIES = 3
+REPOST_RETRY_MINUTES = 5
+
+# Minutes between checks for reposts interrupted by the app or their worker process stopping
+REPOST_RECONCILE_MINUTES = 5
+
+
+def prepare_repost_payload(api, user_id, token, email, payloads, ad_id, warn=None):
+    """Get ad payload ready to be posted again
+
+    Uses the saved ad payload if there is one, otherwise a new payload is generated from the existing ad
+    on Kijiji site and saved.
+
+    :param api: KijijiApi instance
+    :param user_id: user ID number
+    :param token: session token
+    :param email: user email
+    :param payloads: PayloadStore instance for user
+    :param ad_id: ad ID number
+    :param warn: optional callable given any warning messages
+    :return: XML payload string
+    :raises PayloadValidationException: if payload fails local validation
+    """
+    xml_payload = payloads.load(ad_id)
+    if xml_payload is None:
+        # Get existing ad payload from Kijiji site when no local payload file found
+        xml_payload = generate_post_payload(api, user_id, token, email, ad_id)
+        payloads.save(ad_id, xml_payload)
+
+    # Kijiji changed their image upload API on around 2022-06-27 to use a different image host. Ad payloads that
+    # still contain the old image host URLs will be rejected unless the URLs are translated to the new image host.
+    # For ad payloads that already use the new image host, this translation should have no effect.
+    xml_payload = translate_image_urls(api, user_id, token, ad_id, xml_payload)
+
+    # Modify ad title by appending or removing a randomized length suffix
+    # This is done to avoid duplicate ad detection
+    xml_payload = modify_ad_title(xml_payload, warn)
+
+    # Check payload before the existing ad gets deleted, since Kijiji would only reject it after
+    check_payload(api, user_id, token, xml_payload)
+    return xml_payload
+
+
+def repost_ad(api, user_id, token, email, payloads, ad_id, delay_minutes=REPOST_DELAY_MINUTES, warn=None,
+              on_change=None):
+    """Repost existing ad by deleting it and posting a new ad with the same content
+
+    Blocks for the whole delay between deleting and posting.
+
+    :param on_change: optional callable given the user ID once the ad is deleted, and again once posted
+    :return: new ad ID number
+    """
+    xml_payload = prepare_repost_payload(api, user_id, token, email, payloads, ad_id, warn)
+
+    job = RepostJob(api, payloads.instance_path, user_id, token, ad_id, xml_payload, delay_minutes, on_change=on_change)
+    return job.run()
+
+
+class RepostJob(StatusJob):
+    """Repost an ad as a state machine whose progress is persisted after every step
+
+    States go from 'pending-delete' to 'deleted' once the existing ad has been deleted, to 'cooling' while waiting
+    for the repost delay to pass, and end in 'posted' or 'failed'. Posting is retried a few times before failing.
+    A failed repost keeps its payload, both in the job and in the payload store, so that it can be retried later.
+
+    The job carries everything needed to run on its own: the user ID, session token and prepared payload.
+    It does not use any request or app context, so it can run on any worker thread.
+    The payload and a JSON status file are saved within the user's instance folder when the job is created,
+    so that a job interrupted by the app stopping can be resumed with load() and run().
+
+    A job holds a file lock from when it is created or loaded until it finishes or fails to delete the ad,
+    so that it is never run twice at the same time, even by different worker processes, and a job whose
+    worker process was recycled can be resumed by another one.
+    """
+
+    FOLDER = 'jobs'
+
+    # States of jobs that have not finished yet
+    UNFINISHED = ('pending-delete', 'deleted', 'cooling')
+
+    def __init__(self, api, instance_path, user_id, token, ad_id, xml_payload, delay_minutes=REPOST_DELAY_MINUTES,
+                 job_id=None, retries=REPOST_RETRIES, retry_minutes=REPOST_RETRY_MINUTES, status=None, on_change=None):
+        self.api = api
+        self.instance_path = instance_path
+        self.user_id = user_id
+        self.token = token
+        self.id = job_id or uuid.uuid4().hex
+        self.delay_minutes = delay_minutes
+        self.retries = retries
+        self.retry_minutes = retry_minutes
+
+        # Optional callable given the user ID once the ad is deleted, and again once posted
+        self.on_change = on_change
+        self._lock = FileLock(self.file(instance_path, user_id, self.id, 'lock'))
+
+        # Whether resuming an existing job, in which case the ad may or may not have been deleted already
+        self.resumed = status is not None
+        if self.resumed:
+            self.status = status
+            return
+
+        self.status = {
+            'id': self.id,
+            'state': 'pending-delete',
+            'ad_id': ad_id,
+            'new_ad_id': None,
+            'created': datetime.utcnow().isoformat(timespec='milliseconds'),
+            'deleted': None,
+            'delay_minutes': delay_minutes,
+            'post_at': None,
+            'attempts': 0,
+            'finished': None,
+            'error': None,
+        }
+
+        payload_file = self.file(instance_path, user_id, self.id, 'xml')
+        os.makedirs(os.path.dirname(payload_file), exist_ok=True)
+        self._lock.acquire()
+        with open(payload_file, 'w', encoding='utf-8') as f:
+            f.write(xml_payload)
+        self._write()
+
+    @classmethod
+    def list_status(cls, instance_path, user_id):
+        """Get status dicts of all jobs of a user, most recently created first"""
+        path = os.path.join(instance_path, 'user', user_id, 'jobs')
+        if not os.path.isdir(path):
+            return []
+
+        jobs = []
+        for name in os.listdir(path):
+            job_id, ext = os.path.splitext(name)
+            if ext == '.json':
+                status = cls.load_status(instance_path, user_id, job_id)
+                if status is not None:
+                    jobs.append(status)
+        return sorted(jobs, key=lambda j: j['created'], reverse=True)
+
+    @classmethod
+    def load(cls, api, instance_path, user_id, token, job_id, **kwargs):
+        """Load existing job to resume or retry it
+
+        :return: RepostJob instance, or None if the job or its payload does not exist, or it is already running
+        """
+        lock_file = cls.file(instance_path, user_id, job_id, 'lock')
+        if not lock_file:
+            return None
+        lock = FileLock(lock_file)
+        if not lock.acquire():
+            return None
+
+        # Status is only read once locked, since the job may have just been run to the end
+        status = cls.load_status(instance_path, user_id, job_id)
+        if status is None or not os.path.isfile(cls.file(instance_path, user_id, job_id, 'xml')):
+            lock.release()
+            return None
+
+        # Jobs saved by earlier versions were only created once the ad had been deleted
+        if status['state'] == 'waiting':
+            status['state'] = 'deleted'
+        status.setdefault('deleted', status['created'])
+        status.setdefault('attempts', 0)
+        kwargs.setdefault('delay_minutes', status.get('delay_minutes', REPOST_DELAY_MINUTES))
+
+        job = cls(api, instance_path, user_id, token, status['ad_id'], None, job_id=job_id, status=status, **kwargs)
+        job._lock = lock
+        return job
+
+    @classmethod
+    def is_running(cls, instance_path, user_id, job_id):
+        """Check if job is held by a job object, in this or any other process"""
+        lock = FileLock(cls.file(instance_path, user_id, job_id, 'lock'))
+        if not lock.acquire():
+            return True
+        lock.release()
+        return False
+
+    @property
+    def state(self):
+        return self.status['state']
+
+    def delete(self):
+        """Delete the existing ad, unless already deleted
+
+        A delete rejected by Kijiji leaves the existing ad in place, so the job fails without anything to retry.
+        Any other error, e.g. a timeout, leaves it unknown whether the ad was deleted, so the job stays pending
+        and the delete is checked again once it is resumed.
+        The job's lock is released whenever this raises, since the job is not run after.
+        """
+        if self.state != 'pending-delete':
+            return
+
+        ad_id = self.status['ad_id']
+        try:
+            self.api.delete_ad(self.user_id, self._token(), ad_id)
+        except Exception as e:
+            if isinstance(e, KijijiApiException):
+                # A resumed job may have been interrupted right after deleting, and find the ad already gone
+                exists = self._ad_exists(ad_id) if self.resumed else True
+            else:
+                exists = None
+            if exists is not False:
+                try:
+                    self._delete_failed(ad_id, e, exists)
+                finally:
+                    # Job is not run after a failed delete, so it can be resumed elsewhere
+                    self.release()
+                raise
+
+        post_time = time.time() + self.delay_minutes * 60
+        self._update(state='deleted', deleted=datetime.utcnow().isoformat(timespec='milliseconds'),
+                     post_at=datetime.utcfromtimestamp(post_time).isoformat(timespec='milliseconds'))
+        logger.info('Repost job %s: deleted ad %s of user %s', self.id, ad_id, self.user_id)
+        if self.on_change:
+            self.on_change(self.user_id)
+
+    def run(self):
+        """Run job from its current state until finished: delete the ad if not deleted yet,
+        wait until the post time and post the ad, retrying on failure
+
+        :return: new ad ID number, or None if the job is already running
+        """
+        if not self._lock.acquire():
+            logger.info('Repost job %s is already running', self.id)
+            return None
+
+        try:
+            self.delete()
+            return self._post()
+        finally:
+            self.release()
+
+    def release(self):
+        """Release the job's lock, for a job that is not going to be run"""
+        if self._lock.locked and self.state not in self.UNFINISHED:
+            # Lock file is no longer needed, since a finished job is never resumed
+            try:
+                os.remove(self._lock.path)
+            except OSError:
+                pass
+        self._lock.release()
+
+    def retry(self):
+        """Mark failed job to be posted again by run(), as long as its ad was deleted"""
+        if self.state == 'failed' and self.status['deleted']:
+            self._update(state='deleted', attempts=0, error=None, finished=None,
+                         post_at=datetime.utcnow().isoformat(timespec='milliseconds'))
+            return True
+        return False
+
+    def _delete_failed(self, ad_id, e, exists):
+        if exists is None:
+            self._update(error=f'Unable to delete ad: {error_message(e)}')
+            logger.error('Repost job %s: unable to tell if ad %s of user %s was deleted, will try again when resumed: %s',
+                         self.id, ad_id, self.user_id, self.status['error'])
+            return
+
+        self._update(state='failed', error=f'Unable to delete ad: {error_message(e)}',
+                     finished=datetime.utcnow().isoformat(timespec='milliseconds'))
+        os.remove(self.file(self.instance_path, self.user_id, self.id, 'xml'))
+        logger.error('Repost job %s: failed to delete ad %s of user %s: %s', self.id, ad_id, self.user_id, self.status['error'])
+
+    def _post(self):
+        if self.state == 'posted':
+            return self.status['new_ad_id']
+        if self.state not in ('deleted', 'cooling'):
+            return None
+
+        ad_id = self.status['ad_id']
+        self._update(state='cooling')
+        logger.info('Repost job %s: posting ad %s of user %s at %s UTC', self.id, ad_id, self.user_id, self.status['post_at'])
+        post_time = datetime.fromisoformat(self.status['post_at']).replace(tzinfo=timezone.utc).timestamp()
+        time.sleep(max(0, post_time - time.time()))
+
+        payload_file = self.file(self.instance_path, self.user_id, self.id, 'xml')
+        with open(payload_file, 'r', encoding='utf-8') as f:
+            xml_payload = f.read()
+
+        while True:
+            try:
+                ad_id_new = self.api.post_ad(self.user_id, self._token(), xml_payload)
+                break
+            except KijijiApiException as e:
+                attempts = self.status['attempts'] + 1
+                if attempts > self.retries:
+                    self._update(state='failed', attempts=attempts, error=error_message(e),
+                                 finished=datetime.utcnow().isoformat(timespec='milliseconds'))
+                    logger.error('Repost job %s: failed to post ad %s of user %s after %d attempts: %s',
+                                 self.id, ad_id, self.user_id, attempts, self.status['error'])
+                    raise
+
+                self._update(attempts=attempts, error=error_message(e))
+                logger.warning('Repost job %s: failed to post ad %s of user %s, retrying in %s minutes: %s',
+                               self.id, ad_id, self.user_id, self.retry_minutes, self.status['error'])
+                time.sleep(self.retry_minutes * 60)
+
+        payloads = PayloadStore(self.instance_path, self.user_id)
+        payloads.save(ad_id_new, xml_payload)
+        payloads.delete(ad_id)
+
+        # Payload is kept in the payload store from now on
+        os.remove(payload_file)
+
+        self._update(state='posted', new_ad_id=ad_id_new, error=None,
+                     finished=datetime.utcnow().isoformat(timespec='milliseconds'))
+        logger.info('Repost job %s: reposted ad %s of user %s, new ID %s', self.id, ad_id, self.user_id, ad_id_new)
+        if self.on_change:
+            self.on_change(self.user_id)
+        return ad_id_new
+
+    def _token(self):
+        # Session token may have been refreshed in the background while waiting
+        user = registry.get(self.user_id)
+        return user['token'] if user else self.token
+
+    def _ad_exists(self, ad_id):
+        """Check if ad is still listed in the user's ads, or None if the ads cannot be fetched"""
+        try:
+            return any(ad.get('@id') == ad_id for ad in iter_ads(self.api, self.user_id, self._token()))
+        except Exception:
+            return None
+
+    def _update(self, **kwargs):
+        self.status.update(kwargs)
+        self._write()
+
+
+def resume_reposts(api, instance_path, user_id, token, start=None, on_change=None):
+    """Resume repost jobs of a user that were interrupted by the app stopping
+
+    :param api: KijijiApi instance
+    :param instance_path: Flask instance folder path
+    :param user_id: user ID number
+    :param token: session token
+    :param start: callable given each job's run method to run it in the background, defaults to a new thread
+    :param on_change: optional callable given the user ID whenever a resumed job changes the user's ads
+    :return: list of resumed job IDs
+    """
+    resumed = []
+    for status in RepostJob.list_status(instance_path, user_id):
+        if status['state'] not in RepostJob.UNFINISHED:
+            continue
+        job = RepostJob.load(api, instance_path, user_id, token, status['id'], on_change=on_change)
+        if job is None:
+            continue
+
+        logger.info('Repost job %s: resuming repost of ad %s of user %s from state %s', job.id, status['ad_id'], user_id, job.state)
+        (start or _start_thread)(job.run)
+        resumed.append(job.id)
+    return resumed
+
+
+# IDs of interrupted jobs already reported by reconcile_reposts()
+_reported = set()
+
+
+def reconcile_reposts(api, instance_path, credentials=None, start=None, on_change=None):
+    """Find repost jobs of all users that were interrupted by the app or their worker process stopping
+
+    Run on app startup and then periodically by the process running scheduled tasks. Jobs still running,
+    whichever process runs them, are skipped. Jobs of users with saved credentials are resumed right away.
+    Other users' jobs are reported once, and are resumed once the user logs in again.
+
+    :param api: KijijiApi instance
+    :param instance_path: Flask instance folder path
+    :param credentials: optional CredentialStore instance
+    :param start: callable given each job's run method to run it in the background, defaults to a new thread
+    :param on_change: optional callable given the user ID whenever a resumed job changes the user's ads
+    :return: dict of user ID to list of resumed job IDs
+    """
+    user_root = os.path.join(instance_path, 'user')
+    if not os.path.isdir(user_root):
+        return {}
+
+    resumed = {}
+    for user_id in os.listdir(user_root):
+        unfinished = [s for s in RepostJob.list_status(instance_path, user_id)
+                      if s['state'] in RepostJob.UNFINISHED and not RepostJob.is_running(instance_path, user_id, s['id'])]
+        if not unfinished:
+            continue
+
+        saved = credentials.get(user_id) if credentials else None
+        if saved:
+            try:
+                _, token = api.login(saved['email'], saved['password'])
+            except KijijiApiException as e:
+                logger.warning('Unable to log in user %s to resume reposts: %s', user_id, e)
+            else:
+                resumed[user_id] = resume_reposts(api, instance_path, user_id, token, start, on_change)
+                continue
+
+        unreported = [s for s in unfinished if s['id'] not in _reported]
+        if unreported:
+            logger.warning('%d interrupted reposts of user %s will be resumed once they log in: ads %s',
+                           len(unreported), user_id, ', '.join(s['ad_id'] for s in unreported))
+            _reported.update(s['id'] for s in unreported)
+    return resumed
+
+
+def _start_thread(func):
+    def run():
+        try:
+            func()
+        except Exception:
+            # Already logged and recorded in the job status
+            pass
+    threading.Thread(target=run, name='repost-job', daemon=True).start()
+
+
+def translate_image_urls(api, user_id, token, ad_id, xml_payload):
+    """Overwrite image URLs in ad payload using image URLs from current ad."""
+    data = api.get_ad(user_id, token, ad_id)
+    payload = xmltodict.parse(xml_payload)
+    payload['ad:ad']['pic:pictures'] = data['ad:ad']['pic:pictures']
+    return xmltodict.unparse(payload, short_empty_elements=True)
+
+
+def modify_ad_title(xml_payload, warn=None):
+    """Modify ad title by appending or removing a randomized length suffix."""
+    def count_suffix_len(text, suffix_char):
+        """Count the number of consecutive characters in the string starting from the end."""
+        i = len(text)
+        for i in reversed(range(len(text))):
+            if text[i] != suffix_char:
+                i += 1
+                break
+        return len(text) - i
+
+    # Possible suffix character choices
+    suffix_chars = ['.', '!', '*', '+']
+
+    # Maximum number of consecutive suffix characters to append
+    suffix_max_length = 4
+
+    payload = xmltodict.parse(xml_payload)
+    ad_title_orig = payload['ad:ad']['ad:title']
+
+    # Test every possible suffix character, stopping on the first one found
+    # TODO Efficiency of this algorithm is pretty bad, but ad titles are limited to 64 characters at most
+    suffix_len = 0
+    for char in suffix_chars:
+        suffix_len = count_suffix_len(ad_title_orig, char)
+        if suffix_len:
+            break
+
+    if suffix_len:
+        # Suffix exists, remove it
+        ad_title_new = ad_title_orig[:-suffix_len].rstrip()
+    else:
+        # No suffix, append a random length one with a randomly chosen suffix character
+        suffix_new = f" {random.choice(suffix_chars) * random.randint(1, suffix_max_length)}"
+        ad_title_new = ad_title_orig + suffix_new
+
+        # Check if new ad title is longer than the maximum allowed ad title length
+        max_ad_title_length = 64
+        if len(ad_title_new) > max_ad_title_length:
+            if warn:
+                warn(f'Warning: Truncating modified ad title "{ad_title_new}" to {max_ad_title_length} characters')
+            ad_title_new = ad_title_orig[:max_ad_title_length - len(suffix_new)] + suffix_new
+
+    payload['ad:ad']['ad:title'] = ad_title_new
+    return xmltodict.unparse(payload, short_empty_elements=True)
+
+
+def generate_post_payload(api, user_id, token, email, ad_id):
+    """Generate ad payload from existing ad data."""
+    data = api.get_ad(user_id, token, ad_id)
+    ad_orig = data['ad:ad']
+    payload = {
+        'ad:ad': {
+            '@xmlns:ad': 'http://www.ebayclassifiedsgroup.com/schema/ad/v1',
+            '@xmlns:cat': 'http://www.ebayclassifiedsgroup.com/schema/category/v1',
+            '@xmlns:loc': 'http://www.ebayclassifiedsgroup.com/schema/location/v1',
+            '@xmlns:attr': 'http://www.ebayclassifiedsgroup.com/schema/attribute/v1',
+            '@xmlns:types': 'http://www.ebayclassifiedsgroup.com/schema/types/v1',
+            '@xmlns:pic': 'http://www.ebayclassifiedsgroup.com/schema/picture/v1',
+            '@xmlns:vid': 'http://www.ebayclassifiedsgroup.com/schema/video/v1',
+            '@xmlns:user': 'http://www.ebayclassifiedsgroup.com/schema/user/v1',
+            '@xmlns:feature': 'http://www.ebayclassifiedsgroup.com/schema/feature/v1',
+            '@id': '',
+            'cat:category': ad_orig['cat:category'],
+            'loc:locations': ad_orig['loc:locations'],
+            'ad:ad-type': ad_orig['ad:ad-type'],
+            'ad:title': ad_orig['ad:title'],
+            'ad:description':  ad_orig['ad:description'],
+            'ad:price': ad_orig.get('ad:price'),
+            'ad:account-id': user_id,
+            'ad:email': email,
+            'ad:poster-contact-email': email,
+            # 'ad:poster-contact-name': None,  # Not sent by Kijiji app
+            'ad:phone': ad_orig['ad:phone'],
+            'ad:ad-address': ad_orig['ad:ad-address'],
+            'ad:visible-on-map': 'true',  # appears to make no difference if set to 'true' or 'false'
+            'attr:attributes': ad_orig['attr:attributes'],
+            'pic:pictures': ad_orig['pic:pictures'],
+            'vid:videos': None,
+            'ad:adSlots': None,
+            'ad:listing-tags': None,
+        }
+    }
+    return xmltodict.unparse(payload, short_empty_elements=True)
@@ -0,0 +1,100 @@
+import logging
+import os
+import threading
+
+from .locks import FileLock
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLease:
+    """Elect a single process to run scheduled background work
+
+    When the app is served by many worker processes, e.g. by gunicorn, every worker starts the same periodic tasks.
+    The first process to lock `scheduler.lock` within the instance folder becomes the leader and keeps the lock
+    for as long as it runs. The other processes only serve requests, and check again each time one of their tasks
+    is due, so one of them takes over once the leader exits or is recycled.
+
+    Use get() rather than creating a lease directly, so that every app within a process shares one lease
+    per instance folder; a second lease on the same file would never become the leader.
+    """
+
+    FILE = 'scheduler.lock'
+
+    # Leases of this process by instance folder path
+    _leases = {}
+    _leases_lock = threading.Lock()
+
+    def __init__(self, instance_path):
+        self._lock = FileLock(os.path.join(instance_path, self.FILE))
+        self._guard = threading.Lock()
+
+    @classmethod
+    def get(cls, instance_path):
+        """Get the lease of this process for an instance folder"""
+        instance_path = os.path.abspath(instance_path)
+        with cls._leases_lock:
+            if instance_path not in cls._leases:
+                cls._leases[instance_path] = cls(instance_path)
+            return cls._leases[instance_path]
+
+    def is_leader(self):
+        """Check if this process is the leader, becoming it if there is no leader"""
+        with self._guard:
+            if self._lock.locked:
+                return True
+            if self._lock.acquire():
+                logger.info('Process %s is now running scheduled tasks', os.getpid())
+                return True
+            return False
+
+    def release(self):
+        with self._guard:
+            self._lock.release()
+
+
+class PeriodicTask:
+    """Run a function repeatedly at a fixed interval in a background daemon thread
+
+    Exceptions raised by the function are logged and do not stop the task from running again.
+    """
+
+    def __init__(self, name, interval, func, *args, lease=None, **kwargs):
+        """
+        :param name: task name, used for logging and thread name
+        :param interval: seconds between the start of each run
+        :param func: function to run
+        :param lease: optional LeaderLease, the function is only run while this process is the leader
+        """
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.lease = lease
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        """Run function once in the current thread"""
+        try:
+            self.func(*self.args, **self.kwargs)
+        except Exception:
+            logger.exception('Periodic task %s failed', self.name)
+
+    def _run(self):
+        logger.info('Started periodic task %s every %s seconds', self.name, self.interval)
+        while not self._stop.is_set():
+            if self.lease is None or self.lease.is_leader():
+                self.run_once()
+            self._stop.wait(self.interval)
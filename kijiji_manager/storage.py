@@ -0,0 +1,63 @@
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+# Process umask, which can only be read by setting it
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+@contextmanager
+def atomic_write(file, binary=False, private=False):
+    """Open file for writing, replacing the file only once it is completely written
+
+    Contents are written to a temporary file first, so that readers, including other processes,
+    only ever see the old or the new contents and never a partially written file.
+    Every write has its own temporary file, so writers of the same file at the same time never clash;
+    the last one to finish wins.
+
+    :param file: file path, its folder is created if missing
+    :param binary: write bytes rather than text
+    :param private: only allow the user running the app to read the file
+    """
+    folder = os.path.dirname(file)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=folder, prefix=f'{os.path.basename(file)}.', suffix='.tmp')
+    try:
+        # Temporary files are only readable by the user running the app, other files get the usual permissions
+        if not private:
+            os.chmod(tmp_file, 0o666 & ~_umask)
+        with open(fd, 'wb' if binary else 'w', encoding=None if binary else 'utf-8') as f:
+            yield f
+        os.replace(tmp_file, file)
+    except BaseException:
+        try:
+            os.remove(tmp_file)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def file_identity(path):
+    """File identity that changes whenever the file is replaced, or None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def read_json(file, default=None):
+    """Read JSON file, or get default if the file is missing or not valid JSON"""
+    try:
+        with open(file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(file, data, private=False):
+    """Write JSON file atomically, see atomic_write()"""
+    with atomic_write(file, private=private) as f:
+        json.dump(data, f)
@@ -0,0 +1,167 @@
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from xml.parsers.expat import ExpatError
+
+import xmltodict
+
+from .kijijiapi import KijijiApiException
+from .metadata import metadata_cache
+from .records import as_list
+
+logger = logging.getLogger(__name__)
+
+# Longest ad title accepted by Kijiji
+MAX_TITLE_LENGTH = 64
+
+# Dollar amount with at most two decimal places
+_price_pattern = re.compile(r'^\d+(\.\d{1,2})?$')
+
+# Kijiji date values are ISO 8601 datetime strings, only the date portion is used
+_date_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+
+class PayloadValidationException(KijijiApiException):
+    """Raised when an ad payload fails local validation, before anything is sent to Kijiji"""
+
+
+class AttributeSchema:
+    """Ad types and attributes supported by a category, from KijijiApi.get_attributes() response"""
+
+    def __init__(self, data):
+        ad = (data or {}).get('ad:ad') or {}
+        self.ad_types = [_text(v) for v in as_list((ad.get('ad:ad-type') or {}).get('ad:supported-value'))]
+
+        # Only attributes that can be written to an ad, by attribute name
+        self.attributes = {}
+        for attrib in as_list((ad.get('attr:attributes') or {}).get('attr:attribute')):
+            if not isinstance(attrib, dict) or attrib.get('@deprecated') == 'true' or attrib.get('@write') == 'unsupported':
+                continue
+            self.attributes[attrib.get('@name')] = {
+                'label': attrib.get('@localized-label') or attrib.get('@name'),
+                'type': attrib.get('@type'),
+                'required': attrib.get('@write') == 'required',
+                'choices': {_text(v) for v in as_list(attrib.get('attr:supported-value'))},
+            }
+
+    def validate(self, ad):
+        """Check ad type and attribute values of parsed ad payload
+
+        Attributes unknown to the schema are not checked, since existing ads may carry read-only attributes.
+
+        :param ad: ad:ad element dict of parsed payload
+        :return: list of error messages
+        """
+        messages = []
+
+        ad_type = _text((ad.get('ad:ad-type') or {}).get('ad:value'))
+        if self.ad_types and ad_type not in self.ad_types:
+            messages.append(f'Ad type {ad_type} is not supported in this category')
+
+        values = {}
+        for attrib in as_list((ad.get('attr:attributes') or {}).get('attr:attribute')):
+            if isinstance(attrib, dict):
+                values[attrib.get('@name')] = _text(attrib.get('attr:value'))
+
+        for name, attrib in self.attributes.items():
+            value = values.get(name)
+            if value is None or value == '':
+                if attrib['required']:
+                    messages.append(f'Missing required attribute {attrib["label"]}')
+                continue
+
+            if attrib['type'] == 'ENUM' and attrib['choices']:
+                invalid = [v for v in value.split(',') if v not in attrib['choices']]
+                if invalid:
+                    messages.append(f'Invalid value {",".join(invalid)} for attribute {attrib["label"]}')
+            elif attrib['type'] == 'INTEGER' and not re.match(r'^-?\d+$', value):
+                messages.append(f'Attribute {attrib["label"]} must be a whole number')
+            elif attrib['type'] == 'BOOLEAN' and value not in ('true', 'false'):
+                messages.append(f'Attribute {attrib["label"]} must be true or false')
+            elif attrib['type'] == 'DATE' and not _date_pattern.match(value):
+                messages.append(f'Attribute {attrib["label"]} must be a date')
+        return messages
+
+
+def validate_ad(ad, schema=None):
+    """Check title, price and, if a schema is given, the attributes of parsed ad payload
+
+    :param ad: ad:ad element dict of parsed payload
+    :param schema: optional AttributeSchema of the ad category
+    :return: list of error messages
+    """
+    messages = []
+
+    title = _text(ad.get('ad:title')) or ''
+    if not title.strip():
+        messages.append('Missing ad title')
+    elif len(title) > MAX_TITLE_LENGTH:
+        messages.append(f'Ad title is longer than {MAX_TITLE_LENGTH} characters')
+
+    price = ad.get('ad:price') or {}
+    price_type = _text((price.get('types:price-type') or {}).get('types:value'))
+    amount = _text(price.get('types:amount'))
+    if price_type == 'SPECIFIED_AMOUNT' and not amount:
+        messages.append('Missing price amount')
+    elif amount and not _price_pattern.match(amount):
+        messages.append(f'Invalid price amount {amount}')
+
+    if schema is not None:
+        messages += schema.validate(ad)
+    return messages
+
+
+def validate_payloads(api, user_id, token, xml_payloads, workers=4):
+    """Check many ad payloads at once before posting them
+
+    The attribute metadata of each category is fetched once, through the metadata cache, for all payloads
+    of that category. Payloads whose category metadata cannot be fetched are only checked for title and price.
+
+    :param api: KijijiApi instance
+    :param user_id: user ID number
+    :param token: session token
+    :param xml_payloads: list of XML payload strings
+    :param workers: number of category metadata fetched at the same time
+    :return: list of lists of error messages, in the same order as the payloads
+    """
+    ads = []
+    for xml_payload in xml_payloads:
+        try:
+            ad = xmltodict.parse(xml_payload).get('ad:ad')
+        except ExpatError:
+            ad = None
+        ads.append(ad if isinstance(ad, dict) else None)
+
+    categories = list({(ad.get('cat:category') or {}).get('@id') for ad in ads if ad} - {None})
+
+    def get_schema(category_id):
+        try:
+            return AttributeSchema(metadata_cache.attributes(api, user_id, token, category_id))
+        except KijijiApiException as e:
+            logger.warning('Unable to get attribute metadata of category %s, skipping attribute checks: %s', category_id, e)
+            return None
+
+    schemas = {}
+    if categories:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(categories)))) as pool:
+            schemas = dict(zip(categories, pool.map(get_schema, categories)))
+
+    return [validate_ad(ad, schemas.get((ad.get('cat:category') or {}).get('@id'))) if ad else ['Unable to parse ad payload']
+            for ad in ads]
+
+
+def check_payload(api, user_id, token, xml_payload):
+    """Check a single ad payload before posting it
+
+    :raises PayloadValidationException: with the list of error messages if payload is not valid
+    """
+    messages = validate_payloads(api, user_id, token, [xml_payload])[0]
+    if messages:
+        raise PayloadValidationException(messages)
+
+
+def _text(value):
+    """Get text of parsed element, which is a dict if the element has attributes"""
+    if isinstance(value, dict):
+        return value.get('#text')
+    return value
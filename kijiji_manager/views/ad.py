@@ -1,18 +1,29 @@
 import os
-import random
-from datetime import datetime
-from time import sleep
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
 
 import xmltodict
-from flask import Blueprint, flash, render_template, redirect, url_for, session, current_app, request
+from flask import Blueprint, flash, render_template, redirect, url_for, current_app, request
 from flask_executor import Executor
 from flask_login import login_required, current_user
 from flask_wtf import FlaskForm
+from werkzeug.datastructures import FileStorage, MultiDict
 from wtforms import StringField, SelectField, BooleanField, IntegerField, DateField, SelectMultipleField, widgets
 from wtforms.validators import InputRequired, Optional
 
-from kijiji_manager.forms.post import CategoryForm, PostForm, PostManualForm
+from kijiji_manager.adtemplates import AdTemplateStore, generate_payloads, template_fields
+from kijiji_manager.bulk import BulkImportException, BulkPostJob, read_archive, read_directory
+from kijiji_manager.cache import page_cache
+from kijiji_manager.drafts import DraftStore
+from kijiji_manager.forms.post import CategoryForm, PostForm, PostManualForm, PostBulkForm, AdTemplateForm, AdTemplateGenerateForm
+from kijiji_manager.images import UploadedImageStore, image_processor
 from kijiji_manager.kijijiapi import KijijiApi
+from kijiji_manager.metadata import metadata_cache
+from kijiji_manager.payloads import PayloadStore
+from kijiji_manager.records import parse_ad, parse_ads
+from kijiji_manager.repost import REPOST_DELAY_MINUTES, REPOST_RETRIES, REPOST_RETRY_MINUTES, RepostJob, generate_post_payload, prepare_repost_payload, translate_image_urls
+from kijiji_manager.validation import validate_payloads
 
 ad = Blueprint('ad', __name__)
 kijiji_api = KijijiApi()
@@ -23,8 +34,9 @@ executor = Executor()
 @login_required
 def show(ad_id):
     """Show existing ad."""
-    data = kijiji_api.get_ad(current_user.id, current_user.token, ad_id)
-    return render_template('ad.html', data=data)
+    data = page_cache.data(current_user.id, f'ad/{ad_id}', lambda: kijiji_api.get_ad(current_user.id, current_user.token, ad_id))
+    record = parse_ad(data)
+    return page_cache.render_page(current_user.id, 'ad.html', 'fragments/ad_details.html', record, ad=record)
 
 
 @ad.route('/delete/<ad_id>')
@@ -32,6 +44,7 @@ def show(ad_id):
 def delete(ad_id):
     """Delete existing ad."""
     kijiji_api.delete_ad(current_user.id, current_user.token, ad_id)
+    page_cache.invalidate(current_user.id)
     flash(f'Deleted ad {ad_id}')
     return redirect(url_for('main.home'))
 
@@ -45,46 +58,104 @@ def post_manual():
         if form.file.data:
             xml_payload = form.file.data.read()
 
+            # Check payload locally first, rather than waiting for Kijiji to reject it
+            messages = validate_payloads(kijiji_api, current_user.id, current_user.token, [xml_payload])[0]
+            if messages:
+                flash(f'Ad payload is not valid: {"; ".join(messages)}')
+                return render_template('post_manual.html', form=form)
+
             ad_id = kijiji_api.post_ad(current_user.id, current_user.token, xml_payload)
+            page_cache.invalidate(current_user.id)
             flash(f'Manually posted ad {ad_id}')
 
             # Save ad payload
-            user_dir = os.path.join(current_app.instance_path, 'user', current_user.id)
-            if not os.path.exists(user_dir):
-                os.makedirs(user_dir)
-            ad_file = os.path.join(user_dir, f'{ad_id}.xml')
-            with open(ad_file, 'w', encoding='utf-8') as f:
-                if isinstance(xml_payload, bytes):
-                    xml_payload = xml_payload.decode('utf-8')
-                f.write(xml_payload)
-            flash(f'Ad {ad_id} payload saved to {ad_file}')
+            save_ad_file(ad_id, xml_payload)
 
     if form.errors:
         flash(form.errors)
     return render_template('post_manual.html', form=form)
 
 
+@ad.route('/post_bulk', methods=['GET', 'POST'])
+@login_required
+def post_bulk():
+    """Post many new ads from an archive or server directory of raw ad payloads."""
+    form = PostBulkForm()
+    if form.validate_on_submit():
+        try:
+            if form.file.data:
+                payloads = read_archive(form.file.data.stream, form.file.data.filename)
+            elif form.directory.data:
+                payloads = read_directory(get_bulk_import_dir(form.directory.data))
+            else:
+                raise BulkImportException('Either an archive file or a server directory must be given')
+        except BulkImportException as e:
+            flash(e)
+            return render_template('post_bulk.html', form=form)
+
+        if not payloads:
+            flash('No XML ad payload files found')
+            return render_template('post_bulk.html', form=form)
+
+        workers = current_app.config.get('BULK_POST_WORKERS', 4)
+        job = BulkPostJob(kijiji_api, current_app.instance_path, current_user.id, current_user.token, payloads, workers,
+                          on_change=page_cache.invalidate)
+        executor.submit(job.run)
+
+        flash(f'Posting {len(payloads)} ads in background... Do not stop the app from running')
+        return redirect(url_for('.post_bulk_status', job_id=job.id))
+
+    if form.errors:
+        flash(form.errors)
+    return render_template('post_bulk.html', form=form)
+
+
+@ad.route('/post_bulk/<job_id>')
+@login_required
+def post_bulk_status(job_id):
+    """Show progress of bulk ad post job."""
+    status = BulkPostJob.load_status(current_app.instance_path, current_user.id, job_id)
+    if status is None:
+        flash(f'Bulk post job {job_id} not found')
+        return redirect(url_for('.post_bulk'))
+    return render_template('post_bulk.html', form=PostBulkForm(), status=status)
+
+
+def get_bulk_import_dir(directory):
+    """Resolve bulk import directory path.
+    Server directories are only allowed within the configured bulk import folder.
+    """
+    root = os.path.realpath(current_app.config.get('BULK_IMPORT_DIR', os.path.join(current_app.instance_path, 'import')))
+    path = os.path.realpath(os.path.join(root, directory))
+    if os.path.commonpath([root, path]) != root:
+        raise BulkImportException(f'Directory must be within {root}')
+    return path
+
+
+# Multi-step post form
+post_steps = [
+    'choose_category',
+    'fill_attributes',
+    'submit',
+]
+
+
 @ad.route('/post', methods=['GET', 'POST'])
 @login_required
 def post():
     """Post new ad using form."""
-
-    # Multi-step form
-    step = [
-        'choose_category',
-        'fill_attributes',
-        'submit',
-    ]
+    step = post_steps
 
     category_form = CategoryForm()
-    category_form.cat1.choices = [(cat['@id'], cat['cat:id-name']) for cat in kijiji_api.get_categories(current_user.id, current_user.token)['cat:categories']['cat:category']['cat:category']]
+    category_form.cat1.choices = [(cat['@id'], cat['cat:id-name']) for cat in metadata_cache.categories(kijiji_api, current_user.id, current_user.token)['cat:categories']['cat:category']['cat:category']]
 
     form = PostForm()
+    drafts = get_draft_store()
 
     if 'step' not in request.form:
         # Step 1: Choose ad category
 
-        return render_template('post.html', form=category_form, step=step[0], next_step=step[1])
+        return render_template('post.html', form=category_form, step=step[0], next_step=step[1], drafts=drafts.list())
 
     elif request.form['step'] == step[1]:
         # Step 2: Fill in ad attributes
@@ -95,49 +166,25 @@ def post():
 
         # Get most significant category ID from given set of categories in previous step form
         category_choice = (lambda x1, x2, x3: x3 if x3 else x2 if x2 else x1)(category_form.cat1.data, category_form.cat2.data, category_form.cat3.data)
-        session['category'] = category_choice
-        data = kijiji_api.get_attributes(current_user.id, current_user.token, category_choice)
+        data = metadata_cache.attributes(kijiji_api, current_user.id, current_user.token, category_choice)
 
         # Update supported ad type choices
         try:
             form.adtype.choices = [(x['#text'], x['@localized-label']) for x in data['ad:ad']['ad:ad-type']['ad:supported-value']]
-            session['adtype.choices'] = form.adtype.choices
         except KeyError:
             flash('No supported ad types available')
 
         # Location options
-        locations = kijiji_api.get_locations(current_user.id, current_user.token)
+        locations = metadata_cache.locations(kijiji_api, current_user.id, current_user.token)
         try:
             location_list = [(loc['@id'], loc['loc:localized-name']) for loc in locations['loc:locations']['loc:location']['loc:location']]
         except KeyError:
             # Only one location
             location_list = locations['loc:locations']['loc:location']['loc:localized-name']
         form.loc1.choices = location_list
-        session['loc1.choices'] = form.loc1.choices
 
         # Default form values from config file
-        default_ad_title = current_app.config.get('DEFAULT_AD_TITLE')
-        default_ad_desc = current_app.config.get('DEFAULT_AD_DESCRIPTION')
-        default_ad_price = current_app.config.get('DEFAULT_AD_PRICE')
-        default_postalcode = current_app.config.get('DEFAULT_POSTAL_CODE')
-        default_fulladdress = current_app.config.get('DEFAULT_FULL_ADDRESS')
-        default_phone = current_app.config.get('DEFAULT_PHONE')
-        try:
-            # Only apply default values if one was given
-            if default_ad_title:
-                form.adtitle.data = str(default_ad_title)
-            if default_ad_desc:
-                form.description.data = str(default_ad_desc)
-            if default_ad_price:
-                form.price.data = float(default_ad_price)
-            if default_postalcode:
-                form.postalcode.data = str(default_postalcode)
-            if default_fulladdress:
-                form.fulladdress.data = str(default_fulladdress)
-            if default_phone:
-                form.phone.data = str(default_phone)
-        except (TypeError, ValueError) as e:
-            flash(f'Unable to parse value from config file: {e}')
+        apply_form_defaults(form)
 
         # Begin parsing attributes xml for selected category
         attrib_types = {
@@ -211,30 +258,44 @@ def post():
 
         # Build dynamic attributes form
         attrib_form = create_attribute_form(attrib_types)
-        session['attrib_types'] = attrib_types
 
-        return render_template('post.html', form=form, step=step[1], next_step=step[2], attrib_form=attrib_form, attrib=category_choice)
+        # Keep dynamic form data in a server-side draft rather than in the session cookie
+        # Only the draft ID is passed along with the form to the next step
+        draft_id = drafts.create({
+            'category': category_choice,
+            'adtype.choices': form.adtype.choices or [],
+            'loc1.choices': form.loc1.choices,
+            'attrib_types': attrib_types,
+        })
+
+        return render_template('post.html', form=form, step=step[1], next_step=step[2], attrib_form=attrib_form, attrib=category_choice, draft_id=draft_id)
 
     elif request.form['step'] == step[2]:
+        draft = drafts.get(request.form.get('draft'))
+        if draft is None:
+            flash('Ad draft not found or has expired, please start again')
+            return redirect(url_for('.post'))
+
         # Restore dynamic form data
-        if not form.adtype.choices:
-            form.adtype.choices = session.get('adtype.choices', [])
-        if not form.loc1.choices:
-            form.loc1.choices = session.get('loc1.choices', [])
-        attrib_form = create_attribute_form(session.get('attrib_types'))
+        form.adtype.choices = draft['adtype.choices']
+        form.loc1.choices = draft['loc1.choices']
+        attrib_form = create_attribute_form(draft['attrib_types'])
 
         # Update dynamic car or motorcycle model choices
         if hasattr(attrib_form, 'carmake') and hasattr(attrib_form, 'carmodel'):
-            attrib_form.carmodel.choices = get_vehicle_model_choices(session.get('category'), attrib_form.carmake.data)
+            attrib_form.carmodel.choices = get_vehicle_model_choices(draft['category'], attrib_form.carmake.data)
         if hasattr(attrib_form, 'motorcyclesmake') and hasattr(attrib_form, 'motorcyclesmodel'):
-            attrib_form.motorcyclesmodel.choices = get_vehicle_model_choices(session.get('category'), attrib_form.motorcyclesmake.data)
+            attrib_form.motorcyclesmodel.choices = get_vehicle_model_choices(draft['category'], attrib_form.motorcyclesmake.data)
+
+        # Remember submitted values so that the draft can be resumed later or reused for a similar ad
+        drafts.update(draft['id'], {'title': form.adtitle.data, 'values': get_draft_values(request.form)})
 
         if not form.validate_on_submit() or not attrib_form.validate_on_submit():
             if form.errors:
                 flash(form.errors)
             if attrib_form.errors:
                 flash(attrib_form.errors)
-            return render_template('post.html', form=form, step=step[1], next_step=step[2], attrib_form=attrib_form, attrib=session.get('category'))
+            return render_template('post.html', form=form, step=step[1], next_step=step[2], attrib_form=attrib_form, attrib=draft['category'], draft_id=draft['id'])
 
         # Get most significant location ID from given set of locations in previous step form
         # Default to 'Canada' => '0' if none given
@@ -258,7 +319,7 @@ def post():
                 '@xmlns:user': 'http://www.ebayclassifiedsgroup.com/schema/user/v1',
                 '@xmlns:feature': 'http://www.ebayclassifiedsgroup.com/schema/feature/v1',
                 '@id': '',
-                'cat:category': {'@id': session['category']},
+                'cat:category': {'@id': draft['category']},
                 'loc:locations': {'loc:location': {'@id': location_choice}},
                 'ad:ad-type': {'ad:value': form.adtype.data},
                 'ad:title': form.adtitle.data,
@@ -294,8 +355,15 @@ def post():
 
         xml_payload = xmltodict.unparse(payload, short_empty_elements=True)
 
+        # Save payload as an ad template rather than posting it, placeholders and all
+        if form.template.data:
+            template_id = get_template_store().create(form.adtitle.data, xml_payload)
+            flash(f'Saved ad template {form.adtitle.data}')
+            return redirect(url_for('.template', template_id=template_id))
+
         # Submit final payload
         ad_id = kijiji_api.post_ad(current_user.id, current_user.token, xml_payload)
+        page_cache.invalidate(current_user.id)
         flash(f'Ad {ad_id} posted!')
 
         # Save ad payload
@@ -304,6 +372,194 @@ def post():
         return redirect(url_for('main.home'))
 
 
+@ad.route('/post/draft/<draft_id>')
+@login_required
+def post_draft(draft_id):
+    """Resume posting new ad from a saved draft."""
+    step = post_steps
+
+    draft = get_draft_store().get(draft_id)
+    if draft is None:
+        flash('Ad draft not found or has expired')
+        return redirect(url_for('.post'))
+
+    # Restore previously submitted form values if there are any
+    values = draft.get('values')
+    formdata = MultiDict(values) if values else None
+
+    form = PostForm(formdata=formdata)
+    form.adtype.choices = draft['adtype.choices']
+    form.loc1.choices = draft['loc1.choices']
+    if not values:
+        apply_form_defaults(form)
+    attrib_form = create_attribute_form(draft['attrib_types'], formdata)
+
+    return render_template('post.html', form=form, step=step[1], next_step=step[2], attrib_form=attrib_form, attrib=draft['category'], draft_id=draft['id'])
+
+
+@ad.route('/post/draft/<draft_id>/delete')
+@login_required
+def delete_draft(draft_id):
+    """Delete saved ad draft."""
+    get_draft_store().delete(draft_id)
+    flash('Deleted ad draft')
+    return redirect(url_for('.post'))
+
+
+def get_draft_store():
+    """Get ad draft store for current user."""
+    expiry = timedelta(hours=current_app.config.get('DRAFT_EXPIRY_HOURS', 72))
+    return DraftStore(current_app.instance_path, current_user.id, expiry)
+
+
+@ad.route('/templates', methods=['GET', 'POST'])
+@login_required
+def templates():
+    """List ad templates, and create a new template from a raw ad payload."""
+    store = get_template_store()
+    form = AdTemplateForm()
+    if form.validate_on_submit():
+        try:
+            template_id = store.create(form.name.data, form.payload.data)
+        except BulkImportException as e:
+            flash(e)
+        else:
+            flash(f'Saved ad template {form.name.data}')
+            return redirect(url_for('.template', template_id=template_id))
+
+    if form.errors:
+        flash(form.errors)
+    return render_template('templates.html', form=form, templates=store.list())
+
+
+@ad.route('/template/<template_id>', methods=['GET', 'POST'])
+@login_required
+def template(template_id):
+    """Show and edit ad template."""
+    store = get_template_store()
+    template = store.get(template_id)
+    if template is None:
+        flash(f'Ad template {template_id} not found')
+        return redirect(url_for('.templates'))
+
+    form = AdTemplateForm(data=template)
+    if form.validate_on_submit():
+        try:
+            template = store.update(template_id, form.name.data, form.payload.data)
+        except BulkImportException as e:
+            flash(e)
+        else:
+            flash(f'Saved ad template {form.name.data}')
+
+    if form.errors:
+        flash(form.errors)
+    return render_template('template.html', form=form, generate_form=AdTemplateGenerateForm(), template=template,
+                           fields=template_fields(template['payload']))
+
+
+@ad.route('/template/<template_id>/generate', methods=['POST'])
+@login_required
+def generate_from_template(template_id):
+    """Post one new ad from ad template for each row of uploaded CSV file of placeholder values."""
+    template = get_template_store().get(template_id)
+    if template is None:
+        flash(f'Ad template {template_id} not found')
+        return redirect(url_for('.templates'))
+
+    form = AdTemplateGenerateForm()
+    if not form.validate_on_submit():
+        flash(form.errors)
+        return redirect(url_for('.template', template_id=template_id))
+
+    try:
+        payloads = generate_payloads(template['payload'], form.file.data.read().decode('utf-8-sig'))
+    except UnicodeDecodeError as e:
+        flash(f'CSV file is not valid UTF-8 text: {e}')
+        return redirect(url_for('.template', template_id=template_id))
+    except BulkImportException as e:
+        flash(e)
+        return redirect(url_for('.template', template_id=template_id))
+
+    if not payloads:
+        flash('No rows found in CSV file')
+        return redirect(url_for('.template', template_id=template_id))
+
+    # Generated payloads are validated and posted in the same way as a bulk post
+    workers = current_app.config.get('BULK_POST_WORKERS', 4)
+    job = BulkPostJob(kijiji_api, current_app.instance_path, current_user.id, current_user.token, payloads, workers,
+                      on_change=page_cache.invalidate)
+    executor.submit(job.run)
+
+    flash(f'Posting {len(payloads)} ads from template {template["name"]} in background... Do not stop the app from running')
+    return redirect(url_for('.post_bulk_status', job_id=job.id))
+
+
+@ad.route('/template/<template_id>/delete')
+@login_required
+def delete_template(template_id):
+    """Delete ad template."""
+    get_template_store().delete(template_id)
+    flash('Deleted ad template')
+    return redirect(url_for('.templates'))
+
+
+@ad.route('/template/new/<ad_id>')
+@login_required
+def template_from_ad(ad_id):
+    """Create ad template from existing ad, reusing its already uploaded images."""
+    payloads = PayloadStore(current_app.instance_path, current_user.id)
+    xml_payload = payloads.load(ad_id)
+    if xml_payload is None:
+        xml_payload = generate_post_payload(kijiji_api, current_user.id, current_user.token, current_user.email, ad_id)
+
+    # Image URLs of older payloads may no longer be valid
+    xml_payload = translate_image_urls(kijiji_api, current_user.id, current_user.token, ad_id, xml_payload)
+
+    name = xmltodict.parse(xml_payload)['ad:ad'].get('ad:title') or ad_id
+    template_id = get_template_store().create(name, xml_payload)
+    flash(f'Saved ad template {name} from ad {ad_id}')
+    return redirect(url_for('.template', template_id=template_id))
+
+
+def get_template_store():
+    """Get ad template store for current user."""
+    return AdTemplateStore(current_app.instance_path, current_user.id)
+
+
+def get_draft_values(formdata):
+    """Get submitted post form values to save in ad draft.
+    Form control fields and uploaded files are not saved.
+    """
+    return {key: values for key, values in formdata.to_dict(flat=False).items()
+            if key not in ('csrf_token', 'step', 'draft', 'submit') and not key.startswith('file')}
+
+
+def apply_form_defaults(form):
+    """Apply default post form values from config file."""
+    default_ad_title = current_app.config.get('DEFAULT_AD_TITLE')
+    default_ad_desc = current_app.config.get('DEFAULT_AD_DESCRIPTION')
+    default_ad_price = current_app.config.get('DEFAULT_AD_PRICE')
+    default_postalcode = current_app.config.get('DEFAULT_POSTAL_CODE')
+    default_fulladdress = current_app.config.get('DEFAULT_FULL_ADDRESS')
+    default_phone = current_app.config.get('DEFAULT_PHONE')
+    try:
+        # Only apply default values if one was given
+        if default_ad_title:
+            form.adtitle.data = str(default_ad_title)
+        if default_ad_desc:
+            form.description.data = str(default_ad_desc)
+        if default_ad_price:
+            form.price.data = float(default_ad_price)
+        if default_postalcode:
+            form.postalcode.data = str(default_postalcode)
+        if default_fulladdress:
+            form.fulladdress.data = str(default_fulladdress)
+        if default_phone:
+            form.phone.data = str(default_phone)
+    except (TypeError, ValueError) as e:
+        flash(f'Unable to parse value from config file: {e}')
+
+
 class MultiCheckboxField(SelectMultipleField):
     """A multiple-select, except displays a list of checkboxes."""
     widget = widgets.ListWidget(prefix_label=False)
@@ -320,8 +576,10 @@ class KijijiDateField(DateField):
             self.data = datetime.combine(self.data, datetime.min.time()).strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
-def create_attribute_form(types):
-    """Build dynamic attribute form."""
+def create_attribute_form(types, formdata=None):
+    """Build dynamic attribute form.
+    Form is bound to the current request form data unless other form data is given.
+    """
     def insert_attr(obj, field_type, data, **kwargs):
         """Insert field attribute to form object."""
         try:
@@ -368,6 +626,8 @@ def create_attribute_form(types):
         for item in types['excepts']:
             insert_attr(AttributeForm, SelectField, item)
 
+    if formdata is not None:
+        return AttributeForm(formdata=formdata)
     return AttributeForm()
 
 
@@ -440,19 +700,34 @@ def create_picture_payload(data):
         'thumbnail': 64,
     }
 
-    for key, value in data.items():
-        if key.startswith('file') and value:
-            link = kijiji_api.upload_image(current_user.id, current_user.token, value)
-
-            # Add a separate link for each image size
-            links = []
-            for size_name, size_px in image_sizes.items():
-                links.append({
-                    '@rel': size_name,
-                    '@href': f'{link}?rule=kijijica-{size_px}-jpg',
-                })
+    files = [value for key, value in data.items() if key.startswith('file') and value]
+
+    # Reuse previously uploaded images with the same content, and only upload the others
+    uploaded = UploadedImageStore(current_app.instance_path, current_user.id)
+    contents = [f.read() for f in files]
+    digests = [uploaded.digest(content) for content in contents]
+    urls = [uploaded.get(digest) for digest in digests]
+
+    # Shrink all new images at once before uploading each one
+    new = [i for i, url in enumerate(urls) if url is None]
+    images = image_processor.process(
+        [FileStorage(BytesIO(contents[i]), files[i].filename, content_type=files[i].content_type) for i in new])
+    for i, image in zip(new, images):
+        expires = time.time() + kijiji_api.image_lifetime.total_seconds()
+        urls[i] = kijiji_api.upload_image(current_user.id, current_user.token, image)
+        uploaded.save(digests[i], urls[i], expires)
+
+    for link in urls:
+
+        # Add a separate link for each image size
+        links = []
+        for size_name, size_px in image_sizes.items():
+            links.append({
+                '@rel': size_name,
+                '@href': f'{link}?rule=kijijica-{size_px}-jpg',
+            })
 
-            payload['pic:picture'].append({'pic:link': links})
+        payload['pic:picture'].append({'pic:link': links})
 
     return payload if len(payload['pic:picture']) else {}
 
@@ -460,11 +735,7 @@ def create_picture_payload(data):
 @login_required
 def save_ad_file(ad_id, xml_payload):
     """Save ad payload to file."""
-    user_dir = os.path.join(current_app.instance_path, 'user', current_user.id)
-    os.makedirs(user_dir, exist_ok=True)
-    ad_file = os.path.join(user_dir, f'{ad_id}.xml')
-    with open(ad_file, 'w', encoding='utf-8') as f:
-        f.write(xml_payload)
+    ad_file = PayloadStore(current_app.instance_path, current_user.id).save(ad_id, xml_payload)
     flash(f'Ad {ad_id} payload saved to {ad_file}')
 
 
@@ -474,178 +745,46 @@ def repost(ad_id):
     """Repost existing ad by deleting it and posting a new ad with the same content."""
 
     # Get existing ad
-    user_dir = os.path.join(current_app.instance_path, 'user', current_user.id)
-    ad_file = os.path.join(user_dir, f'{ad_id}.xml')
-
-    if os.path.isfile(ad_file):
-        with open(ad_file, 'r', encoding='utf-8') as f:
-            xml_payload = f.read()
-    else:
-        # Get existing ad payload from Kijiji site when no local payload file found
-        xml_payload = generate_post_payload(ad_id)
-        if os.path.isfile(ad_file):
-            flash(f'Generated new file from existing ad on Kijiji site')
-        else:
-            flash(f'Failed to generate new ad file from existing ad on Kijiji site')
-            return redirect(url_for('main.home'))
-
-    # Kijiji changed their image upload API on around 2022-06-27 to use a different image host. Ad payloads that
-    # still contain the old image host URLs will be rejected unless the URLs are translated to the new image host.
-    # For ad payloads that already use the new image host, this translation should have no effect.
-    xml_payload = translate_image_urls(ad_id, xml_payload)
-
-    # Modify ad title by appending or removing a randomized length suffix
-    # This is done to avoid duplicate ad detection
-    xml_payload = modify_ad_title(xml_payload)
-
-    # Delete existing ad
-    kijiji_api.delete_ad(current_user.id, current_user.token, ad_id)
+    payloads = PayloadStore(current_app.instance_path, current_user.id)
+    generated = not payloads.exists(ad_id)
+    xml_payload = prepare_repost_payload(kijiji_api, current_user.id, current_user.token, current_user.email, payloads, ad_id, warn=flash)
+    if generated:
+        flash('Generated new file from existing ad on Kijiji site')
+
+    delay_minutes = REPOST_DELAY_MINUTES
+
+    # Delete existing ad, keeping track of the repost from here on
+    job = RepostJob(kijiji_api, current_app.instance_path, current_user.id, current_user.token, ad_id, xml_payload, delay_minutes,
+                    retries=current_app.config.get('REPOST_RETRIES', REPOST_RETRIES),
+                    retry_minutes=current_app.config.get('REPOST_RETRY_MINUTES', REPOST_RETRY_MINUTES),
+                    on_change=page_cache.invalidate)
+    job.delete()
     flash(f'Deleted old ad {ad_id}')
 
-    # Waiting for 3 minutes appears to be enough time for Kijiji to not consider it a duplicate ad
-    delay_minutes = 3
-
-    # Delay and then run callback to post ad again
-    future_response = executor.submit(delay, delay_minutes * 60, {'payload': xml_payload, 'ad_id': ad_id})
-    future_response.add_done_callback(post_ad_again)
+    # Post ad again in background after delay
+    executor.submit(job.run)
 
     flash(f'Reposting ad in background after {delay_minutes} minute delay... Do not stop the app from running')
     return redirect(url_for('main.home'))
 
 
-def delay(secs, data):
-    """Delay and pass along any data given."""
-    sleep(secs)
-    return data
-
-
-def post_ad_again(future):
-    """Post ad again using given ad payload in Futures call."""
-    if future.done():
-        error = future.exception()
-        if error:
-            print(f'Futures call error: {error}')
-        else:
-            result = future.result()
-            xml_payload = result['payload']
-            ad_id_orig = result['ad_id']
-
-            # Post ad again
-            ad_id_new = kijiji_api.post_ad(current_user.id, current_user.token, xml_payload)
-            print(f'Reposted ad, new ID {ad_id_new}')
-
-            user_dir = os.path.join(current_app.instance_path, 'user', current_user.id)
-
-            # Save ad file
-            ad_file_new = os.path.join(user_dir, f'{ad_id_new}.xml')
-            with open(ad_file_new, 'w', encoding='utf-8') as f:
-                f.write(xml_payload)
-
-            # Delete old ad file
-            ad_file_orig = os.path.join(user_dir, f'{ad_id_orig}.xml')
-            if os.path.isfile(ad_file_orig):
-                os.remove(ad_file_orig)
-                print(f'Deleted old ad file for ad {ad_id_orig}')
-    elif future.cancelled():
-        print('Futures call canceled')
-
-
-def translate_image_urls(ad_id, xml_payload):
-    """Overwrite image URLs in ad payload using image URLs from current ad."""
-    data = kijiji_api.get_ad(current_user.id, current_user.token, ad_id)
-    payload = xmltodict.parse(xml_payload)
-    payload['ad:ad']['pic:pictures'] = data['ad:ad']['pic:pictures']
-    return xmltodict.unparse(payload, short_empty_elements=True)
-
-
-def modify_ad_title(xml_payload):
-    """Modify ad title by appending or removing a randomized length suffix."""
-    def count_suffix_len(text, suffix_char):
-        """Count the number of consecutive characters in the string starting from the end."""
-        i = len(text)
-        for i in reversed(range(len(text))):
-            if text[i] != suffix_char:
-                i += 1
-                break
-        return len(text) - i
-
-    # Possible suffix character choices
-    suffix_chars = ['.', '!', '*', '+']
-
-    # Maximum number of consecutive suffix characters to append
-    suffix_max_length = 4
-
-    payload = xmltodict.parse(xml_payload)
-    ad_title_orig = payload['ad:ad']['ad:title']
-
-    # Test every possible suffix character, stopping on the first one found
-    # TODO Efficiency of this algorithm is pretty bad, but ad titles are limited to 64 characters at most
-    suffix_len = 0
-    for char in suffix_chars:
-        suffix_len = count_suffix_len(ad_title_orig, char)
-        if suffix_len:
-            break
-
-    if suffix_len:
-        # Suffix exists, remove it
-        ad_title_new = ad_title_orig[:-suffix_len].rstrip()
-    else:
-        # No suffix, append a random length one with a randomly chosen suffix character
-        suffix_new = f" {random.choice(suffix_chars) * random.randint(1, suffix_max_length)}"
-        ad_title_new = ad_title_orig + suffix_new
-
-        # Check if new ad title is longer than the maximum allowed ad title length
-        max_ad_title_length = 64
-        if len(ad_title_new) > max_ad_title_length:
-            flash(f'Warning: Truncating modified ad title "{ad_title_new}" to {max_ad_title_length} characters')
-            ad_title_new = ad_title_orig[:max_ad_title_length - len(suffix_new)] + suffix_new
-
-    payload['ad:ad']['ad:title'] = ad_title_new
-    return xmltodict.unparse(payload, short_empty_elements=True)
-
-
-def generate_post_payload(ad_id):
-    """Get existing ad data and save ad payload to file."""
-    data = kijiji_api.get_ad(current_user.id, current_user.token, ad_id)
-    ad_orig = data['ad:ad']
-    payload = {
-        'ad:ad': {
-            '@xmlns:ad': 'http://www.ebayclassifiedsgroup.com/schema/ad/v1',
-            '@xmlns:cat': 'http://www.ebayclassifiedsgroup.com/schema/category/v1',
-            '@xmlns:loc': 'http://www.ebayclassifiedsgroup.com/schema/location/v1',
-            '@xmlns:attr': 'http://www.ebayclassifiedsgroup.com/schema/attribute/v1',
-            '@xmlns:types': 'http://www.ebayclassifiedsgroup.com/schema/types/v1',
-            '@xmlns:pic': 'http://www.ebayclassifiedsgroup.com/schema/picture/v1',
-            '@xmlns:vid': 'http://www.ebayclassifiedsgroup.com/schema/video/v1',
-            '@xmlns:user': 'http://www.ebayclassifiedsgroup.com/schema/user/v1',
-            '@xmlns:feature': 'http://www.ebayclassifiedsgroup.com/schema/feature/v1',
-            '@id': '',
-            'cat:category': ad_orig['cat:category'],
-            'loc:locations': ad_orig['loc:locations'],
-            'ad:ad-type': ad_orig['ad:ad-type'],
-            'ad:title': ad_orig['ad:title'],
-            'ad:description':  ad_orig['ad:description'],
-            'ad:price': ad_orig.get('ad:price'),
-            'ad:account-id': current_user.id,
-            'ad:email': current_user.email,
-            'ad:poster-contact-email': current_user.email,
-            # 'ad:poster-contact-name': None,  # Not sent by Kijiji app
-            'ad:phone': ad_orig['ad:phone'],
-            'ad:ad-address': ad_orig['ad:ad-address'],
-            'ad:visible-on-map': 'true',  # appears to make no difference if set to 'true' or 'false'
-            'attr:attributes': ad_orig['attr:attributes'],
-            'pic:pictures': ad_orig['pic:pictures'],
-            'vid:videos': None,
-            'ad:adSlots': None,
-            'ad:listing-tags': None,
-        }
-    }
-    xml_payload = xmltodict.unparse(payload, short_empty_elements=True)
-
-    # Save ad payload
-    save_ad_file(ad_id, xml_payload)
+@ad.route('/repost_job/<job_id>/retry')
+@login_required
+def retry_repost(job_id):
+    """Post the deleted ad of a failed repost job again."""
+    job = RepostJob.load(kijiji_api, current_app.instance_path, current_user.id, current_user.token, job_id,
+                         retries=current_app.config.get('REPOST_RETRIES', REPOST_RETRIES),
+                         retry_minutes=current_app.config.get('REPOST_RETRY_MINUTES', REPOST_RETRY_MINUTES),
+                         on_change=page_cache.invalidate)
+    if job is None or not job.retry():
+        if job is not None:
+            job.release()
+        flash(f'Repost job {job_id} not found, already running or cannot be retried')
+        return redirect(url_for('main.home'))
 
-    return xml_payload
+    executor.submit(job.run)
+    flash(f'Retrying repost of ad {job.status["ad_id"]} in background... Do not stop the app from running')
+    return redirect(url_for('main.home'))
 
 
 @ad.route('/repost_all')
@@ -655,13 +794,8 @@ def repost_all():
 
     # Get all existing ads
     data = kijiji_api.get_ad(current_user.id, current_user.token)
-    ads = data['ad:ads']['ad:ad']
-
-    # If there is only one ad, force it to a list
-    if not isinstance(ads, list):
-        ads = [ads]
 
-    for ad_id in [ad['@id'] for ad in ads]:
+    for ad_id in [ad.id for ad in parse_ads(data)]:
         repost(ad_id)
 
     return redirect(url_for('main.home'))
@@ -0,0 +1,63 @@
+import itertools
+import socket
+from datetime import datetime
+
+from flask import Blueprint, Response, stream_with_context, abort, request
+from flask_login import login_required, current_user
+
+from kijiji_manager.export import FORMATS, AD_FIELDS, CONVERSATION_FIELDS, iter_ads, iter_conversations, flatten_ad, flatten_conversation, export as export_rows
+from kijiji_manager.kijijiapi import KijijiApi
+
+export = Blueprint('export', __name__)
+kijiji_api = KijijiApi()
+
+
+@export.route('/export/ads.<fmt>')
+@login_required
+def ads(fmt):
+    """Stream all ads as JSONL or CSV file download."""
+    rows = (flatten_ad(ad) for ad in iter_ads(kijiji_api, current_user.id, current_user.token))
+    return _stream(rows, AD_FIELDS, fmt, 'ads')
+
+
+@export.route('/export/conversations.<fmt>')
+@login_required
+def conversations(fmt):
+    """Stream all conversations as JSONL or CSV file download."""
+    rows = (flatten_conversation(c) for c in iter_conversations(kijiji_api, current_user.id, current_user.token))
+    return _stream(rows, CONVERSATION_FIELDS, fmt, 'conversations')
+
+
+def _stream(rows, fieldnames, fmt, name):
+    """Build streaming file download response.
+    Pages are fetched from Kijiji as the response is sent, so only one page is held in memory at a time.
+    The first page is fetched before the response is built, so that errors such as an expired session
+    get the usual error page rather than a download.
+    """
+    if fmt not in FORMATS:
+        abort(404)
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is not None:
+        rows = itertools.chain([first], rows)
+    chunks = _abort_on_error(export_rows(rows, fieldnames, fmt), request.environ.get('werkzeug.socket'))
+    filename = f'{name}-{datetime.now().strftime("%Y%m%d-%H%M%S")}.{fmt}'
+    return Response(stream_with_context(chunks), mimetype=FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+def _abort_on_error(chunks, connection):
+    """Pass through chunks, dropping the connection if fetching a later page fails.
+    The download then fails rather than being saved as a complete looking but truncated file.
+    Gunicorn already drops the connection once a response has started, while the development server
+    would append an error page and end the response cleanly, so its socket is shut down here.
+    """
+    try:
+        yield from chunks
+    except Exception:
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        raise
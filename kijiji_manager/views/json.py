@@ -1,11 +1,87 @@
-from flask import Blueprint, request, jsonify
+import time
+
+from flask import Blueprint, request, jsonify, current_app, abort, url_for
 from flask_login import login_required, current_user
 
-from kijiji_manager.kijijiapi import KijijiApi
+from kijiji_manager.accounts import AccountBatchJob
+from kijiji_manager.adindex import AdIndex
+from kijiji_manager.bulk import BulkPostJob
+from kijiji_manager.cache import page_cache
+from kijiji_manager.export import iter_ads
+from kijiji_manager.history import HistoryStore, downsample
+from kijiji_manager.kijijiapi import KijijiApi, KijijiApiException
+from kijiji_manager.locations import nearest_location
+from kijiji_manager.metadata import metadata_cache
+from kijiji_manager.records import Ad
+from kijiji_manager.replies import ReplyBatchJob
+from kijiji_manager.repost import RepostJob
 
 json = Blueprint('json', __name__)
 kijiji_api = KijijiApi()
 
+# Seconds to keep the index of all ads used by the ad table, unless `CACHE_SECONDS` is longer
+# The ad table requests a new page on every sort, search and page change, so this is always cached for a while
+AD_INDEX_SECONDS = 60
+
+
+@json.route('/ads')
+@login_required
+def get_ads():
+    """Return JSON page of ads for the home page ad table, using the DataTables server-side processing protocol.
+    Query string values 'start' and 'length' select the page, 'search[value]' filters ads by text,
+    and 'order[0][column]' with 'order[0][dir]' sort by the column whose 'columns[<n>][data]' is given.
+    See https://datatables.net/manual/server-side for details.
+    """
+    index = page_cache.data(current_user.id, 'ad-index', _build_ad_index, ttl=max(page_cache.ttl, AD_INDEX_SECONDS))
+
+    column_number = request.args.get('order[0][column]', type=int)
+    column = request.args.get(f'columns[{column_number}][data]') if column_number is not None else None
+    length = request.args.get('length', -1, type=int)
+
+    total, ads = index.query(search=request.args.get('search[value]', '').strip(),
+                             column=column,
+                             descending=request.args.get('order[0][dir]') == 'desc',
+                             start=max(0, request.args.get('start', 0, type=int)),
+                             length=length if length >= 0 else None)
+
+    return jsonify({
+        'draw': request.args.get('draw', 0, type=int),
+        'recordsTotal': len(index),
+        'recordsFiltered': total,
+        'data': [_ad_row(ad) for ad in ads],
+    })
+
+
+def _build_ad_index():
+    """Fetch all ads and build the index used by the ad table."""
+    ads = list(iter_ads(kijiji_api, current_user.id, current_user.token))
+
+    # Ad data has already been fetched, so record it to the ad history for free
+    # Skipped for ads that were sampled recently to avoid a sample on every page refresh
+    history_minutes = current_app.config.get('HISTORY_SAMPLE_MINUTES')
+    if history_minutes:
+        HistoryStore(current_app.instance_path, current_user.id).record_ads(ads, min_interval=history_minutes * 60)
+
+    return AdIndex(Ad.from_dict(ad) for ad in ads)
+
+
+def _ad_row(ad):
+    """Return ad table row dict of given ad record."""
+    return {
+        'id': ad.id,
+        'thumbnail': ad.thumbnail,
+        'title': ad.title,
+        'category': ad.category,
+        'price': ad.price_label,
+        'views': ad.views,
+        'page': ad.page,
+        'start': str(ad.start_at) if ad.start_at else None,
+        'end': str(ad.end_at) if ad.end_at else None,
+        'url': url_for('ad.show', ad_id=ad.id),
+        'repost_url': url_for('ad.repost', ad_id=ad.id),
+        'delete_url': url_for('ad.delete', ad_id=ad.id),
+    }
+
 
 @json.route('/cat')
 @login_required
@@ -16,7 +92,7 @@ def get_category():
     """
 
     # Start at category ID 0 ('All Categories')
-    data = kijiji_api.get_categories(current_user.id, current_user.token)['cat:categories']['cat:category']
+    data = metadata_cache.categories(kijiji_api, current_user.id, current_user.token)['cat:categories']['cat:category']
 
     # Top level categories
     categories = _get_subcategories(data)
@@ -62,7 +138,7 @@ def get_location():
     """
 
     # Start at location ID 0 ('Canada')
-    data = kijiji_api.get_locations(current_user.id, current_user.token)['loc:locations']['loc:location']
+    data = metadata_cache.locations(kijiji_api, current_user.id, current_user.token)['loc:locations']['loc:location']
 
     locations = data['loc:location']
 
@@ -92,6 +168,31 @@ def get_location():
     } for l in locations])
 
 
+@json.route('/loc/nearest')
+@login_required
+def get_nearest_location():
+    """Return JSON dict of the most specific location closest to the postal code given in the query string.
+    The dict has location 'id', 'name', 'lat' and 'long' keys, and a 'path' list of location IDs from the top level down.
+    Returns an empty dict if the postal code is unknown.
+    """
+    postal_code = request.args.get('postalcode', '').strip()
+    if not postal_code:
+        return jsonify({})
+    try:
+        location = nearest_location(kijiji_api, current_user.id, current_user.token, postal_code)
+    except KijijiApiException:
+        location = None
+    if location is None:
+        return jsonify({})
+    return jsonify({
+        'id': location['id'],
+        'name': location['name'],
+        'lat': location['latitude'],
+        'long': location['longitude'],
+        'path': location['path'],
+    })
+
+
 @json.route('/attrib')
 @login_required
 def get_supported_values():
@@ -107,7 +208,7 @@ def get_supported_values():
 
     attribs = []
     if attrib_id:
-        data = kijiji_api.get_attributes(current_user.id, current_user.token, attrib_id)
+        data = metadata_cache.attributes(kijiji_api, current_user.id, current_user.token, attrib_id)
         if data:
             if 'attr:dependent-attributes' in data['ad:ad']:
                 # Start at list of all dependent attributes
@@ -121,3 +222,76 @@ def get_supported_values():
                                 attribs.append({'id': subval['#text'], 'name': subval['@localized-label']})
 
     return jsonify(attribs)
+
+
+@json.route('/bulk/<job_id>')
+@login_required
+def get_bulk_status(job_id):
+    """Return JSON status of bulk ad post job, including the result of each ad payload."""
+    status = BulkPostJob.load_status(current_app.instance_path, current_user.id, job_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+@json.route('/account_batch/<job_id>')
+@login_required
+def get_account_batch_status(job_id):
+    """Return JSON status of multiple account batch job, including the progress of each account."""
+    status = AccountBatchJob.load_status(current_app.instance_path, current_user.id, job_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+@json.route('/reply_batch/<job_id>')
+@login_required
+def get_reply_batch_status(job_id):
+    """Return JSON status of bulk reply job, including the result of each conversation."""
+    status = ReplyBatchJob.load_status(current_app.instance_path, current_user.id, job_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+@json.route('/repost_jobs')
+@login_required
+def get_repost_jobs():
+    """Return JSON list of status of all repost jobs, most recent first.
+    Optional 'state' query string value only includes jobs in the given state, e.g. 'failed'.
+    """
+    jobs = RepostJob.list_status(current_app.instance_path, current_user.id)
+    state = request.args.get('state')
+    if state:
+        jobs = [job for job in jobs if job['state'] == state]
+    return jsonify(jobs)
+
+
+@json.route('/repost_job/<job_id>')
+@login_required
+def get_repost_status(job_id):
+    """Return JSON status of background repost job, including the new ad ID once posted."""
+    status = RepostJob.load_status(current_app.instance_path, current_user.id, job_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+@json.route('/history/<ad_id>')
+@login_required
+def get_ad_history(ad_id):
+    """Return JSON list of performance samples for given ad ID, oldest first.
+    Each sample is a dict with 'time' (epoch seconds), 'views', 'phone_clicks', 'map_views', and 'rank' keys.
+    Optional 'days' query string value limits samples to the given number of most recent days,
+    and 'resolution' downsamples to at most one sample per given number of seconds.
+    """
+    resolution = request.args.get('resolution', 0, type=int)
+    days = request.args.get('days', type=float)
+    since = time.time() - days * 24 * 60 * 60 if days else None
+
+    try:
+        samples = HistoryStore(current_app.instance_path, current_user.id).read(ad_id, since)
+    except ValueError:
+        abort(404)
+
+    return jsonify({'ad_id': ad_id, 'resolution': resolution, 'samples': downsample(samples, resolution)})
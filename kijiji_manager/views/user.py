@@ -1,11 +1,23 @@
-from flask import Blueprint, flash, render_template, redirect, url_for, request, abort
+import time
+
+from flask import Blueprint, flash, render_template, redirect, url_for, request, abort, current_app
 from flask_login import login_required, current_user, login_user, logout_user
 from is_safe_url import is_safe_url
 
+from kijiji_manager.accounts import ACTIONS, AccountBatchJob, summarize_accounts
+from kijiji_manager.adtemplates import fill_text
+from kijiji_manager.cache import page_cache
+from kijiji_manager.conversations import ConversationStore, fetch_conversation
+from kijiji_manager.credentials import CredentialStore
 from kijiji_manager.models import User
+from kijiji_manager.forms.accounts import AccountBatchForm
 from kijiji_manager.forms.login import LoginForm
-from kijiji_manager.forms.conversation import ConversationForm
+from kijiji_manager.forms.conversation import ConversationForm, ReplyBatchForm, CannedResponseForm
 from kijiji_manager.kijijiapi import KijijiApi, KijijiApiException
+from kijiji_manager.records import parse_conversation, parse_conversations
+from kijiji_manager.replies import REPLY_FIELDS, CannedResponseStore, ReplyBatchJob, check_reply, reply_target, reply_values
+from kijiji_manager.repost import RepostJob, resume_reposts
+from kijiji_manager.views.ad import executor
 
 user = Blueprint('user', __name__)
 kijiji_api = KijijiApi()
@@ -31,7 +43,13 @@ def login():
             return render_template('login.html', form=form)
 
         # Create user object instance and login
-        login_user(User(user_id, token, email, display_name))
+        login_user(User(user_id, token, email, display_name, time.time()))
+
+        # Keep credentials to log in again in the background once the token gets old, if enabled
+        if current_app.config.get('SAVE_CREDENTIALS'):
+            CredentialStore(current_app.instance_path).save(user_id, email, password)
+
+        resume_user_reposts(user_id, token)
 
         # Validate the `next` parameter
         next = request.values.get('next')
@@ -52,11 +70,118 @@ def login():
 def logout():
     """Logout of session."""
     User.clear(current_user.id)
+    page_cache.invalidate(current_user.id)
+    CredentialStore(current_app.instance_path).delete(current_user.id)
     logout_user()
     flash('Logged out')
     return redirect(url_for('.login'))
 
 
+@user.route('/accounts', methods=['GET', 'POST'])
+@login_required
+def accounts():
+    """Show totals of all accounts logged in within this session, and run actions on many accounts at once."""
+    users = User.accounts()
+    form = AccountBatchForm()
+    form.accounts.choices = [(u.id, f'{u.name} ({u.email})') for u in users]
+
+    if form.validate_on_submit():
+        selected = [_user_dict(u) for u in users if u.id in form.accounts.data]
+        job = AccountBatchJob(kijiji_api, current_app.instance_path, current_user.id, selected, form.action.data,
+                              current_app.config.get('ACCOUNT_ACTIONS_PER_MINUTE', 10), on_change=page_cache.invalidate)
+        executor.submit(job.run)
+
+        flash(f'Running "{ACTIONS[form.action.data]}" on {len(selected)} accounts in background... Do not stop the app from running')
+        return redirect(url_for('.accounts', job=job.id))
+
+    if form.errors:
+        flash(form.errors)
+
+    status = None
+    job_id = request.args.get('job')
+    if job_id:
+        status = AccountBatchJob.load_status(current_app.instance_path, current_user.id, job_id)
+
+    summaries = summarize_accounts(kijiji_api, [_user_dict(u) for u in users])
+    return render_template('accounts.html', form=form, summaries=summaries, status=status, actions=ACTIONS)
+
+
+@user.route('/accounts/add', methods=['GET', 'POST'])
+@login_required
+def add_account():
+    """Login to another account, keeping the current account logged in."""
+    form = LoginForm()
+    if form.validate_on_submit():
+        email = request.form['email']
+        password = request.form['password']
+
+        try:
+            user_id, token = kijiji_api.login(email, password)
+            display_name = kijiji_api.get_profile(user_id, token)['user:user-profile']['user:user-display-name']
+        except KijijiApiException as e:
+            flash(e)
+            return render_template('login.html', form=form, action=url_for('.add_account'))
+
+        # Add user to session user db without switching to it
+        User(user_id, token, email, display_name, time.time())
+        if current_app.config.get('SAVE_CREDENTIALS'):
+            CredentialStore(current_app.instance_path).save(user_id, email, password)
+        resume_user_reposts(user_id, token)
+
+        flash(f'Added account {display_name}')
+        return redirect(url_for('.accounts'))
+
+    if form.errors:
+        flash(form.errors)
+    return render_template('login.html', form=form, action=url_for('.add_account'))
+
+
+@user.route('/accounts/switch/<user_id>')
+@login_required
+def switch_account(user_id):
+    """Switch current user to another account logged in within this session."""
+    account = User.get(user_id)
+    if account is None:
+        flash(f'Account {user_id} is not logged in')
+        return redirect(url_for('.accounts'))
+
+    login_user(account)
+    flash(f'Switched to account {account.name}')
+    return redirect(url_for('main.home'))
+
+
+@user.route('/accounts/remove/<user_id>')
+@login_required
+def remove_account(user_id):
+    """Logout of another account logged in within this session."""
+    if user_id == current_user.id:
+        flash('Cannot remove the current account, logout instead')
+    elif User.get(user_id):
+        User.clear(user_id)
+        page_cache.invalidate(user_id)
+        CredentialStore(current_app.instance_path).delete(user_id)
+        flash(f'Removed account {user_id}')
+    return redirect(url_for('.accounts'))
+
+
+def resume_user_reposts(user_id, token):
+    """Resume reposts of user interrupted by the app stopping, and report reposts that failed."""
+    resumed = resume_reposts(kijiji_api, current_app.instance_path, user_id, token, executor.submit, page_cache.invalidate)
+    if resumed:
+        flash(f'Resumed {len(resumed)} interrupted reposts in background')
+
+    failed = [job for job in RepostJob.list_status(current_app.instance_path, user_id)
+              if job['state'] == 'failed' and job['deleted']]
+    if failed:
+        flash(f'{len(failed)} reposted ads were deleted but could not be posted again: ads {", ".join(job["ad_id"] for job in failed)}. '
+              f'See {url_for("json.get_repost_jobs", state="failed")} and retry them from /repost_job/<job id>/retry')
+
+
+def _user_dict(user):
+    """Return user dict as used by background tasks for given user object."""
+    return {'id': user.id, 'token': user.token, 'email': user.email, 'name': user.name}
+
+
 @user.route('/profile')
 @login_required
 def profile():
@@ -69,45 +194,26 @@ def profile():
 @login_required
 def conversations(page):
     """Show all user conversations."""
-    data = kijiji_api.get_conversation_page(current_user.id, current_user.token, page)
-    return render_template('conversations.html', conversations=data, page=page)
+    data = page_cache.data(current_user.id, f'conversations/{page}', lambda: kijiji_api.get_conversation_page(current_user.id, current_user.token, page))
+    conversations = parse_conversations(data)
+    return page_cache.render_page(current_user.id, 'conversations.html', 'fragments/conversation_rows.html', conversations,
+                                  conversations=conversations, page=page)
 
 
 @user.route('/conversation/<uid>', methods=['GET', 'POST'])
 @login_required
 def conversation(uid):
     """Show specific user conversation."""
-    data = kijiji_api.get_conversation(current_user.id, current_user.token, uid)
+    data = parse_conversation(page_cache.data(current_user.id, f'conversation/{uid}',
+                                              lambda: fetch_conversation(kijiji_api, current_user.id, current_user.token, uid,
+                                                                         ConversationStore(current_app.instance_path, current_user.id))))
     form = ConversationForm()
     if form.validate_on_submit():
-        ad_id = data['user:user-conversation']['user:ad-id']
-        owner_id = data['user:user-conversation']['user:ad-owner-id']
-        owner_email = data['user:user-conversation']['user:ad-owner-email']
-        owner_name = data['user:user-conversation']['user:ad-owner-name']
-        replier_id = data['user:user-conversation']['user:ad-replier-id']
-        replier_email = data['user:user-conversation']['user:ad-replier-email']
-        replier_name = data['user:user-conversation']['user:ad-replier-name']
-
-        # Ad has been deleted if owner ID is 'null'
-        # Subject will also say 'Deleted Ad'
-        if owner_id != 'null':
-            reply_message = form.message.data
-            reply_username = None
-            reply_email = None
-            reply_direction = None
-
-            if owner_id == current_user.id:
-                # Replying to our own ad
-                reply_email = owner_email
-                reply_username = owner_name
-                reply_direction = 'buyer'
-            elif replier_id == current_user.id:
-                # Replying to someone else's ad
-                reply_email = replier_email
-                reply_username = replier_name
-                reply_direction = 'owner'
-
-            kijiji_api.post_conversation_reply(current_user.id, current_user.token, uid, ad_id, reply_username, reply_email, reply_message, reply_direction)
+        target = reply_target(data, current_user.id, current_user.name, current_user.email)
+        if target is not None:
+            reply_username, reply_email, reply_direction = target
+            kijiji_api.post_conversation_reply(current_user.id, current_user.token, uid, data.ad_id, reply_username, reply_email, form.message.data, reply_direction)
+            page_cache.invalidate(current_user.id)
             flash('Reply sent')
 
             # Redirect to this url, clearing form data and refreshing the page
@@ -117,4 +223,87 @@ def conversation(uid):
 
     if form.errors:
         flash(form.errors)
-    return render_template('conversation.html', conversation=data, form=form)
+    responses = CannedResponseStore(current_app.instance_path, current_user.id).list()
+    values = reply_values(data, current_user.id, current_user.name)
+    return render_template('conversation.html', conversation=data, form=form,
+                           responses=[dict(r, message=_fill_reply(r['message'], values)) for r in responses])
+
+
+@user.route('/replies', methods=['GET', 'POST'])
+@login_required
+def replies():
+    """Send the same reply to many conversations of a conversations page at once."""
+    page = request.args.get('page', 0, type=int)
+
+    # Same data as the conversations page, so it is not fetched again while cached
+    data = page_cache.data(current_user.id, f'conversations/{page}', lambda: kijiji_api.get_conversation_page(current_user.id, current_user.token, page))
+    conversations = parse_conversations(data)
+
+    store = CannedResponseStore(current_app.instance_path, current_user.id)
+    responses = store.list()
+
+    form = ReplyBatchForm()
+    form.conversations.choices = [(c.uid, f'{c.replier_name if c.owner_id == current_user.id else c.owner_name} - {c.subject}')
+                                  for c in conversations]
+    form.response.choices = [('', 'None, use reply below')] + [(r['id'], r['name']) for r in responses]
+
+    if form.validate_on_submit():
+        response = store.get(form.response.data)
+        message = response['message'] if response else form.message.data
+        error = check_reply(message) if message else 'Enter a reply or choose a canned response'
+        if error:
+            flash(error)
+        else:
+            selected = [c for c in conversations if c.uid in form.conversations.data]
+            job = ReplyBatchJob(kijiji_api, current_app.instance_path, current_user.id, current_user.token, current_user.name, current_user.email, message, selected,
+                                current_app.config.get('REPLIES_PER_MINUTE', 20), current_app.config.get('REPLY_WORKERS', 4),
+                                on_change=page_cache.invalidate)
+            executor.submit(job.run)
+
+            flash(f'Sending reply to {len(selected)} conversations in background...')
+            return redirect(url_for('.replies', page=page, job=job.id))
+
+    if form.errors:
+        flash(form.errors)
+
+    status = None
+    job_id = request.args.get('job')
+    if job_id:
+        status = ReplyBatchJob.load_status(current_app.instance_path, current_user.id, job_id)
+
+    return render_template('replies.html', form=form, page=page, status=status, responses=responses,
+                           response_form=CannedResponseForm(), fields=REPLY_FIELDS)
+
+
+@user.route('/responses', methods=['POST'])
+@login_required
+def add_response():
+    """Save a new canned response."""
+    form = CannedResponseForm()
+    if form.validate_on_submit():
+        error = check_reply(form.message.data)
+        if error:
+            flash(error)
+        else:
+            CannedResponseStore(current_app.instance_path, current_user.id).create(form.name.data, form.message.data)
+            flash(f'Saved canned response "{form.name.data}"')
+    if form.errors:
+        flash(form.errors)
+    return redirect(request.referrer if request.referrer and is_safe_url(request.referrer, request.host_url) else url_for('.replies'))
+
+
+@user.route('/responses/<response_id>/delete')
+@login_required
+def delete_response(response_id):
+    """Delete a canned response."""
+    CannedResponseStore(current_app.instance_path, current_user.id).delete(response_id)
+    flash('Deleted canned response')
+    return redirect(url_for('.replies'))
+
+
+def _fill_reply(message, values):
+    """Fill in placeholders of a canned response, leaving it as is if it cannot be filled in."""
+    try:
+        return fill_text(message, values)
+    except KeyError:
+        return message
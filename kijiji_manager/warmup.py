@@ -0,0 +1,48 @@
+import logging
+import time
+
+from .kijijiapi import KijijiApi
+from .metadata import metadata_cache
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up(api, users=(), connections=4):
+    """Get the app ready for its first requests: open pooled connections to Kijiji,
+    and load category and location metadata and postal code data
+
+    Category and location metadata is the same for every user, but can only be fetched with a session token,
+    so it is only loaded if a user is already known, e.g. from before the app was restarted.
+    Each step that fails is logged and skipped.
+
+    :param api: KijijiApi instance
+    :param users: list of user dicts with 'id' and 'token' keys
+    :param connections: number of connections to open
+    :return: dict of step name to seconds taken, for steps that succeeded
+    """
+    timings = {}
+
+    def step(name, func):
+        start = time.monotonic()
+        try:
+            func()
+        except Exception as e:
+            logger.warning('Warm-up step %s failed: %s', name, e)
+        else:
+            timings[name] = time.monotonic() - start
+
+    start = time.monotonic()
+    step('connections', lambda: api.connect(connections))
+
+    user = next((u for u in users if u.get('token')), None)
+    if user:
+        step('categories', lambda: metadata_cache.categories(api, user['id'], user['token']))
+        step('locations', lambda: metadata_cache.locations(api, user['id'], user['token']))
+    else:
+        logger.info('Warm-up: no known user to fetch category and location metadata with, skipping')
+
+    step('postal codes', KijijiApi.nominatim)
+
+    logger.info('Warm-up finished in %.2fs: %s', time.monotonic() - start,
+                ', '.join(f'{name} {seconds:.2f}s' for name, seconds in timings.items()) or 'nothing warmed up')
+    return timings
@@ -42,6 +42,9 @@ setup(
         'phonenumbers',
         'pgeocode',
     ],
+    extras_require={
+        'images': ['Pillow'],
+    },
     entry_points={
         'console_scripts': ['kijiji-manager=kijiji_manager.__main__:main']
     },